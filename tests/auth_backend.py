@@ -0,0 +1,321 @@
+import abc
+import argparse
+import asyncio
+import collections
+import concurrent.futures
+import getpass
+import hashlib
+import hmac
+import os
+import socket
+import sqlite3
+import sys
+import threading
+import time
+
+from server_log import log
+
+# --- Authentication ---
+# Checks AUTH credentials for tcp_server.py and udp_server.py. Without --auth-db
+# every AUTH succeeds, as before; with it, secrets are checked against a backend.
+# A backend is an AuthBackend whose verify(username, secret) -> bool may be called
+# from several threads at once; SqliteAuthBackend keeps salted PBKDF2-SHA256
+# hashes in a local SQLite file (this module's command line adds users to it).
+# Hashing is deliberately slow, so it never runs on a serving loop: an
+# Authenticator hands it to a small thread pool (hashlib's PBKDF2 releases the
+# GIL, so the loop keeps running while the pool hashes) and returns the verdict
+#   verify()        blocking, for the threaded TCP engine's client threads
+#   verify_async()  awaitable, for the asyncio engine
+#   verify_later()  callback on the selector loop, which registers wakeup_socket()
+#                   and calls run_completed() when it becomes readable
+# Recent successful verifications are cached (LRU, bounded by entries and by
+# age), so a storm of clients reconnecting at once costs an HMAC each rather
+# than a hash; identical credentials already being hashed share that one hash.
+# The cache keeps an HMAC of the secret under a per-process random key, never
+# the secret itself. Failed verifications are not cached: repeated wrong
+# secrets are for the AUTH rate limits, see rate_limit.py. A secret changed in
+# the database keeps working until its cache entry ages out (--auth-cache-ttl).
+# Pool threads, database connections and the wakeup socket are created on first
+# use, so a server may build its Authenticator before forking --workers; each
+# worker then has its own pool and cache.
+
+DEFAULT_ITERATIONS = 100_000 # PBKDF2 rounds for newly stored secrets, tens of ms per hash
+SALT_BYTES = 16
+DEFAULT_WORKERS = 2 # Hashing threads; more only helps with more cores
+DEFAULT_CACHE_SIZE = 65536 # Verified credentials kept
+DEFAULT_CACHE_TTL = 300.0 # Seconds a verified secret is trusted without hashing it again
+LOAD_SECRET = "secret" # What load_generator.py and the benchmarks send
+
+
+def hash_secret(secret, salt, iterations):
+    return hashlib.pbkdf2_hmac("sha256", secret.encode("utf-8"), salt, iterations)
+
+
+class AuthBackend(abc.ABC):
+    """Credential store interface; verify() is called from the Authenticator's pool threads."""
+    @abc.abstractmethod
+    def verify(self, username, secret):
+        """Returns True when secret is the user's. May block (disk, hashing)."""
+
+    def close(self):
+        pass
+
+
+class SqliteAuthBackend(AuthBackend):
+    """Users with salted PBKDF2-SHA256 secrets in a SQLite file; one connection per thread."""
+    def __init__(self, path, iterations=DEFAULT_ITERATIONS):
+        self.path = path
+        self.iterations = iterations
+        self.local = threading.local()
+        # Unknown users are hashed too, so a reply's timing does not tell which users exist
+        self.dummy_salt = os.urandom(SALT_BYTES)
+        with self.connection() as db:
+            db.execute("CREATE TABLE IF NOT EXISTS users (username TEXT PRIMARY KEY, salt BLOB NOT NULL, "
+                       "hash BLOB NOT NULL, iterations INTEGER NOT NULL)")
+
+    def connection(self):
+        db = getattr(self.local, "db", None)
+        if db is None:
+            db = self.local.db = sqlite3.connect(self.path, timeout=5.0)
+        return db
+
+    def verify(self, username, secret):
+        row = self.connection().execute("SELECT salt, hash, iterations FROM users WHERE username = ?",
+                                        (username,)).fetchone()
+        if row is None:
+            hash_secret(secret, self.dummy_salt, self.iterations)
+            return False
+        salt, stored, iterations = row
+        return hmac.compare_digest(hash_secret(secret, salt, iterations), stored)
+
+    def set_secrets(self, credentials):
+        """Adds or replaces users from (username, secret) pairs in one transaction."""
+        rows = []
+        for username, secret in credentials:
+            salt = os.urandom(SALT_BYTES)
+            rows.append((username, salt, hash_secret(secret, salt, self.iterations), self.iterations))
+        with self.connection() as db:
+            db.executemany("INSERT OR REPLACE INTO users VALUES (?, ?, ?, ?)", rows)
+
+    def remove(self, username):
+        with self.connection() as db:
+            return db.execute("DELETE FROM users WHERE username = ?", (username,)).rowcount > 0
+
+    def usernames(self):
+        return [row[0] for row in self.connection().execute("SELECT username FROM users ORDER BY username")]
+
+    def close(self):
+        db = getattr(self.local, "db", None)
+        if db is not None:
+            db.close()
+            self.local.db = None
+
+
+class VerifiedCache:
+    """Recently verified credentials, least recently used evicted first, each trusted for ttl seconds."""
+    def __init__(self, size=DEFAULT_CACHE_SIZE, ttl=DEFAULT_CACHE_TTL):
+        self.size = size
+        self.ttl = ttl
+        self.key = os.urandom(32)
+        self.lock = threading.Lock() # Threaded TCP looks up from every client thread, the pool stores
+        self.entries = collections.OrderedDict() # Key: username, Value: (secret digest, expiry time)
+        self.hits = 0
+        self.misses = 0
+
+    def digest(self, secret):
+        return hmac.new(self.key, secret.encode("utf-8"), hashlib.sha256).digest()
+
+    def lookup(self, username, digest, now):
+        """True if username was verified with this secret digest less than ttl seconds ago."""
+        with self.lock:
+            entry = self.entries.get(username)
+            if entry is not None and entry[1] > now and hmac.compare_digest(entry[0], digest):
+                self.entries.move_to_end(username)
+                self.hits += 1
+                return True
+            self.misses += 1
+            return False
+
+    def store(self, username, digest, now):
+        if self.size <= 0:
+            return
+        with self.lock:
+            self.entries[username] = (digest, now + self.ttl)
+            self.entries.move_to_end(username)
+            if len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+
+    def hit_ratio(self):
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else None
+
+
+class Verdict:
+    """Outcome of one AUTH check: ok, whether the cache answered it, and the seconds spent in the pool."""
+    __slots__ = ("ok", "cached", "seconds")
+
+    def __init__(self, ok, cached, seconds=0.0):
+        self.ok = ok
+        self.cached = cached
+        self.seconds = seconds # Queueing and hashing; 0 for cache hits
+
+
+class Authenticator:
+    """Verifies credentials against a backend off the serving loop, with a VerifiedCache in front."""
+    def __init__(self, backend, cache=None, workers=DEFAULT_WORKERS, clock=time.monotonic):
+        self.backend = backend
+        self.cache = cache if cache is not None else VerifiedCache()
+        self.workers = workers
+        self.clock = clock
+        self.lock = threading.Lock()
+        self.pool = None
+        self.in_flight = {} # Key: (username, secret digest), Value: Future of a hash being computed
+        self.completed = collections.deque() # (callback, args, verdict) waiting for run_completed()
+        self.wakeup_reader = None
+        self.wakeup_writer = None
+        self.hashed = 0
+        self.rejected = 0
+
+    def submit(self, username, secret):
+        """Returns a concurrent.futures.Future of the Verdict, already done on a cache hit."""
+        digest = self.cache.digest(secret)
+        if self.cache.lookup(username, digest, self.clock()):
+            future = concurrent.futures.Future()
+            future.set_result(Verdict(True, True))
+            return future
+        key = (username, digest)
+        with self.lock:
+            future = self.in_flight.get(key)
+            if future is None:
+                if self.pool is None:
+                    self.pool = concurrent.futures.ThreadPoolExecutor(self.workers, thread_name_prefix="auth")
+                future = self.in_flight[key] = self.pool.submit(self._check, username, secret, digest,
+                                                                time.perf_counter())
+        return future
+
+    def _check(self, username, secret, digest, submitted):
+        """Pool thread: asks the backend; a store that fails rejects the AUTH rather than admitting it."""
+        try:
+            ok = bool(self.backend.verify(username, secret))
+        except Exception as e:
+            log.error(f"Credential check for '{username}' failed: {e}")
+            ok = False
+        if ok:
+            self.cache.store(username, digest, self.clock())
+        with self.lock:
+            del self.in_flight[(username, digest)]
+            self.hashed += 1
+            self.rejected += not ok
+        return Verdict(ok, False, time.perf_counter() - submitted)
+
+    def verify(self, username, secret):
+        """Blocks the calling thread (never a loop) until the Verdict is known."""
+        return self.submit(username, secret).result()
+
+    async def verify_async(self, username, secret):
+        return await asyncio.wrap_future(self.submit(username, secret))
+
+    def verify_later(self, username, secret, callback, *args):
+        """Calls callback(*args, verdict) on the loop: right away on a cache hit, else from run_completed()."""
+        future = self.submit(username, secret)
+        if future.done():
+            callback(*args, future.result())
+            return
+        self.wakeup_socket()
+        future.add_done_callback(lambda done: self._complete(callback, args, done.result()))
+
+    def _complete(self, callback, args, verdict):
+        self.completed.append((callback, args, verdict))
+        try:
+            self.wakeup_writer.send(b"\0")
+        except BlockingIOError:
+            pass # The loop has wakeups pending anyway
+
+    def wakeup_socket(self):
+        """Socket that becomes readable when verify_later() results are waiting; register it with the loop."""
+        if self.wakeup_reader is None:
+            self.wakeup_reader, self.wakeup_writer = socket.socketpair()
+            self.wakeup_reader.setblocking(False)
+            self.wakeup_writer.setblocking(False)
+        return self.wakeup_reader
+
+    def run_completed(self):
+        """Loop side of verify_later(): runs the callbacks of every verdict reached so far."""
+        try:
+            while self.wakeup_reader.recv(4096):
+                pass
+        except BlockingIOError:
+            pass
+        while self.completed:
+            callback, args, verdict = self.completed.popleft()
+            try:
+                callback(*args, verdict)
+            except Exception as e:
+                log.error(f"Unexpected error completing AUTH: {e}")
+
+    def describe(self):
+        ratio = self.cache.hit_ratio()
+        return (f"cache_hits={self.cache.hits} cache_misses={self.cache.misses} "
+                f"hit_ratio={'n/a' if ratio is None else f'{ratio:.3f}'} cached={len(self.cache.entries)} "
+                f"hashed={self.hashed} rejected={self.rejected} in_flight={len(self.in_flight)}")
+
+
+def add_auth_arguments(parser):
+    """Adds the authentication options shared by the test servers to an argparse parser."""
+    group = parser.add_argument_group("authentication (every AUTH succeeds unless --auth-db is given)")
+    group.add_argument("--auth-db", default=None, metavar="PATH",
+                       help="Check AUTH secrets against this SQLite user database (see auth_backend.py)")
+    group.add_argument("--auth-workers", type=int, default=DEFAULT_WORKERS,
+                       help="Threads hashing secrets off the serving loop")
+    group.add_argument("--auth-cache-size", type=int, default=DEFAULT_CACHE_SIZE,
+                       help="Recently verified credentials remembered (0 hashes every AUTH)")
+    group.add_argument("--auth-cache-ttl", type=float, default=DEFAULT_CACHE_TTL,
+                       help="Seconds a verified secret is accepted again without hashing")
+
+def authenticator_from_args(args):
+    """Returns an Authenticator, or None when AUTH is not checked."""
+    if not args.auth_db:
+        return None
+    if not os.path.exists(args.auth_db):
+        raise SystemExit(f"No user database at {args.auth_db}; create it with auth_backend.py")
+    try:
+        backend = SqliteAuthBackend(args.auth_db)
+    except sqlite3.Error as e:
+        raise SystemExit(f"Cannot open user database {args.auth_db}: {e}")
+    log.info(f"Checking AUTH against {args.auth_db} ({len(backend.usernames())} users)")
+    backend.close() # The pool threads open their own connections
+    return Authenticator(backend, VerifiedCache(args.auth_cache_size, args.auth_cache_ttl), args.auth_workers)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Manage the IPK25-CHAT test servers' SQLite user database")
+    parser.add_argument("db", help="Database file, created if missing")
+    parser.add_argument("--iterations", type=int, default=DEFAULT_ITERATIONS,
+                        help="PBKDF2 rounds for the secrets stored by this run")
+    commands = parser.add_subparsers(dest="command", required=True)
+    add = commands.add_parser("add", help="Add a user or replace its secret")
+    add.add_argument("username")
+    add.add_argument("--secret", default=None, help="Secret to store (prompted for if omitted)")
+    load = commands.add_parser("add-load", help=f"Add users load0..loadN-1 with secret '{LOAD_SECRET}', "
+                                                "as load_generator.py and the benchmarks authenticate")
+    load.add_argument("count", type=int)
+    remove = commands.add_parser("remove", help="Remove a user")
+    remove.add_argument("username")
+    commands.add_parser("list", help="List the usernames")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    backend = SqliteAuthBackend(args.db, args.iterations)
+    if args.command == "add":
+        backend.set_secrets([(args.username, args.secret if args.secret is not None else getpass.getpass("Secret: "))])
+    elif args.command == "add-load":
+        backend.set_secrets((f"load{index}", LOAD_SECRET) for index in range(args.count))
+        print(f"Stored {args.count} load users", file=sys.stderr)
+    elif args.command == "remove":
+        if not backend.remove(args.username):
+            raise SystemExit(f"No user '{args.username}'")
+    else:
+        print("\n".join(backend.usernames()))
+    backend.close()
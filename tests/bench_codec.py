@@ -0,0 +1,132 @@
+import argparse
+import struct
+import timeit
+
+import udp_codec
+from udp_codec import HEADER, HEADER_SIZE, MSG_TYPE_MSG, NUL, parse_header, unpack_strings
+
+# --- Benchmark: original udp_server.py helpers vs. udp_codec ---
+# The legacy functions below are verbatim copies of the helpers udp_server.py
+# used before the codec existed, kept here only as the comparison baseline.
+# The pack_into/memoryview variants are the alternatives that were measured
+# and lost under CPython; they stay here so the choice can be re-checked.
+
+ENCODING = 'us-ascii'
+
+
+def legacy_pack_msg(message_id, display_name, content):
+    enc_display = display_name.encode(ENCODING)
+    enc_content = content.encode(ENCODING)
+    fmt = f'>BH{len(enc_display)}sx{len(enc_content)}sx'
+    return struct.pack(fmt, MSG_TYPE_MSG, message_id, enc_display, enc_content)
+
+def legacy_pack_confirm(ref_message_id):
+    return struct.pack('>BH', udp_codec.MSG_TYPE_CONFIRM, ref_message_id)
+
+def legacy_parse_udp_message(data):
+    if len(data) < 3:
+        return None
+    msg_type, msg_id = struct.unpack('>BH', data[:3])
+    return msg_type, msg_id, data[3:]
+
+def legacy_unpack_string_from(data):
+    try:
+        null_pos = data.index(b'\x00')
+        value = data[:null_pos].decode(ENCODING)
+        remaining = data[null_pos+1:]
+        return value, remaining
+    except (ValueError, UnicodeDecodeError):
+        return None, data
+
+
+def legacy_parse_msg(data):
+    msg_type, msg_id, content = legacy_parse_udp_message(data)
+    display_name, remaining = legacy_unpack_string_from(content)
+    message, remaining = legacy_unpack_string_from(remaining)
+    return display_name, message
+
+def codec_parse_msg(data):
+    msg_type, msg_id = parse_header(data)
+    return tuple(unpack_strings(data, 2))
+
+
+class ReusableFrameBuilder:
+    """pack_into a preallocated bytearray; the returned view is valid until the next call."""
+    def __init__(self, capacity=65535):
+        self.buffer = bytearray(capacity)
+        self.view = memoryview(self.buffer)
+        self.header_view = self.view[:HEADER_SIZE]
+
+    def pack_confirm(self, ref_message_id):
+        HEADER.pack_into(self.buffer, 0, udp_codec.MSG_TYPE_CONFIRM, ref_message_id)
+        return self.header_view
+
+    def pack_msg(self, message_id, display_name, content):
+        buffer = self.buffer
+        HEADER.pack_into(buffer, 0, MSG_TYPE_MSG, message_id)
+        offset = HEADER_SIZE
+        for field in (display_name, content):
+            encoded = field.encode(ENCODING)
+            end = offset + len(encoded)
+            buffer[offset:end] = encoded
+            buffer[end] = 0
+            offset = end + 1
+        return self.view[:offset]
+
+
+def memoryview_parse_msg(data):
+    msg_type, msg_id = parse_header(data)
+    values = []
+    offset = HEADER_SIZE
+    with memoryview(data) as view:
+        for _ in range(2):
+            end = data.find(NUL, offset)
+            values.append(str(view[offset:end], ENCODING))
+            offset = end + 1
+    return tuple(values)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark UDP pack/parse helpers")
+    parser.add_argument("--number", type=int, default=200000)
+    parser.add_argument("--content-length", type=int, default=200, help="MSG content length in characters")
+    args = parser.parse_args()
+
+    content = "x" * args.content_length
+    frame = udp_codec.pack_msg(42, "display", content)
+    assert legacy_pack_msg(42, "display", content) == frame
+    assert legacy_parse_msg(frame) == codec_parse_msg(frame)
+    builder = ReusableFrameBuilder()
+    assert bytes(builder.pack_msg(42, "display", content)) == frame
+    assert memoryview_parse_msg(frame) == codec_parse_msg(frame)
+
+    cases = [
+        ("pack MSG", [
+            ("legacy f-string struct", lambda: legacy_pack_msg(42, "display", content)),
+            ("codec (bytes)", lambda: udp_codec.pack_msg(42, "display", content)),
+            ("pack_into reusable bytearray", lambda: builder.pack_msg(42, "display", content)),
+        ]),
+        ("pack CONFIRM", [
+            ("legacy struct.pack", lambda: legacy_pack_confirm(42)),
+            ("codec (bytes)", lambda: udp_codec.pack_confirm(42)),
+            ("pack_into reusable bytearray", lambda: builder.pack_confirm(42)),
+        ]),
+        ("parse MSG", [
+            ("legacy slicing", lambda: legacy_parse_msg(frame)),
+            ("codec offset walk", lambda: codec_parse_msg(frame)),
+            ("memoryview offset walk", lambda: memoryview_parse_msg(frame)),
+        ]),
+    ]
+    print(f"{args.number} iterations, MSG content {args.content_length} chars")
+    for title, variants in cases:
+        print(title)
+        baseline = None
+        for name, func in variants:
+            seconds = min(timeit.repeat(func, number=args.number, repeat=3))
+            ns = seconds / args.number * 1e9
+            baseline = baseline or ns
+            print(f"  {name:30} {ns:7.0f} ns/op   x{baseline / ns:.2f}")
+
+
+if __name__ == "__main__":
+    main()
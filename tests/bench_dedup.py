@@ -0,0 +1,74 @@
+import argparse
+import sys
+import time
+import tracemalloc
+
+from udp_dedup import MessageIdWindow
+
+# --- Benchmark: set of received MessageIDs vs. MessageIdWindow ---
+# Simulates long-running chatty sessions: every session sends --messages
+# sequential MessageIDs (wrapping the uint16) with a retransmitted duplicate
+# every --dup-every messages. Reports memory per session, time per check and
+# how many genuinely new messages each structure wrongly flags as duplicates.
+
+
+class SetDedup:
+    """The original SessionData behaviour: remember every MessageID forever."""
+    __slots__ = ("ids",)
+
+    def __init__(self):
+        self.ids = set()
+
+    def contains(self, msg_id):
+        return msg_id in self.ids
+
+    def add(self, msg_id):
+        self.ids.add(msg_id)
+
+
+def replay(records, messages, dup_every):
+    false_duplicates = 0
+    missed_duplicates = 0
+    for record in records:
+        for i in range(messages):
+            msg_id = i % 65536
+            if record.contains(msg_id):
+                false_duplicates += 1
+            else:
+                record.add(msg_id)
+            if dup_every and i % dup_every == 0 and not record.contains(msg_id):
+                missed_duplicates += 1 # The retransmit of msg_id must be recognised
+    return false_duplicates, missed_duplicates
+
+
+def run(factory, sessions, messages, dup_every):
+    # Timed pass without tracemalloc, whose hooks would dominate the per-message cost
+    start = time.perf_counter()
+    false_duplicates, missed_duplicates = replay([factory() for _ in range(sessions)], messages, dup_every)
+    elapsed = time.perf_counter() - start
+
+    tracemalloc.start()
+    records = [factory() for _ in range(sessions)]
+    replay(records, messages, dup_every)
+    current, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return current / sessions, elapsed / (sessions * messages) * 1e9, false_duplicates, missed_duplicates
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark client MessageID duplicate detection")
+    parser.add_argument("--sessions", type=int, default=20)
+    parser.add_argument("--messages", type=int, default=200000, help="Messages per session (>65536 wraps)")
+    parser.add_argument("--dup-every", type=int, default=10)
+    args = parser.parse_args()
+
+    print(f"{args.sessions} sessions x {args.messages} messages, duplicate every {args.dup_every}")
+    print(f"Empty record: set {sys.getsizeof(set())} B, window {sys.getsizeof(MessageIdWindow())} B (+ mask int)")
+    for name, factory in (("set", SetDedup), ("window", MessageIdWindow)):
+        per_session, ns_per_check, false_dups, missed = run(factory, args.sessions, args.messages, args.dup_every)
+        print(f"{name:7} {per_session / 1024:9.1f} KiB/session  {ns_per_check:6.0f} ns/msg  "
+              f"false duplicates: {false_dups}  missed duplicates: {missed}")
+
+
+if __name__ == "__main__":
+    main()
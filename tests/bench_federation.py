@@ -0,0 +1,220 @@
+import argparse
+import asyncio
+import os
+import signal
+import subprocess
+import sys
+import time
+
+from bench_workers import wait_for_port
+from chat_core import ChatCore
+from federation import Federation
+from tcp_framing import CRLF
+from tcp_grammar import ENCODING
+
+# --- Benchmark: cross-node fan-out vs. cluster size ---
+# Starts a federation of N chat_server.py nodes (see federation.py) for each N,
+# puts --receivers TCP clients and one sender on every node into one channel,
+# and measures two things:
+#   latency     the sender on node 0 posts --probes MSGs carrying their send time;
+#               p50/p99 until they arrive, separately for receivers on node 0
+#               (local fan-out) and on the other nodes (one link hop)
+#   throughput  every sender posts --burst MSGs back to back; MSG deliveries per
+#               second until every receiver has all of them
+# All nodes and the clients share this machine's cores, so on a small machine
+# adding nodes mostly adds per-node overhead rather than capacity.
+# --flap instead links two nodes in this process, drops their link, empties one
+# of node 1's channels while the link is down, and checks that after the
+# relink node 0 no longer sends that channel's broadcasts to node 1.
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+CHANNEL = "bench"
+
+
+class BenchClient:
+    """A TCP chat client that counts burst MSGs and timestamps probe MSGs."""
+    def __init__(self, name, node):
+        self.name = name
+        self.node = node
+        self.reader = None
+        self.writer = None
+        self.task = None
+        self.latencies = []
+        self.burst_received = 0
+        self.burst_done = None # Future set once the expected burst MSGs arrived
+        self.burst_expected = 0
+
+    async def connect(self, port):
+        self.reader, self.writer = await asyncio.open_connection("127.0.0.1", port)
+        for line in (f"AUTH {self.name} AS {self.name} USING secret", f"JOIN {CHANNEL} AS {self.name}"):
+            self.send(line)
+            while not (await self.reader.readline()).startswith(b"REPLY"):
+                pass
+        self.task = asyncio.ensure_future(self.read())
+
+    def send(self, line):
+        self.writer.write((line + CRLF).encode(ENCODING))
+
+    async def read(self):
+        while True:
+            line = await self.reader.readline()
+            if not line:
+                return
+            content = line.decode(ENCODING).rstrip().partition(" IS ")[2]
+            if content.startswith("probe "):
+                self.latencies.append(time.perf_counter() - float(content.split()[1]))
+            elif content.startswith("burst "):
+                self.burst_received += 1
+                if self.burst_received == self.burst_expected and self.burst_done is not None:
+                    self.burst_done.set_result(None)
+
+    def close(self):
+        self.writer.close()
+
+
+def percentile(samples, q):
+    samples = sorted(samples)
+    return samples[min(int(len(samples) * q), len(samples) - 1)] * 1000 if samples else float("nan")
+
+
+async def measure(args, nodes):
+    receivers = []
+    senders = []
+    for node in range(nodes):
+        for index in range(args.receivers):
+            receivers.append(BenchClient(f"r{node}x{index}", node))
+        senders.append(BenchClient(f"s{node}", node))
+    await asyncio.gather(*(client.connect(args.port + client.node) for client in receivers + senders))
+    await asyncio.sleep(0.5) # Let the SUBSCRIBEs reach every node
+
+    for index in range(args.probes):
+        senders[0].send(f"MSG FROM s0 IS probe {time.perf_counter()!r} {index}")
+        await asyncio.sleep(args.probe_interval)
+    await asyncio.sleep(0.5)
+    local = [value for client in receivers if client.node == 0 for value in client.latencies]
+    remote = [value for client in receivers if client.node != 0 for value in client.latencies]
+
+    loop = asyncio.get_running_loop()
+    for client in receivers:
+        client.burst_expected = args.burst * nodes
+        client.burst_done = loop.create_future()
+    started = time.perf_counter()
+    for sender in senders:
+        for index in range(args.burst):
+            sender.send(f"MSG FROM {sender.name} IS burst {index}")
+    try:
+        await asyncio.wait_for(asyncio.gather(*(client.burst_done for client in receivers)), args.timeout)
+    except asyncio.TimeoutError:
+        pass
+    elapsed = time.perf_counter() - started
+    delivered = sum(client.burst_received for client in receivers)
+    expected = len(receivers) * args.burst * nodes
+    for client in receivers + senders:
+        client.close()
+    return local, remote, delivered, expected, elapsed
+
+
+def run_case(args, nodes):
+    cluster = ",".join(str(args.link_port + node) for node in range(nodes))
+    processes = [subprocess.Popen([sys.executable, "chat_server.py", "--port", str(args.port + node),
+                                   "--cluster", cluster, "--node-id", str(node), "--log-level", "warn"],
+                                  cwd=HERE, stdout=subprocess.DEVNULL)
+                 for node in range(nodes)]
+    try:
+        for node in range(nodes):
+            wait_for_port("tcp", args.port + node)
+        time.sleep(0.5) # Links dial with backoff
+        return asyncio.run(measure(args, nodes))
+    finally:
+        for process in processes:
+            process.send_signal(signal.SIGINT)
+        for process in processes:
+            process.wait(timeout=10)
+
+
+async def wait_until(condition, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            raise SystemExit("Timed out waiting for the federation links")
+        await asyncio.sleep(0.01)
+
+
+async def check_flap(args):
+    """Returns node 0's view of node 1's channels after a link flap, and what node 0 published meanwhile."""
+    ports = [args.link_port, args.link_port + 1]
+    nodes = []
+    for node_id in range(2):
+        core = ChatCore()
+        federation = Federation(node_id, ports, core)
+        core.on_broadcast = federation.publish
+        core.channels.on_channel_opened = federation.subscribe
+        core.channels.on_channel_closed = federation.unsubscribe
+        nodes.append(federation)
+    first, second = nodes
+    for federation in nodes:
+        await federation.start()
+    staying, leaving = object(), object() # Channel members as far as the registry is concerned
+    second.core.channels.join(staying, "kept")
+    second.core.channels.join(leaving, "emptied")
+    await wait_until(lambda: first.peers[1].interest == {"kept", "emptied"})
+
+    first.server.close() # Node 1 redials node 0, so keep the link down until start() listens again
+    second.peers[0].protocol.transport.abort()
+    await wait_until(lambda: second.peers[0].protocol is None and first.peers[1].protocol is None)
+    second.core.channels.leave(leaving) # Its UNSUBSCRIBE has no link to go out on
+    await first.start()
+    await wait_until(lambda: second.peers[0].protocol is not None and first.peers[1].protocol is not None)
+    await asyncio.sleep(0.1) # Let the SUBSCRIBE list of the new connection arrive
+    interest = set(first.peers[1].interest)
+    published = first.published
+    first.publish("emptied", "probe", "after the flap", None)
+    published = first.published - published
+    for federation in nodes:
+        federation.server.close()
+        for peer in federation.peers.values():
+            if peer.protocol is not None:
+                peer.protocol.transport.close()
+            if peer.dialer is not None:
+                peer.dialer.cancel()
+    return interest, published
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark cross-node fan-out across federation sizes")
+    parser.add_argument("--nodes", default="1,2,3,4", help="Comma-separated cluster sizes")
+    parser.add_argument("--port", type=int, default=4600, help="Client port of node 0 (node N uses PORT+N)")
+    parser.add_argument("--link-port", type=int, default=5600, help="Link port of node 0 (node N uses LINK_PORT+N)")
+    parser.add_argument("--receivers", type=int, default=20, help="Receiving clients per node")
+    parser.add_argument("--probes", type=int, default=200, help="Latency probes sent from node 0")
+    parser.add_argument("--probe-interval", type=float, default=0.01, help="Seconds between probes")
+    parser.add_argument("--burst", type=int, default=200, help="MSGs each node's sender posts for the throughput run")
+    parser.add_argument("--timeout", type=float, default=30.0, help="Seconds to wait for a burst to arrive")
+    parser.add_argument("--flap", action="store_true",
+                        help="Check that a link flap leaves no stale channel subscriptions, instead of benchmarking")
+    args = parser.parse_args()
+
+    if args.flap:
+        interest, published = asyncio.run(check_flap(args))
+        print(f"after the flap node 0 has node 1 in {sorted(interest)}, "
+              f"a broadcast to the emptied channel went to {published} peer(s)")
+        if interest != {"kept"} or published:
+            sys.exit(1)
+        return
+
+    print(f"{args.receivers} receivers per node, {args.probes} probes, burst {args.burst} per node, "
+          f"{os.cpu_count()} CPU(s)")
+    baseline = None
+    for nodes in [int(value) for value in args.nodes.split(",")]:
+        local, remote, delivered, expected, elapsed = run_case(args, nodes)
+        rate = delivered / elapsed
+        baseline = baseline or rate
+        remote_text = f"remote p50 {percentile(remote, 0.5):6.2f} ms p99 {percentile(remote, 0.99):6.2f} ms" \
+            if nodes > 1 else "remote      n/a"
+        print(f"  nodes={nodes:<2} local p50 {percentile(local, 0.5):6.2f} ms p99 {percentile(local, 0.99):6.2f} ms   "
+              f"{remote_text}   delivered {rate:10.1f} msg/s x{rate / baseline:.2f}   "
+              f"({delivered}/{expected} in {elapsed:.2f} s)")
+
+
+if __name__ == "__main__":
+    main()
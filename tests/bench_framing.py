@@ -0,0 +1,83 @@
+import argparse
+import time
+
+from tcp_framing import LineFramer
+
+# --- Micro-benchmark: legacy str splitting vs. LineFramer ---
+# Feeds ~1 MB of pipelined MSG lines to both framers in large and tiny chunks,
+# plus one huge line trickled in small pieces (the worst case for rescanning).
+
+CRLF = "\r\n"
+ENCODING = 'us-ascii'
+
+
+def legacy_feed(state, data):
+    """The original handle_client() framing: str += chunk, then split(CRLF, 1) per message."""
+    state[0] += data.decode(ENCODING)
+    lines = []
+    while CRLF in state[0]:
+        message, state[0] = state[0].split(CRLF, 1)
+        lines.append(message)
+    return lines
+
+
+def build_payload(total_bytes):
+    lines = []
+    size = 0
+    i = 0
+    while size < total_bytes:
+        line = f"MSG FROM user{i % 100} IS message number {i} with some filler text to pad it out{CRLF}"
+        lines.append(line)
+        size += len(line)
+        i += 1
+    return "".join(lines).encode(ENCODING), i
+
+
+def chunked(payload, chunk_size):
+    return [payload[i:i + chunk_size] for i in range(0, len(payload), chunk_size)]
+
+
+def run_legacy(chunks):
+    state = [""]
+    count = 0
+    start = time.perf_counter()
+    for chunk in chunks:
+        count += len(legacy_feed(state, chunk))
+    return time.perf_counter() - start, count
+
+
+def run_framer(chunks, max_line_length):
+    framer = LineFramer(max_line_length, ENCODING)
+    count = 0
+    start = time.perf_counter()
+    for chunk in chunks:
+        count += len(framer.feed(chunk))
+    return time.perf_counter() - start, count
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark TCP CRLF framing")
+    parser.add_argument("--size", type=int, default=1 << 20, help="Payload size in bytes")
+    parser.add_argument("--large-chunk", type=int, default=65536)
+    parser.add_argument("--tiny-chunk", type=int, default=7)
+    args = parser.parse_args()
+
+    payload, line_count = build_payload(args.size)
+    long_line = b"MSG FROM a IS " + b"x" * args.size + CRLF.encode(ENCODING)
+    scenarios = [
+        (f"pipelined, {args.large_chunk} B chunks", chunked(payload, args.large_chunk), line_count),
+        (f"pipelined, {args.tiny_chunk} B chunks", chunked(payload, args.tiny_chunk), line_count),
+        ("one huge line, 512 B chunks", chunked(long_line, 512), 1),
+    ]
+
+    print(f"Payload: {len(payload)} bytes, {line_count} lines")
+    for name, chunks, expected in scenarios:
+        legacy_time, legacy_count = run_legacy(chunks)
+        framer_time, framer_count = run_framer(chunks, len(long_line))
+        assert legacy_count == framer_count == expected, (legacy_count, framer_count, expected)
+        print(f"{name:32} legacy {legacy_time * 1000:9.1f} ms   framer {framer_time * 1000:9.1f} ms"
+              f"   speedup x{legacy_time / framer_time:.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,105 @@
+import argparse
+import random
+import re
+import time
+
+from tcp_grammar import parse_command
+
+# --- Benchmark: regex chain vs. single-pass TCP command parser ---
+# The legacy patterns and dispatch below are verbatim copies of what
+# tcp_server.py used before tcp_grammar existed: a message_type() split for the
+# metrics label, then one anchored regex per command tried in turn, so a BYE or
+# a malformed line paid for every pattern before it. Kept here only as the
+# comparison baseline. The corpus mixes commands in roughly chat proportions
+# (mostly MSG), keyword case variants and malformed lines.
+
+RE_AUTH = re.compile(r"^AUTH\s+([a-zA-Z0-9_-]{1,20})\s+AS\s+([\x21-\x7E]{1,20})\s+USING\s+([a-zA-Z0-9_-]{1,128})$")
+RE_JOIN = re.compile(r"^JOIN\s+([a-zA-Z0-9_-]{1,20})\s+AS\s+([\x21-\x7E]{1,20})$")
+RE_MSG = re.compile(r"^MSG\s+FROM\s+([\x21-\x7E]{1,20})\s+IS\s+(.*)$", re.DOTALL) # DOTALL for multiline messages potentially ending before CRLF
+RE_BYE = re.compile(r"^BYE\s+FROM\s+([\x21-\x7E]{1,20})$")
+MESSAGE_TYPES = frozenset(("AUTH", "JOIN", "MSG", "BYE", "ERR", "REPLY"))
+
+
+def legacy_message_type(message):
+    keyword = message.partition(" ")[0].upper()
+    return keyword if keyword in MESSAGE_TYPES else "UNKNOWN"
+
+def legacy_parse(message):
+    label = legacy_message_type(message)
+    for keyword, pattern in (("AUTH", RE_AUTH), ("JOIN", RE_JOIN), ("MSG", RE_MSG), ("BYE", RE_BYE)):
+        match = pattern.match(message)
+        if match:
+            return keyword, match.groups()
+    return label, None
+
+def single_pass_parse(message):
+    keyword, fields = parse_command(message)
+    return (keyword if keyword in MESSAGE_TYPES else "UNKNOWN"), fields
+
+
+def build_corpora(size, content_length, seed):
+    rng = random.Random(seed)
+    content = "x" * (content_length - 10) + " some text"
+    valid = [
+        (1, "AUTH user_01 AS Alice USING s3cr3t-value"),
+        (2, "JOIN general AS Alice"),
+        (40, f"MSG FROM Alice IS {content}"),
+        (1, "BYE FROM Alice"),
+    ]
+    variants = [
+        (1, "auth user_01 as Alice using s3cr3t-value"),
+        (1, "Join general As Alice"),
+        (2, f"msg from Alice is {content}"),
+    ]
+    malformed = [
+        (1, "HELLO there"),
+        (1, "JOIN bad/channel AS Alice"),
+        (1, "MSG FROM Alice"),
+        (1, "BYE FROM Alice extra"),
+    ]
+    def sample(lines):
+        population = [line for weight, line in lines for _ in range(weight)]
+        return [rng.choice(population) for _ in range(size)]
+    corpora = {
+        "mixed": sample(valid + variants + malformed),
+        "MSG only": sample(valid[2:3]),
+        "AUTH/JOIN/BYE": sample(valid[:2] + valid[3:]),
+        "malformed": sample(malformed),
+    }
+    return [line for _, line in valid], corpora
+
+
+def time_parser(parse, corpus, repeat):
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for line in corpus:
+            parse(line)
+        best = min(best, time.perf_counter() - start)
+    return best / len(corpus) * 1e9
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark TCP command parsing")
+    parser.add_argument("--lines", type=int, default=100000, help="Corpus size")
+    parser.add_argument("--content-length", type=int, default=80, help="MSG content length in characters")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    valid, corpora = build_corpora(args.lines, args.content_length, args.seed)
+    for line in valid:
+        assert legacy_parse(line) == single_pass_parse(line), line
+
+    print(f"{args.lines} lines per corpus, MSG content {args.content_length} chars")
+    for title, corpus in corpora.items():
+        print(f"{title} ({sum(parse_command(line)[1] is None for line in corpus)} rejected by the grammar)")
+        baseline = None
+        for name, parse in (("legacy regex chain", legacy_parse), ("single-pass dispatcher", single_pass_parse)):
+            ns = time_parser(parse, corpus, args.repeat)
+            baseline = baseline or ns
+            print(f"  {name:25} {ns:7.0f} ns/line   x{baseline / ns:.2f}")
+
+
+if __name__ == "__main__":
+    main()
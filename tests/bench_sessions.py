@@ -0,0 +1,150 @@
+import argparse
+import gc
+import time
+import tracemalloc
+
+from sessions import SessionSet, SessionState, SessionTable
+from tcp_server import ClientConnection
+from udp_dedup import MessageIdWindow
+from udp_server import SessionData
+
+# --- Benchmark: bytes per session, dict-based records vs. sessions.py ---
+# The legacy classes below are verbatim copies of udp_server.SessionData and
+# tcp_server.ClientConnection before sessions.py existed (limiter is None, as
+# when no rate limit is configured). Legacy sessions are kept in a plain dict
+# (UDP) and a set (TCP), as the servers did; current ones in a SessionTable (UDP)
+# and a SessionSet (TCP).
+# Every synthetic session is in the steady state of a chat client: authenticated,
+# in a channel, a few MessageIDs exchanged and nothing awaiting CONFIRM. Timer
+# handles and the sockets are left out (shared dummies), as they are the same
+# objects either way. Measured with tracemalloc, so the numbers include the
+# table's own growth and per-session floats, strings and dicts.
+
+limiter = None
+
+
+class LegacySessionData:
+    """Stores state for an active client session."""
+    def __init__(self, client_addr, dynamic_socket):
+        self.client_addr = client_addr
+        self.socket = dynamic_socket # The dynamic socket for this session
+        self.state = "NEEDS_AUTH" # Initial state before REPLY is sent
+        self.display_name = None
+        self.current_channel = "default"
+        self.server_message_id = 0 # Counter for messages sent BY SERVER
+        self.received_client_message_ids = MessageIdWindow() # IDs received FROM CLIENT, bounded and wrap-aware
+        self.last_activity_time = time.time()
+        self.last_ping_time = time.time()
+        self.pending_auth_reply = None # Store details needed for AUTH REPLY after CONFIRM
+        self.auth_reply_id = None # MessageID of the AUTH REPLY whose CONFIRM completes authentication
+        self.outstanding = {} # Key: server MessageID, Value: OutstandingMessage awaiting CONFIRM
+        self.ping_timer = None # TimerQueue handles, see schedule_keepalive()
+        self.expiry_timer = None
+        self.buckets = limiter.session_buckets(time.time()) if limiter is not None else None # Token buckets by type
+
+    def get_next_server_msg_id(self):
+        msg_id = self.server_message_id
+        self.server_message_id = (self.server_message_id + 1) % 65536 # Wrap around uint16
+        return msg_id
+
+    def add_received_client_id(self, msg_id):
+        self.received_client_message_ids.add(msg_id)
+
+    def has_received_client_id(self, msg_id):
+        return self.received_client_message_ids.contains(msg_id)
+
+    def update_activity(self):
+        self.last_activity_time = time.time()
+
+
+class LegacyClientConnection:
+    """Per-connection protocol state shared by the threaded and asyncio engines."""
+    def __init__(self, addr, send_raw):
+        self.addr = addr
+        self.send_raw = send_raw # Callable taking already encoded bytes
+        self.state = "NEEDS_AUTH" # Initial state
+        self.display_name = None
+        self.current_channel = "default" # Initial channel after auth
+        self.buckets = limiter.session_buckets(time.monotonic()) if limiter is not None else None
+
+
+def legacy_udp(addrs, names, sock):
+    table = {}
+    for addr, name in zip(addrs, names):
+        session = LegacySessionData(addr, sock)
+        session.add_received_client_id(0)
+        session.add_received_client_id(1)
+        session.auth_reply_id = session.get_next_server_msg_id()
+        session.get_next_server_msg_id()
+        session.pending_auth_reply = None
+        session.display_name = name
+        session.state = "AUTHENTICATED"
+        session.update_activity()
+        table[addr] = session
+    return table
+
+def current_udp(addrs, names, sock):
+    table = SessionTable()
+    for addr, name in zip(addrs, names):
+        session = SessionData(addr, sock)
+        session.add_received_client_id(0)
+        session.add_received_client_id(1)
+        session.auth_reply_id = session.get_next_server_msg_id()
+        session.get_next_server_msg_id()
+        session.display_name = name
+        session.state = SessionState.AUTHENTICATED
+        table.add(addr, session, time.time())
+        table.touch(session, time.time())
+    return table
+
+def legacy_tcp(addrs, names, send_raw):
+    table = set()
+    for addr, name in zip(addrs, names):
+        client = LegacyClientConnection(addr, send_raw)
+        client.display_name = name
+        client.state = "AUTHENTICATED"
+        table.add(client)
+    return table
+
+def current_tcp(addrs, names, send_raw):
+    table = SessionSet()
+    for addr, name in zip(addrs, names):
+        client = ClientConnection(addr, send_raw)
+        client.display_name = name
+        client.state = SessionState.AUTHENTICATED
+        table.add(client)
+    return table
+
+
+def measure(build, count):
+    """Returns bytes per session allocated while building count sessions."""
+    # Addresses and names exist on the real server before the session does
+    addrs = [("127.0.0.1", 1024 + i) for i in range(count)]
+    names = [f"user{i}" for i in range(count)]
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    table = build(addrs, names, None)
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    assert len(table) == count
+    return (after - before) / count
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure memory per session of the server session records")
+    parser.add_argument("--sessions", type=int, nargs="+", default=[10000, 100000])
+    args = parser.parse_args()
+
+    for title, legacy, current in (("UDP SessionData", legacy_udp, current_udp),
+                                   ("TCP ClientConnection", legacy_tcp, current_tcp)):
+        print(title)
+        for count in args.sessions:
+            before = measure(legacy, count)
+            after = measure(current, count)
+            print(f"  {count:7} sessions: legacy {before:6.0f} B/session   slots+table {after:6.0f} B/session"
+                  f"   x{before / after:.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,88 @@
+import argparse
+import json
+import os
+import signal
+import socket
+import subprocess
+import sys
+import time
+
+# --- Benchmark: throughput vs. number of pre-fork workers ---
+# Starts tcp_server.py or udp_server.py with --workers N for each N, drives it
+# with one or more load_generator.py processes (one generator process is
+# itself limited to one core) and prints delivered MSGs/s per worker count.
+# Logging is set to warn so stdout is not what is being measured. Scaling is
+# bounded by the number of cores: on a single-core machine every N performs
+# about the same and the bus hop shows up as overhead.
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+
+def wait_for_port(transport, port, timeout=5.0):
+    if transport == "udp":
+        time.sleep(1.0) # Nothing to connect to; give the workers time to bind
+        return
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=0.2).close()
+            return
+        except OSError:
+            time.sleep(0.05)
+    raise RuntimeError(f"Server did not start listening on port {port}")
+
+
+def run_generators(args):
+    generator_args = ["--transport", args.transport, "--port", str(args.port),
+                      "--clients", str(args.clients // args.generators), "--rate", str(args.rate),
+                      "--channels", str(args.channels), "--duration", str(args.duration), "--ramp", "1"]
+    processes = [subprocess.Popen([sys.executable, "load_generator.py", *generator_args, "--seed", str(index)],
+                                  cwd=HERE, stdout=subprocess.PIPE, text=True)
+                 for index in range(args.generators)]
+    reports = [json.loads(process.communicate()[0]) for process in processes]
+    sent = sum(report["throughput"]["msg_sent_per_s"] for report in reports)
+    received = sum(report["throughput"]["msg_received_per_s"] for report in reports)
+    errors = sum(sum(report["errors"].values()) for report in reports)
+    return sent, received, errors
+
+
+def run_case(args, workers):
+    server = "tcp_server.py" if args.transport == "tcp" else "udp_server.py"
+    command = [sys.executable, server, "--workers", str(workers), "--log-level", "warn"]
+    if args.transport == "tcp":
+        command += ["--mode", args.mode]
+    process = subprocess.Popen(command, cwd=HERE, stdout=subprocess.DEVNULL)
+    try:
+        wait_for_port(args.transport, args.port)
+        return run_generators(args)
+    finally:
+        process.send_signal(signal.SIGINT)
+        process.wait(timeout=10)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark server throughput across pre-fork worker counts")
+    parser.add_argument("--transport", choices=("tcp", "udp"), default="tcp")
+    parser.add_argument("--mode", choices=("threaded", "asyncio"), default="asyncio", help="TCP engine")
+    parser.add_argument("--workers", default="1,2,4", help="Comma-separated worker counts")
+    parser.add_argument("--port", type=int, default=4567)
+    parser.add_argument("--clients", type=int, default=200)
+    parser.add_argument("--rate", type=float, default=20.0, help="MSG per second per client")
+    parser.add_argument("--channels", type=int, default=20)
+    parser.add_argument("--duration", type=float, default=10.0)
+    parser.add_argument("--generators", type=int, default=max(os.cpu_count() // 2, 1),
+                        help="Load generator processes sharing --clients")
+    args = parser.parse_args()
+
+    print(f"{args.transport} ({args.mode if args.transport == 'tcp' else 'selector'}), {args.clients} clients "
+          f"x {args.rate} msg/s in {args.channels} channels, {args.generators} generator(s), {os.cpu_count()} CPU(s)")
+    baseline = None
+    for workers in [int(value) for value in args.workers.split(",")]:
+        sent, received, errors = run_case(args, workers)
+        baseline = baseline or received
+        print(f"  workers={workers:<3} sent {sent:9.1f} msg/s   delivered {received:10.1f} msg/s   "
+              f"x{received / baseline:.2f}   errors={errors}")
+
+
+if __name__ == "__main__":
+    main()
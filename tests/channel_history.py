@@ -0,0 +1,126 @@
+import collections
+import sys
+import threading
+
+# --- Channel History ---
+# Shared by tcp_server.py and udp_server.py. Each channel keeps a ring buffer of
+# its most recent chat MSGs, bounded both by message count and by bytes, and the
+# servers replay the last N of them to a session right after it joins, so a
+# client gets a burst of inbound MSGs straight after its REPLY. Entries cache
+# their wire frame per transport (the full TCP line, the UDP body without the
+# per-session header): the frame a broadcast already encoded is stored as is,
+# any other transport's frame is encoded on its first replay, and every later
+# replay hands out the same bytes objects without touching a string.
+# With --workers, broadcasts arriving over the worker bus are kept as frames only.
+# Only the most recently written MAX_CHANNELS channels are kept, so memory stays
+# bounded by MAX_CHANNELS x max_bytes (plus per-entry overhead, see memory_by_channel()).
+
+DEFAULT_MAX_MESSAGES = 100
+DEFAULT_MAX_BYTES = 64 * 1024 # Frame bytes per channel
+MAX_CHANNELS = 1024 # Least recently written channels beyond this lose their history
+
+
+class HistoryEntry:
+    __slots__ = ("display_name", "content", "frames", "size")
+
+    def __init__(self, display_name, content, frames, size):
+        self.display_name = display_name # None for frames relayed by another worker
+        self.content = content
+        self.frames = frames # Key: transport name, Value: encoded frame
+        self.size = size
+
+
+class ChannelHistory:
+    """Ring buffers of recent MSGs per channel, with replay frames cached per transport."""
+    def __init__(self, max_messages=DEFAULT_MAX_MESSAGES, max_bytes=DEFAULT_MAX_BYTES, max_channels=MAX_CHANNELS):
+        self.lock = threading.Lock() # Threaded TCP records from every client thread
+        self.max_messages = max_messages
+        self.max_bytes = max_bytes
+        self.max_channels = max_channels
+        self.channels = collections.OrderedDict() # Key: channel_id, Value: deque of HistoryEntry, oldest first
+        self.channel_bytes = {} # Key: channel_id, Value: sum of entry sizes
+        self.replayed = 0
+
+    def record(self, channel_id, display_name, content, transport, frame):
+        """Appends a MSG to the channel's history; frame is the transport's encoding of it.
+
+        display_name and content may be None when only the frame is known, and
+        frame None when no transport encoded it yet (then it counts as its text).
+        """
+        if frame is None:
+            entry = HistoryEntry(display_name, content, {}, len(display_name) + len(content))
+        else:
+            entry = HistoryEntry(display_name, content, {transport: frame}, len(frame))
+        with self.lock:
+            entries = self.channels.get(channel_id)
+            if entries is None:
+                entries = self.channels[channel_id] = collections.deque()
+                self.channel_bytes[channel_id] = 0
+                if len(self.channels) > self.max_channels:
+                    evicted, _ = self.channels.popitem(last=False)
+                    del self.channel_bytes[evicted]
+            else:
+                self.channels.move_to_end(channel_id)
+            entries.append(entry)
+            size = self.channel_bytes[channel_id] + entry.size
+            while len(entries) > self.max_messages or (size > self.max_bytes and len(entries) > 1):
+                size -= entries.popleft().size
+            self.channel_bytes[channel_id] = size
+
+    def replay(self, channel_id, count, transport, encode):
+        """Returns up to count of the channel's newest frames for transport, oldest first.
+
+        encode(display_name, content) builds a missing frame, which is then cached.
+        """
+        with self.lock:
+            entries = self.channels.get(channel_id)
+            if not entries or count <= 0:
+                return []
+            start = max(len(entries) - count, 0)
+            frames = []
+            for index in range(start, len(entries)):
+                entry = entries[index]
+                frame = entry.frames.get(transport)
+                if frame is None:
+                    if entry.content is None:
+                        continue # Relayed frame of another transport; nothing to encode from
+                    frame = entry.frames[transport] = encode(entry.display_name, entry.content)
+                frames.append(frame)
+            self.replayed += len(frames)
+            return frames
+
+    def memory_by_channel(self):
+        """Approximate bytes held per channel: entries, cached frames and the strings they came from."""
+        with self.lock:
+            usage = {}
+            for channel_id, entries in self.channels.items():
+                total = sys.getsizeof(entries)
+                for entry in entries:
+                    total += sys.getsizeof(entry) + sys.getsizeof(entry.frames)
+                    total += sum(sys.getsizeof(frame) for frame in entry.frames.values())
+                    if entry.content is not None:
+                        total += sys.getsizeof(entry.display_name) + sys.getsizeof(entry.content)
+                usage[channel_id] = total
+            return usage
+
+    def describe(self):
+        with self.lock:
+            return (f"channels={len(self.channels)} messages={sum(len(entries) for entries in self.channels.values())} "
+                    f"frame_bytes={sum(self.channel_bytes.values())} replayed={self.replayed}")
+
+
+def add_history_arguments(parser):
+    """Adds the channel history options shared by the test servers to an argparse parser."""
+    group = parser.add_argument_group("channel history")
+    group.add_argument("--history", type=int, default=0, metavar="N",
+                       help="Replay the last N messages of a channel to a session joining it (0 disables)")
+    group.add_argument("--history-max-messages", type=int, default=DEFAULT_MAX_MESSAGES,
+                       help="Messages kept per channel (at least N)")
+    group.add_argument("--history-max-bytes", type=int, default=DEFAULT_MAX_BYTES,
+                       help="Encoded bytes kept per channel; the oldest messages go first")
+
+def history_from_args(args):
+    """Returns (ChannelHistory, replay count), or (None, 0) when history is disabled."""
+    if args.history <= 0:
+        return None, 0
+    return ChannelHistory(max(args.history_max_messages, args.history), args.history_max_bytes), args.history
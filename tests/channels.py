@@ -0,0 +1,68 @@
+import threading
+
+# --- Channel Registry ---
+# Shared by tcp_server.py and udp_server.py. Members are opaque objects
+# (TCP ClientConnection, UDP SessionData); the servers own the encoding and
+# the actual sending, the registry only answers "who is in this channel".
+# Members are kept in join order (dict keys rather than a set), so fan-out
+# order does not depend on object addresses and simulated runs repeat exactly.
+
+
+class ChannelRegistry:
+    """Tracks channel membership so messages can be fanned out to every member."""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.channels = {} # Key: channel_id, Value: dict of members (values unused), in join order
+        self.member_channel = {} # Key: member, Value: channel_id it is currently in
+        # Optional callbacks(channel_id), called under the lock when a channel gets its
+        # first member or loses its last one; the pre-fork bus uses them as subscriptions
+        self.on_channel_opened = None
+        self.on_channel_closed = None
+
+    def join(self, member, channel_id):
+        """Moves member into channel_id. Returns the channel it left, or None."""
+        with self.lock:
+            previous = self._remove(member)
+            members = self.channels.get(channel_id)
+            if members is None:
+                members = self.channels[channel_id] = {}
+                if self.on_channel_opened is not None:
+                    self.on_channel_opened(channel_id)
+            members[member] = None
+            self.member_channel[member] = channel_id
+            return previous
+
+    def leave(self, member):
+        """Removes member from its channel. Returns the channel it left, or None."""
+        with self.lock:
+            return self._remove(member)
+
+    def channel_of(self, member):
+        with self.lock:
+            return self.member_channel.get(member)
+
+    def members(self, channel_id, exclude=None):
+        """Returns a snapshot list of channel members, safe to iterate without the lock."""
+        with self.lock:
+            members = self.channels.get(channel_id)
+            if not members:
+                return []
+            if exclude is None:
+                return list(members)
+            return [member for member in members if member is not exclude]
+
+    def channel_sizes(self):
+        with self.lock:
+            return {channel_id: len(members) for channel_id, members in self.channels.items()}
+
+    def _remove(self, member):
+        channel_id = self.member_channel.pop(member, None)
+        if channel_id is not None:
+            members = self.channels.get(channel_id)
+            if members is not None:
+                members.pop(member, None)
+                if not members:
+                    del self.channels[channel_id] # Drop empty channels so the registry doesn't grow
+                    if self.on_channel_closed is not None:
+                        self.on_channel_closed(channel_id)
+        return channel_id
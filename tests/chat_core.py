@@ -0,0 +1,98 @@
+from channels import ChannelRegistry
+from server_log import log
+
+# --- Chat Core ---
+# The part of the protocol both servers share once a session is authenticated:
+# channel membership, the join/leave notices, MSG fan-out and the replay
+# history. Wire formats stay with the transports. A member of a channel may be
+# any Session subclass (tcp_server.ClientConnection, udp_server.SessionData)
+# providing:
+#   transport            class attribute naming its wire format ("tcp", "udp"),
+#                        also the key of its frames in the channel history
+#   encode_msg(dn, text) static method returning the MSG frame for that format
+#                        (the whole TCP line; the UDP body without its header)
+#   deliver(frame, msg_trace=None)
+#                        sends such a frame to the session (UDP adds the
+#                        per-session header and retransmits until CONFIRMed);
+#                        a MSG sampled for latency tracking carries its
+#                        MessageTrace, see latency_tracker.py
+# A broadcast encodes the MSG at most once per wire format present among the
+# members, so one core can serve TCP and UDP members of the same channel, see
+# chat_server.py. Each server creates its own core; chat_server.py hands one
+# core to both, and federation.py links the cores of several such servers.
+
+
+class ChatCore:
+    """Channels, broadcasts and history for the sessions of one server process, whatever their transport."""
+    def __init__(self, channels=None):
+        self.channels = channels if channels is not None else ChannelRegistry()
+        self.history = None # ChannelHistory when --history is on
+        self.history_replay = 0 # Messages replayed to a session joining a channel
+        # Optional callback(channel_id, display_name, content, frames) after each
+        # broadcast; the pre-fork bus and federation.py use it to reach members
+        # of other workers or nodes
+        self.on_broadcast = None
+
+    def broadcast(self, channel_id, display_name, content, exclude=None, msg_trace=None):
+        """Sends a MSG to every member of a channel, encoding it once per wire format.
+
+        Returns the frames by transport ({} if nobody was there), or None when
+        nobody was there and there is no bus to publish to either.
+        """
+        members = self.channels.members(channel_id, exclude)
+        if not members and self.on_broadcast is None:
+            return None
+        frames = self.fan_out(channel_id, members, display_name, content, msg_trace)
+        if self.on_broadcast is not None:
+            self.on_broadcast(channel_id, display_name, content, frames)
+        return frames
+
+    def fan_out(self, channel_id, members, display_name, content, msg_trace=None):
+        """Delivers a MSG to the given members only. Returns the frames by transport."""
+        log.packet("SND to %d member(s) of '%s': MSG FROM %s IS %s", len(members), channel_id, display_name, content)
+        frames = {}
+        for member in members:
+            frame = frames.get(member.transport)
+            if frame is None:
+                frame = frames[member.transport] = member.encode_msg(display_name, content)
+            member.deliver(frame, msg_trace)
+        return frames
+
+    def deliver_relayed(self, channel_id, display_name, content):
+        """Fans out a MSG another server published (e.g. a federated node) and records it; never published again."""
+        frames = self.fan_out(channel_id, self.channels.members(channel_id), display_name, content)
+        if self.history is not None:
+            transport, frame = next(iter(frames.items()), (None, None)) # Without members: encoded on replay
+            self.history.record(channel_id, display_name, content, transport, frame)
+
+    def relay(self, session, display_name, content, msg_trace=None):
+        """Relays a chat MSG from session to the rest of its channel and records it in the history."""
+        channel_id = session.current_channel
+        frames = self.broadcast(channel_id, display_name, content, exclude=session, msg_trace=msg_trace)
+        if self.history is not None:
+            transport = session.transport
+            frame = frames.get(transport) if frames else None
+            if frame is None and frames:
+                transport, frame = next(iter(frames.items())) # Any format will do, the others are encoded on replay
+            self.history.record(channel_id, display_name, content, transport,
+                                frame or session.encode_msg(display_name, content))
+
+    def join(self, session, channel_id):
+        """Moves the session into a channel and announces the membership change."""
+        previous = self.channels.join(session, channel_id)
+        session.current_channel = channel_id
+        if previous is not None and previous != channel_id:
+            self.broadcast(previous, "Server", f"{session.display_name} left {previous}.")
+        if self.history is not None:
+            # Runs after the session became a member, so with the threaded TCP engine
+            # a MSG sent concurrently may arrive both live and in the replay
+            for frame in self.history.replay(channel_id, self.history_replay, session.transport, session.encode_msg):
+                session.deliver(frame)
+        # The joining session receives its own notice too
+        self.broadcast(channel_id, "Server", f"{session.display_name} joined {channel_id}.")
+
+    def leave(self, session):
+        """Removes the session from its channel and tells the remaining members."""
+        previous = self.channels.leave(session)
+        if previous is not None:
+            self.broadcast(previous, "Server", f"{session.display_name} left {previous}.")
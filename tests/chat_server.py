@@ -0,0 +1,151 @@
+import argparse
+import asyncio
+import sys
+
+import tcp_server
+import udp_server
+from auth_backend import add_auth_arguments, authenticator_from_args
+from channel_history import add_history_arguments, history_from_args
+from chat_core import ChatCore
+from federation import add_federation_arguments, federation_from_args
+from latency_tracker import add_latency_arguments, latency_from_args
+from rate_limit import add_rate_limit_arguments, limiter_from_args
+from server_log import add_log_arguments, configure_from_args, log
+from server_metrics import ServerMetrics, add_metrics_arguments, start_from_args as start_metrics
+from tcp_output import SLOW_CONSUMER_POLICIES, OutputLimits
+from timer_queue import TimerDriver
+
+# --- Dual-Transport Server ---
+# Serves TCP and UDP clients from one process and one asyncio event loop, so
+# both kinds of client can share a channel. The TCP side is tcp_server.py's
+# asyncio engine as is; the UDP side is udp_server.py with its selector
+# replaced by loop readers (LoopSelector) and its TimerQueue driven by a
+# TimerDriver on the loop's monotonic clock. Both modules get the same
+# ChatCore, and with it one channel registry and one history: a MSG from a TCP
+# client is encoded once as a text line for the TCP members and once as a UDP
+# body for the UDP members, whatever their number (see chat_core.py), and a
+# UDP client joining a channel replays what TCP clients said there. The two
+# listeners share PORT, one per protocol. Both modules also report into one
+# ServerMetrics, one RateLimiter and one Authenticator, so per-IP limits and
+# the verified-credential cache cover both transports.
+# With --cluster, several of these processes form a federation whose channels
+# span nodes, see federation.py; give each node its own --port and --node-id.
+# Not supported here: --workers, --handoff, --trace and the UDP impairment
+# options; run the single-transport servers for those.
+
+
+class LoopSelector:
+    """Stands in for udp_server's selectors.DefaultSelector on a running asyncio loop.
+
+    Instead of being polled, it calls on_readable(sock, data) from the loop
+    whenever a registered socket is readable.
+    """
+    def __init__(self, loop, on_readable):
+        self.loop = loop
+        self.on_readable = on_readable
+
+    def register(self, sock, events, data=None):
+        self.loop.add_reader(sock, self.on_readable, sock, data)
+
+    def unregister(self, sock):
+        self.loop.remove_reader(sock)
+
+    def close(self):
+        pass
+
+
+metrics = ServerMetrics()
+core = ChatCore()
+federation = None # Federation when --cluster is given
+
+
+def sessions_by_state():
+    """Gauge callback: the sessions of both transports, by protocol state."""
+    counts = udp_server.sessions_by_state()
+    for state, count in tcp_server.stats.sessions_by_state().items():
+        counts[state] = counts.get(state, 0) + count
+    return counts
+
+metrics.bind_sessions(sessions_by_state)
+
+
+def share_state(limiter, authenticator, latency):
+    """Points both server modules at this process's core, metrics, rate limiter, authenticator and latency tracker."""
+    for server in (tcp_server, udp_server):
+        server.core = core
+        server.metrics = metrics
+        server.limiter = limiter
+        server.authenticator = authenticator
+        server.latency = latency
+
+
+async def serve():
+    """Opens the UDP sockets on the running loop, then runs the TCP engine until cancelled."""
+    loop = asyncio.get_running_loop()
+    udp_server.clock = loop.time # Same clock as TCP's time.monotonic(), so shared per-IP buckets agree
+    driver = TimerDriver(loop, udp_server.timers, loop.time)
+    udp_server.timers.on_schedule = driver.wake # TCP traffic schedules UDP retransmissions too
+    udp_server.selector = LoopSelector(loop, udp_server.handle_readable)
+    udp_server.open_server_sockets()
+    if federation is not None:
+        await federation.start()
+    try:
+        await tcp_server.serve_async()
+    finally:
+        driver.stop()
+
+
+def parse_args():
+    """Parses command line options."""
+    parser = argparse.ArgumentParser(description="IPK25-CHAT test server for TCP and UDP clients on one event loop")
+    parser.add_argument("--port", type=int, default=tcp_server.PORT, help="TCP and UDP port clients connect to")
+    parser.add_argument("--max-line-length", type=int, default=tcp_server.MAX_LINE_LENGTH,
+                        help="Longest accepted TCP message line in bytes; longer lines get ERR and disconnect")
+    parser.add_argument("--slow-consumer", choices=SLOW_CONSUMER_POLICIES, default=tcp_server.OUTPUT_LIMITS.policy,
+                        help="What to do with a TCP client whose output queue passes the high watermark")
+    parser.add_argument("--reply-pool", type=int, default=udp_server.REPLY_SOCKET_POOL_SIZE,
+                        help="Serve all UDP sessions from N shared reply sockets instead of one per session")
+    parser.add_argument("--confirm-timeout", type=float, default=udp_server.CONFIRM_TIMEOUT,
+                        help="Seconds to wait for a UDP CONFIRM before retransmitting")
+    parser.add_argument("--max-retries", type=int, default=udp_server.MAX_RETRIES,
+                        help="UDP retransmissions before a silent session is terminated")
+    add_history_arguments(parser)
+    add_rate_limit_arguments(parser)
+    add_auth_arguments(parser)
+    add_latency_arguments(parser)
+    add_federation_arguments(parser)
+    add_log_arguments(parser)
+    add_metrics_arguments(parser)
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    tcp_server.PORT = udp_server.PORT = args.port
+    tcp_server.MAX_LINE_LENGTH = args.max_line_length
+    tcp_server.OUTPUT_LIMITS = OutputLimits(policy=args.slow_consumer)
+    udp_server.REPLY_SOCKET_POOL_SIZE = args.reply_pool
+    udp_server.CONFIRM_TIMEOUT = args.confirm_timeout
+    udp_server.MAX_RETRIES = args.max_retries
+    configure_from_args(args)
+    core.history, core.history_replay = history_from_args(args)
+    if core.history is not None:
+        metrics.bind_history(core.history.memory_by_channel)
+    latency = latency_from_args(args)
+    if latency is not None:
+        metrics.bind_latency(latency) # One tracker: a channel's sketches cover members of both transports
+    share_state(limiter_from_args(args, metrics.throttled.inc), authenticator_from_args(args), latency)
+    federation = federation_from_args(args, core)
+    if federation is not None:
+        core.on_broadcast = federation.publish
+        core.channels.on_channel_opened = federation.subscribe
+        core.channels.on_channel_closed = federation.unsubscribe
+    udp_server.raise_fd_limit()
+    start_metrics(metrics, args)
+    try:
+        asyncio.run(serve())
+    except KeyboardInterrupt:
+        log.info("Shutting down server...")
+    except OSError as e:
+        log.error(f"Error binding or listening: {e}")
+        sys.exit(1)
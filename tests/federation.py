@@ -0,0 +1,369 @@
+import asyncio
+import collections
+import itertools
+import os
+import struct
+
+from server_log import log
+
+# --- Federated Nodes ---
+# Links several chat_server.py processes on one machine into a cluster whose
+# channels span nodes: a MSG posted on node A reaches the members connected to
+# node B. Unlike the pre-fork bus (worker_bus.py), nodes are independent
+# processes that start, stop and restart on their own. --cluster lists every
+# node's link port in node id order; each node listens on its own port, and
+# dials every node with a lower id, redialing with backoff whenever such a link
+# drops, so each pair is linked by one localhost TCP connection.
+#
+# As on the bus, a node tells its peers which channels it has members in
+# (SUBSCRIBE/UNSUBSCRIBE), and publishes a broadcast only to the peers
+# subscribed to its channel. Remote broadcasts travel as display name and
+# content rather than as wire frames, because a node serves TCP and UDP members
+# alike, and are fanned out and recorded locally but never forwarded.
+#
+# Both directions of a link carry a HELLO and then batches: a BATCH header and
+# the records queued for the peer since the last write, so a burst of
+# broadcasts costs one write per link per loop iteration. Each PUBLISH carries
+# the sequence number of its origin node, and the receiver acknowledges the
+# highest one it delivered with an ACK in its next batch. Until then the
+# PUBLISH stays in the link's send queue: after a reconnect everything
+# unacknowledged is written again, and the receiver drops the sequence numbers
+# it already delivered, so a message crosses a flapping link exactly once.
+# Subscriptions are not resent that way: each (re)connect starts with the full
+# SUBSCRIBE list of the node's open channels, replacing what the peer knew. The
+# HELLO carries a random incarnation id; when a peer comes back as a new process,
+# its unacknowledged messages and sequence numbers are forgotten as well.
+# A peer that stops reading gets nothing written (asyncio's pause_writing())
+# while its queue grows to MAX_UNACKED, beyond which the oldest are dropped.
+
+LINK_MAGIC = b"IPK25FED"
+LINK_VERSION = 1
+LINK_HOST = "127.0.0.1"
+LINK_ENCODING = "us-ascii"
+HELLO = struct.Struct("<8sBHQ") # Magic, version, node id, incarnation
+BATCH = struct.Struct("<IH") # Length of the records that follow, record count
+CHANNEL_RECORD = struct.Struct("<BH") # Kind, channel id length; then the channel id
+PUBLISH_RECORD = struct.Struct("<BIHHH") # Kind, sequence, channel id/display name/content lengths; then the three
+ACK_RECORD = struct.Struct("<BI") # Kind, highest sequence delivered from the receiving node
+
+REC_SUBSCRIBE = 1
+REC_UNSUBSCRIBE = 2
+REC_PUBLISH = 3
+REC_ACK = 4
+
+MAX_BATCH_BYTES = 1 << 16 # A write is cut into batches of about this many record bytes
+MAX_UNACKED = 10000 # Publishes queued per link; the oldest are dropped beyond this
+RECONNECT_MIN = 0.05 # Seconds before redialing a lost peer, doubled per failed attempt...
+RECONNECT_MAX = 2.0 # ...up to this
+
+
+class PeerLink:
+    """What a node knows about one peer: its connection while up, its interest and its send queue."""
+    def __init__(self, node_id, port):
+        self.node_id = node_id
+        self.port = port
+        self.protocol = None # LinkProtocol once the peer's HELLO arrived, None while the link is down
+        self.incarnation = None # From the peer's last HELLO
+        self.interest = set() # Channels the peer has members in
+        self.control = [] # SUBSCRIBE/UNSUBSCRIBE records not yet written
+        self.unacked = collections.deque() # (sequence, PUBLISH record) the peer has not acknowledged, in order
+        self.written = 0 # Highest sequence written on the current connection
+        self.delivered = 0 # Highest sequence delivered from the peer's current incarnation
+        self.ack_due = False
+        self.flush_scheduled = False
+        self.dialer = None # Task redialing the peer (lower node ids only)
+
+
+class LinkProtocol(asyncio.Protocol):
+    """One link connection, accepted or dialed; peer is the PeerLink dialed, if any."""
+    def __init__(self, federation, peer=None):
+        self.federation = federation
+        self.peer = peer
+        self.link = None # PeerLink, once the HELLO identified the peer
+        self.transport = None
+        self.buffer = bytearray()
+        self.paused = False
+
+    def connection_made(self, transport):
+        self.transport = transport
+        federation = self.federation
+        transport.write(HELLO.pack(LINK_MAGIC, LINK_VERSION, federation.node_id, federation.incarnation))
+
+    def data_received(self, data):
+        buffer = self.buffer
+        buffer += data
+        try:
+            if self.link is None:
+                if len(buffer) < HELLO.size:
+                    return
+                magic, version, node_id, incarnation = HELLO.unpack_from(buffer)
+                if magic != LINK_MAGIC or version != LINK_VERSION:
+                    raise ValueError(f"not a version {LINK_VERSION} federation link")
+                del buffer[:HELLO.size]
+                self.link = self.federation.link_up(self, node_id, incarnation)
+                if self.link is None:
+                    self.transport.close()
+                    return
+            start = 0
+            while len(buffer) - start >= BATCH.size:
+                length, count = BATCH.unpack_from(buffer, start)
+                end = start + BATCH.size + length
+                if len(buffer) < end:
+                    break
+                self.federation.receive_batch(self.link, bytes(buffer[start + BATCH.size:end]))
+                start = end
+            del buffer[:start]
+        except (ValueError, struct.error, UnicodeDecodeError) as e:
+            log.error(f"Federation: dropping link to {self.transport.get_extra_info('peername')}: {e}")
+            self.transport.close()
+
+    def connection_lost(self, exc):
+        self.federation.link_down(self)
+
+    def pause_writing(self):
+        self.paused = True
+
+    def resume_writing(self):
+        self.paused = False
+        if self.link is not None:
+            self.federation.schedule_flush(self.link)
+
+
+class Federation:
+    """This node's links to the other nodes of the cluster, hooked into its ChatCore."""
+    def __init__(self, node_id, ports, core):
+        self.node_id = node_id
+        self.ports = ports
+        self.core = core
+        self.incarnation = int.from_bytes(os.urandom(8), "little")
+        self.sequence = 0 # Of this node's publishes, per incarnation
+        self.peers = {peer_id: PeerLink(peer_id, port) for peer_id, port in enumerate(ports) if peer_id != node_id}
+        self.loop = None
+        self.server = None
+        self.published = 0
+        self.delivered = 0
+        self.duplicates = 0
+        self.resent = 0
+        self.dropped = 0
+
+    async def start(self):
+        """Listens for the nodes with higher ids and dials those with lower ones."""
+        self.loop = asyncio.get_running_loop()
+        port = self.ports[self.node_id]
+        self.server = await self.loop.create_server(lambda: LinkProtocol(self), LINK_HOST, port, reuse_address=True)
+        log.info(f"Federation: node {self.node_id} of {len(self.ports)} linking on {LINK_HOST}:{port}")
+        for peer in self.peers.values():
+            if peer.node_id < self.node_id:
+                self.dial(peer)
+
+    def dial(self, peer):
+        if peer.dialer is None or peer.dialer.done():
+            peer.dialer = asyncio.ensure_future(self._dial(peer))
+
+    async def _dial(self, peer):
+        delay = RECONNECT_MIN
+        while True:
+            try:
+                await self.loop.create_connection(lambda: LinkProtocol(self, peer), LINK_HOST, peer.port)
+                return # The HELLO exchange completes the link; if the connection drops, link_down() dials again
+            except OSError:
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, RECONNECT_MAX)
+
+    # --- ChatCore and ChannelRegistry hooks ---
+
+    def subscribe(self, channel_id):
+        """on_channel_opened: tells every connected peer this node has members in channel_id."""
+        self._send_control(REC_SUBSCRIBE, channel_id)
+
+    def unsubscribe(self, channel_id):
+        """on_channel_closed: the last member here left channel_id."""
+        self._send_control(REC_UNSUBSCRIBE, channel_id)
+
+    def publish(self, channel_id, display_name, content, frames):
+        """on_broadcast: queues a local broadcast for every peer with members in its channel."""
+        targets = [peer for peer in self.peers.values() if channel_id in peer.interest]
+        if not targets:
+            return
+        self.sequence += 1
+        self.published += 1
+        record = encode_publish(self.sequence, channel_id, display_name, content)
+        for peer in targets:
+            unacked = peer.unacked
+            if len(unacked) >= MAX_UNACKED:
+                unacked.popleft()
+                self.dropped += 1
+            unacked.append((self.sequence, record))
+            self.schedule_flush(peer)
+
+    # --- Links ---
+
+    def link_up(self, protocol, node_id, incarnation):
+        """A HELLO arrived. Returns the PeerLink the connection now serves, or None to refuse it."""
+        peer = self.peers.get(node_id)
+        if peer is None or (protocol.peer is not None and protocol.peer is not peer):
+            log.warn(f"Federation: refusing a link from unexpected node {node_id}")
+            return None
+        if peer.protocol is not None:
+            peer.protocol.transport.close() # Stale connection of a peer that reconnected first
+        # Every HELLO is followed by the peer's full SUBSCRIBE list, while UNSUBSCRIBEs it
+        # had for us during an outage were discarded, so the old interest may be stale
+        peer.interest.clear()
+        if peer.incarnation != incarnation:
+            if peer.incarnation is not None:
+                log.info(f"Federation: node {node_id} restarted")
+            # A new process: its sequence starts over, and what its predecessor missed concerns nobody there
+            self.dropped += len(peer.unacked)
+            peer.unacked.clear()
+            peer.delivered = 0
+            peer.incarnation = incarnation
+        peer.protocol = protocol
+        self.resent += len(peer.unacked)
+        peer.written = 0 # Whatever the peer has not acknowledged goes out again
+        peer.control = [encode_channel(REC_SUBSCRIBE, channel_id) for channel_id in self.core.channels.channel_sizes()]
+        peer.ack_due = peer.delivered > 0
+        self.schedule_flush(peer)
+        log.info(f"Federation: linked to node {node_id} ({self.describe()})")
+        return peer
+
+    def link_down(self, protocol):
+        peer = protocol.link or protocol.peer
+        if peer is None:
+            return
+        if peer.protocol is protocol:
+            peer.protocol = None
+            peer.control = []
+            peer.ack_due = False
+            log.warn(f"Federation: lost the link to node {peer.node_id}, {len(peer.unacked)} message(s) unacknowledged")
+        elif peer.protocol is not None:
+            return # Replaced by a newer connection
+        if peer.node_id < self.node_id and self.loop is not None and not self.loop.is_closed():
+            self.dial(peer)
+
+    def receive_batch(self, peer, data):
+        """Handles the records of one batch from peer."""
+        offset = 0
+        end = len(data)
+        while offset < end:
+            kind = data[offset]
+            if kind == REC_PUBLISH:
+                _, sequence, channel_length, name_length, content_length = PUBLISH_RECORD.unpack_from(data, offset)
+                offset += PUBLISH_RECORD.size
+                channel_id = data[offset:offset + channel_length].decode(LINK_ENCODING)
+                offset += channel_length
+                display_name = data[offset:offset + name_length].decode(LINK_ENCODING)
+                offset += name_length
+                content = data[offset:offset + content_length].decode(LINK_ENCODING)
+                offset += content_length
+                if sequence <= peer.delivered:
+                    self.duplicates += 1 # Resent after a reconnect, but it had arrived
+                    continue
+                peer.delivered = sequence
+                peer.ack_due = True
+                self.delivered += 1
+                try:
+                    self.core.deliver_relayed(channel_id, display_name, content)
+                except Exception as e:
+                    log.error(f"Federation: error delivering a MSG from node {peer.node_id}: {e}")
+            elif kind == REC_SUBSCRIBE or kind == REC_UNSUBSCRIBE:
+                _, channel_length = CHANNEL_RECORD.unpack_from(data, offset)
+                offset += CHANNEL_RECORD.size
+                channel_id = data[offset:offset + channel_length].decode(LINK_ENCODING)
+                offset += channel_length
+                if kind == REC_SUBSCRIBE:
+                    peer.interest.add(channel_id)
+                else:
+                    peer.interest.discard(channel_id)
+            elif kind == REC_ACK:
+                _, sequence = ACK_RECORD.unpack_from(data, offset)
+                offset += ACK_RECORD.size
+                unacked = peer.unacked
+                while unacked and unacked[0][0] <= sequence:
+                    unacked.popleft()
+            else:
+                raise ValueError(f"unknown record kind {kind}")
+        if peer.ack_due:
+            self.schedule_flush(peer)
+
+    def schedule_flush(self, peer):
+        if not peer.flush_scheduled and peer.protocol is not None:
+            peer.flush_scheduled = True
+            self.loop.call_soon(self.flush, peer)
+
+    def flush(self, peer):
+        """Writes everything queued for peer as batches of records."""
+        peer.flush_scheduled = False
+        protocol = peer.protocol
+        if protocol is None or protocol.paused:
+            return # Written on reconnect or on resume_writing()
+        records = peer.control
+        peer.control = []
+        if peer.ack_due:
+            records.append(ACK_RECORD.pack(REC_ACK, peer.delivered))
+            peer.ack_due = False
+        unacked = peer.unacked
+        if unacked and unacked[-1][0] > peer.written:
+            start = len(unacked)
+            while start and unacked[start - 1][0] > peer.written:
+                start -= 1 # Usually only the last few are new
+            records.extend(record for _, record in itertools.islice(unacked, start, None))
+            peer.written = unacked[-1][0]
+        if not records:
+            return
+        chunks = []
+        batch = []
+        size = 0
+        for record in records:
+            batch.append(record)
+            size += len(record)
+            if size >= MAX_BATCH_BYTES:
+                chunks.append(BATCH.pack(size, len(batch)))
+                chunks.extend(batch)
+                batch = []
+                size = 0
+        if batch:
+            chunks.append(BATCH.pack(size, len(batch)))
+            chunks.extend(batch)
+        protocol.transport.write(b"".join(chunks))
+
+    def _send_control(self, kind, channel_id):
+        record = encode_channel(kind, channel_id)
+        for peer in self.peers.values():
+            if peer.protocol is not None:
+                peer.control.append(record)
+                self.schedule_flush(peer)
+
+    def describe(self):
+        linked = sum(peer.protocol is not None for peer in self.peers.values())
+        return (f"node={self.node_id} links={linked}/{len(self.peers)} published={self.published} "
+                f"delivered={self.delivered} duplicates={self.duplicates} resent={self.resent} dropped={self.dropped}")
+
+
+def encode_channel(kind, channel_id):
+    channel = channel_id.encode(LINK_ENCODING)
+    return CHANNEL_RECORD.pack(kind, len(channel)) + channel
+
+
+def encode_publish(sequence, channel_id, display_name, content):
+    channel = channel_id.encode(LINK_ENCODING)
+    name = display_name.encode(LINK_ENCODING)
+    text = content.encode(LINK_ENCODING)
+    return PUBLISH_RECORD.pack(REC_PUBLISH, sequence, len(channel), len(name), len(text)) + channel + name + text
+
+
+def add_federation_arguments(parser):
+    """Adds the cluster options of chat_server.py to an argparse parser."""
+    group = parser.add_argument_group("federation")
+    group.add_argument("--cluster", metavar="PORT,PORT,...", default=None,
+                       help="Link ports of every node of a local cluster, in node id order; "
+                            "this node listens on its own and links to all the others")
+    group.add_argument("--node-id", type=int, default=0, help="This node's position in --cluster")
+
+def federation_from_args(args, core):
+    """Returns a Federation for core, or None when --cluster is not given. Call start() on the loop."""
+    if not args.cluster:
+        return None
+    ports = [int(port) for port in args.cluster.split(",")]
+    if not 0 <= args.node_id < len(ports):
+        raise SystemExit(f"--node-id must be between 0 and {len(ports) - 1}")
+    return Federation(args.node_id, ports, core)
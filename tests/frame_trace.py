@@ -0,0 +1,198 @@
+import atexit
+import collections
+import os
+import struct
+import threading
+import time
+
+from server_log import log
+
+# --- Frame Trace ---
+# Records every frame a server receives from or sends to a client into an
+# append-only binary file, for replay with trace_replay.py. The file starts with
+# a FILE_HEADER; each record is a RECORD header (payload length first, so a
+# reader can skip or stop at a record cut short by a crash) followed by the
+# payload. Frames are what crosses the socket: TCP recv() chunks inbound and
+# encoded lines outbound, UDP datagrams both ways (outbound as handed to the
+# impairment layer, if any). Sessions are numbered in the order they are first
+# seen; a KIND_OPEN record maps the number to the transport and client address.
+# As in server_log.py, the hot path appends one tuple to a deque and a
+# background thread packs and writes the records in batches.
+
+TRACE_MAGIC = b"IPK25TRC"
+TRACE_VERSION = 1
+FILE_HEADER = struct.Struct("<8sB") # Magic, version
+RECORD = struct.Struct("<IdIBB") # Payload length, timestamp (s), session id, kind, flags
+
+KIND_OPEN = 1 # Payload: "<transport> <ip> <port>"
+KIND_IN = 2 # Frame from the client
+KIND_OUT = 3 # Frame to the client
+KIND_CLOSE = 4 # Empty payload
+KIND_GAP = 5 # Records were dropped before this one; payload: count as ASCII digits
+KIND_NAMES = {KIND_OPEN: "OPEN", KIND_IN: "IN", KIND_OUT: "OUT", KIND_CLOSE: "CLOSE", KIND_GAP: "GAP"}
+FLAG_MAIN_SOCKET = 1 # UDP: received on / sent from the server's well-known port
+
+FLUSH_INTERVAL = 0.05 # Seconds the writer waits between batches
+MAX_PENDING = 1 << 20 # Records kept while the writer is behind; newer ones are dropped beyond this
+
+
+class TraceRecorder:
+    """Appends session frames to a trace file from any thread."""
+    def __init__(self, path, transport, clock=time.time):
+        self.path = path
+        self.transport = transport
+        self.clock = clock
+        self.file = open(path, "ab")
+        if self.file.tell() == 0:
+            self.file.write(FILE_HEADER.pack(TRACE_MAGIC, TRACE_VERSION))
+        self.pending = collections.deque()
+        self.sessions = {} # Key: client address, Value: session id
+        self.next_session = 1
+        self.session_lock = threading.Lock() # Threaded TCP opens sessions from every client thread
+        self.write_lock = threading.Lock()
+        self.dropped = 0
+        self.records = 0
+        self.bytes = 0
+        threading.Thread(target=self._run_writer, name="trace-writer", daemon=True).start()
+        atexit.register(self.flush)
+
+    def inbound(self, addr, data, flags=0):
+        self._append(addr, KIND_IN, flags, data)
+
+    def outbound(self, addr, data, flags=0):
+        self._append(addr, KIND_OUT, flags, data)
+
+    def tap(self, addr, write):
+        """Wraps write(data) so that everything written to addr is recorded first."""
+        sessions = self.sessions
+        outbound = self.outbound
+        def traced_write(data):
+            if addr in sessions: # Not after close_session(): those writes go to a closed connection
+                outbound(addr, data)
+            return write(data)
+        return traced_write
+
+    def open_session(self, addr):
+        """Starts a session explicitly (e.g. on TCP accept); frames from unknown addresses start one too."""
+        self._session_id(addr)
+
+    def export_sessions(self):
+        """The open sessions and the next session id, for a server handing its sessions over."""
+        with self.session_lock:
+            return {"path": os.path.abspath(self.path), "next_session": self.next_session,
+                    "sessions": [[addr[0], addr[1], session_id] for addr, session_id in self.sessions.items()]}
+
+    def adopt_sessions(self, state):
+        """Continues a predecessor's session numbering when both append to the same file (see session_handoff.py)."""
+        if state is None or state["path"] != os.path.abspath(self.path):
+            return # Another file: the sessions start over with OPEN records there
+        with self.session_lock:
+            for ip, port, session_id in state["sessions"]:
+                self.sessions[(ip, port)] = session_id
+            self.next_session = max(self.next_session, state["next_session"])
+
+    def close_session(self, addr):
+        session_id = self.sessions.pop(addr, None)
+        if session_id is not None:
+            self.pending.append((self.clock(), session_id, KIND_CLOSE, 0, b""))
+
+    def _append(self, addr, kind, flags, data):
+        session_id = self.sessions.get(addr) or self._session_id(addr)
+        pending = self.pending
+        if len(pending) >= MAX_PENDING:
+            self.dropped += 1 # Approximate under contention; written as a KIND_GAP record
+            return
+        pending.append((self.clock(), session_id, kind, flags, data))
+
+    def _session_id(self, addr):
+        with self.session_lock:
+            session_id = self.sessions.get(addr)
+            if session_id is None:
+                session_id = self.sessions[addr] = self.next_session
+                self.next_session += 1
+                payload = f"{self.transport} {addr[0]} {addr[1]}".encode("ascii")
+                self.pending.append((self.clock(), session_id, KIND_OPEN, 0, payload))
+            return session_id
+
+    def _run_writer(self):
+        while True:
+            time.sleep(FLUSH_INTERVAL)
+            self.flush()
+
+    def flush(self):
+        """Writes everything queued so far; call before exiting."""
+        with self.write_lock:
+            pending = self.pending
+            pack = RECORD.pack
+            chunks = []
+            if self.dropped:
+                gap = str(self.dropped).encode("ascii")
+                self.dropped = 0
+                chunks.append(pack(len(gap), self.clock(), 0, KIND_GAP, 0))
+                chunks.append(gap)
+            try:
+                while True:
+                    timestamp, session_id, kind, flags, data = pending.popleft()
+                    chunks.append(pack(len(data), timestamp, session_id, kind, flags))
+                    chunks.append(data)
+            except IndexError:
+                pass # Drained
+            if not chunks:
+                return
+            data = b"".join(chunks)
+            try:
+                self.file.write(data)
+                self.file.flush()
+            except (OSError, ValueError) as e:
+                log.error(f"Error writing trace {self.path}: {e}")
+                return
+            self.records += len(chunks) // 2
+            self.bytes += len(data)
+
+    def describe(self):
+        return f"path={self.path} records={self.records} bytes={self.bytes} sessions_open={len(self.sessions)}"
+
+
+class TraceRecord:
+    __slots__ = ("timestamp", "session_id", "kind", "flags", "payload")
+
+    def __init__(self, timestamp, session_id, kind, flags, payload):
+        self.timestamp = timestamp
+        self.session_id = session_id
+        self.kind = kind
+        self.flags = flags
+        self.payload = payload
+
+
+def read_trace(path):
+    """Yields the TraceRecords of a trace file in order; stops quietly at a truncated last record."""
+    with open(path, "rb") as trace:
+        header = trace.read(FILE_HEADER.size)
+        if len(header) < FILE_HEADER.size or FILE_HEADER.unpack(header) != (TRACE_MAGIC, TRACE_VERSION):
+            raise ValueError(f"{path} is not a version {TRACE_VERSION} IPK25 trace")
+        unpack = RECORD.unpack
+        while True:
+            head = trace.read(RECORD.size)
+            if len(head) < RECORD.size:
+                return
+            length, timestamp, session_id, kind, flags = unpack(head)
+            payload = trace.read(length)
+            if len(payload) < length:
+                return
+            yield TraceRecord(timestamp, session_id, kind, flags, payload)
+
+
+def add_trace_arguments(parser):
+    """Adds the frame trace option shared by the test servers to an argparse parser."""
+    group = parser.add_argument_group("frame trace")
+    group.add_argument("--trace", metavar="PATH", default=None,
+                       help="Append every client frame to this binary trace (replay with trace_replay.py)")
+
+def trace_from_args(args, transport, clock=time.time, worker_id=None):
+    """Returns a TraceRecorder, or None when tracing is off. Pre-fork workers each get PATH.<worker id>."""
+    if not args.trace:
+        return None
+    path = args.trace if worker_id is None else f"{args.trace}.{worker_id}"
+    recorder = TraceRecorder(path, transport, clock)
+    log.info(f"Recording frames to {path}")
+    return recorder
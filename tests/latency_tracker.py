@@ -0,0 +1,236 @@
+import collections
+import math
+import threading
+import time
+
+from server_log import log
+
+# --- Latency Tracking ---
+# Where does a chat MSG spend its time? With --latency both servers keep
+# streaming quantile sketches of three durations, per session and per channel:
+#   rtt      UDP: server message sent until its CONFIRM, first transmissions only
+#            (Karn: a retransmitted message's CONFIRM could answer either send);
+#            the network plus the client's receive path
+#   write    a MSG received from a client until the server wrote it to one
+#            recipient's socket (the transport, for asyncio TCP): the server's share
+#   confirm  UDP: the same MSG until that recipient CONFIRMed it; minus write and
+#            rtt, what is left is time the recipient took to CONFIRM
+# The write and confirm durations follow a trace id that a sampled MSG gets on
+# receipt (--latency-sample) and that travels through ChatCore's fan-out to each
+# recipient; at debug log level every step is logged with that id. MSGs relayed
+# by other workers or federated nodes are not traced. RTT is also smoothed per
+# UDP session as in RFC 6298 (SRTT, RTTVAR), whether or not --latency is on.
+# Sketches have a bounded number of log-spaced buckets (DDSketch-style), so
+# memory stays fixed however many samples arrive: per session it is at most
+# SESSION_BUCKETS buckets per duration, per channel CHANNEL_BUCKETS, and only the
+# MAX_CHANNELS most recently active channels are kept. A session's sketches go
+# when the session ends. Results are served as JSON from the metrics port:
+# /latency.json, ?channel=ID or ?session=IP:PORT (or a display name).
+
+MIN_DURATION = 1e-6 # Seconds; anything shorter counts as zero
+# Quantiles are within the relative accuracy of the true value unless samples
+# spread over more buckets than allowed; then the lowest buckets are folded
+SESSION_ACCURACY = 0.05 # 128 buckets span 5 decades, e.g. 10 us to 1 s
+SESSION_BUCKETS = 128
+CHANNEL_ACCURACY = 0.01 # 1024 buckets span 9 decades
+CHANNEL_BUCKETS = 1024
+MAX_CHANNELS = 1024 # Least recently active channels beyond this lose their sketches
+STAGES = ("rtt", "write", "confirm")
+RTT_ALPHA = 1 / 8 # RFC 6298 gains
+RTT_BETA = 1 / 4
+
+
+class LatencySketch:
+    """Quantiles of durations in log-spaced buckets; the lowest buckets are folded when over max_buckets."""
+    __slots__ = ("gamma", "log_gamma", "buckets", "max_buckets", "count", "total", "zeros", "high")
+
+    def __init__(self, accuracy=CHANNEL_ACCURACY, max_buckets=CHANNEL_BUCKETS):
+        self.gamma = (1 + accuracy) / (1 - accuracy)
+        self.log_gamma = math.log(self.gamma)
+        self.buckets = {} # Key: bucket index i, for values in (gamma^(i-1), gamma^i]; Value: count
+        self.max_buckets = max_buckets
+        self.count = 0
+        self.total = 0.0
+        self.zeros = 0
+        self.high = 0.0
+
+    def add(self, seconds):
+        self.count += 1
+        self.total += seconds
+        if seconds > self.high:
+            self.high = seconds
+        if seconds < MIN_DURATION:
+            self.zeros += 1
+            return
+        index = math.ceil(math.log(seconds) / self.log_gamma)
+        buckets = self.buckets
+        buckets[index] = buckets.get(index, 0) + 1
+        if len(buckets) > self.max_buckets:
+            # Upper quantiles, the ones that matter for latency, keep their accuracy
+            lowest = min(buckets)
+            folded = buckets.pop(lowest)
+            buckets[min(buckets)] += folded
+
+    def quantile(self, q):
+        """Seconds at quantile q (0..1), or None without samples."""
+        if not self.count:
+            return None
+        rank = q * (self.count - 1)
+        if rank < self.zeros:
+            return 0.0
+        seen = self.zeros
+        for index in sorted(self.buckets):
+            seen += self.buckets[index]
+            if seen > rank:
+                # The value within accuracy of both bucket bounds
+                return min(2 * self.gamma ** index / (self.gamma + 1), self.high)
+        return self.high
+
+    def summary(self):
+        if not self.count:
+            return {"count": 0}
+        return {"count": self.count, "mean_ms": round(self.total / self.count * 1000, 3),
+                "p50_ms": round(self.quantile(0.50) * 1000, 3), "p90_ms": round(self.quantile(0.90) * 1000, 3),
+                "p99_ms": round(self.quantile(0.99) * 1000, 3), "max_ms": round(self.high * 1000, 3)}
+
+
+class MessageTrace:
+    """A sampled MSG on its way from the sender to each recipient's socket."""
+    __slots__ = ("trace_id", "channel_id", "received_at")
+
+    def __init__(self, trace_id, channel_id, received_at):
+        self.trace_id = trace_id
+        self.channel_id = channel_id
+        self.received_at = received_at # time.perf_counter() when the MSG arrived
+
+
+def update_rtt(session, sample):
+    """Folds one RTT sample into the session's srtt and rttvar (RFC 6298, section 2)."""
+    if session.srtt is None:
+        session.srtt = sample
+        session.rttvar = sample / 2
+    else:
+        session.rttvar = (1 - RTT_BETA) * session.rttvar + RTT_BETA * abs(session.srtt - sample)
+        session.srtt = (1 - RTT_ALPHA) * session.srtt + RTT_ALPHA * sample
+
+
+class LatencyTracker:
+    """Latency sketches by session, by channel and in total, plus the trace ids of sampled MSGs."""
+    def __init__(self, sample=1.0, max_channels=MAX_CHANNELS):
+        self.lock = threading.Lock() # Threaded TCP records from every client thread and the output pump
+        self.sample_every = max(1, round(1 / sample)) if sample > 0 else 0
+        self.max_channels = max_channels
+        self.msgs = 0 # MSGs offered to start()
+        self.traced = 0 # Also the last trace id handed out
+        self.sessions = {} # Key: Session, Value: {stage: LatencySketch}
+        self.channels = collections.OrderedDict() # Key: channel_id, Value: {stage: LatencySketch}
+        self.totals = {stage: LatencySketch() for stage in STAGES}
+
+    def start(self, channel_id, received_at):
+        """Returns a MessageTrace for every sample_every-th MSG, else None."""
+        self.msgs += 1 # Unlocked: a lost increment under threaded TCP only shifts the sampling
+        if not self.sample_every or self.msgs % self.sample_every:
+            return None
+        self.traced += 1
+        msg_trace = MessageTrace(self.traced, channel_id, received_at)
+        log.debug("TRACE %d: MSG received for '%s'", msg_trace.trace_id, channel_id)
+        return msg_trace
+
+    def written(self, msg_trace, session):
+        """The traced MSG was written to session's socket."""
+        seconds = time.perf_counter() - msg_trace.received_at
+        log.debug("TRACE %d: written to %s after %.3f ms", msg_trace.trace_id, session.addr, seconds * 1000)
+        self.observe(session, msg_trace.channel_id, "write", seconds)
+
+    def confirmed(self, msg_trace, session):
+        """session CONFIRMed the traced MSG (UDP)."""
+        seconds = time.perf_counter() - msg_trace.received_at
+        log.debug("TRACE %d: confirmed by %s after %.3f ms", msg_trace.trace_id, session.addr, seconds * 1000)
+        self.observe(session, msg_trace.channel_id, "confirm", seconds)
+
+    def rtt(self, session, seconds):
+        self.observe(session, session.current_channel, "rtt", seconds)
+
+    def observe(self, session, channel_id, stage, seconds):
+        with self.lock:
+            sketches = self.sessions.get(session)
+            if sketches is None:
+                sketches = self.sessions[session] = {}
+            sketch = sketches.get(stage)
+            if sketch is None:
+                sketch = sketches[stage] = LatencySketch(SESSION_ACCURACY, SESSION_BUCKETS)
+            sketch.add(seconds)
+            sketches = self.channels.get(channel_id)
+            if sketches is None:
+                sketches = self.channels[channel_id] = {}
+                if len(self.channels) > self.max_channels:
+                    self.channels.popitem(last=False)
+            else:
+                self.channels.move_to_end(channel_id)
+            sketch = sketches.get(stage)
+            if sketch is None:
+                sketch = sketches[stage] = LatencySketch()
+            sketch.add(seconds)
+            self.totals[stage].add(seconds)
+
+    def forget(self, session):
+        """Drops an ended session's sketches."""
+        with self.lock:
+            self.sessions.pop(session, None)
+
+    def report(self, session=None, channel=None):
+        """JSON-ready summaries: one session (by "ip:port" or display name), one channel, or totals and channels."""
+        with self.lock:
+            if session is not None:
+                for candidate, sketches in self.sessions.items():
+                    if session in (f"{candidate.addr[0]}:{candidate.addr[1]}", candidate.display_name):
+                        return describe_session(candidate, sketches)
+                return {"error": f"No latency samples for session '{session}'"}
+            if channel is not None:
+                sketches = self.channels.get(channel)
+                if sketches is None:
+                    return {"error": f"No latency samples for channel '{channel}'"}
+                return {"channel": channel, **summaries(sketches)}
+            return {"msgs": self.msgs, "traced_msgs": self.traced,
+                    "sessions": len(self.sessions), "total": summaries(self.totals),
+                    "channels": {channel_id: summaries(sketches) for channel_id, sketches in self.channels.items()}}
+
+    def describe(self):
+        with self.lock:
+            parts = [f"sessions={len(self.sessions)} channels={len(self.channels)}"]
+            for stage, sketch in self.totals.items():
+                if sketch.count:
+                    parts.append(f"{stage} p50={sketch.quantile(0.5) * 1000:.2f}ms "
+                                 f"p99={sketch.quantile(0.99) * 1000:.2f}ms n={sketch.count}")
+            return " ".join(parts)
+
+
+def summaries(sketches):
+    return {stage: sketch.summary() for stage, sketch in sketches.items()}
+
+
+def describe_session(session, sketches):
+    data = {"session": f"{session.addr[0]}:{session.addr[1]}", "display_name": session.display_name,
+            "channel": session.current_channel, **summaries(sketches)}
+    srtt = getattr(session, "srtt", None) # UDP sessions only
+    if srtt is not None:
+        data.update(srtt_ms=round(srtt * 1000, 3), rttvar_ms=round(session.rttvar * 1000, 3))
+    return data
+
+
+def add_latency_arguments(parser):
+    """Adds the latency tracking options shared by the test servers to an argparse parser."""
+    group = parser.add_argument_group("latency tracking")
+    group.add_argument("--latency", action="store_true",
+                       help="Keep RTT and MSG delivery latency sketches per session and channel "
+                            "(served at /latency.json on --metrics-port)")
+    group.add_argument("--latency-sample", type=float, default=1.0, metavar="FRACTION",
+                       help="Share of received MSGs followed to each recipient with a trace id (0 = RTT only)")
+
+def latency_from_args(args):
+    """Returns a LatencyTracker, or None when --latency is off."""
+    if not args.latency:
+        return None
+    if not 0 <= args.latency_sample <= 1:
+        raise SystemExit("--latency-sample must be between 0 and 1")
+    return LatencyTracker(args.latency_sample)
@@ -0,0 +1,363 @@
+import argparse
+import asyncio
+import json
+import random
+import sys
+
+from auth_backend import LOAD_SECRET
+from tcp_framing import CRLF, LineFramer, LineTooLongError
+from tcp_grammar import ENCODING, parse_command
+from udp_codec import (MSG_TYPE_BYE, MSG_TYPE_CONFIRM, MSG_TYPE_ERR, MSG_TYPE_MSG, MSG_TYPE_REPLY,
+                       pack_auth, pack_bye, pack_confirm, pack_join, pack_msg, parse_header, parse_reply)
+from udp_dedup import MessageIdWindow
+
+# --- Load Generator ---
+# Drives N concurrent synthetic IPK25-CHAT clients against tcp_server.py or
+# udp_server.py (or any IPK25-CHAT server) and reports throughput, REPLY and
+# CONFIRM latency percentiles and error counts as JSON, so runs can be compared
+# between releases. Each client authenticates as load<N> with the secret
+# auth_backend.py stores for such users ("add-load"); with --bad-auth a share of
+# sessions first sends a wrong secret, expecting REPLY NOK, and then retries.
+
+UDP_CONFIRM_TIMEOUT = 0.25 # Same defaults as the C# client
+UDP_MAX_RETRIES = 3
+REPLY_TIMEOUT = 5.0 # Seconds to wait for REPLY to AUTH/JOIN
+
+
+class LoadStats:
+    """Counters and raw latency samples shared by every virtual client."""
+    def __init__(self):
+        self.counters = {
+            "sessions_started": 0, "sessions_completed": 0,
+            "msg_sent": 0, "msg_received": 0, "reply_ok": 0, "reply_nok": 0,
+            "retransmissions": 0, "auth_retries": 0,
+        }
+        self.errors = {}
+        self.reply_latencies = [] # Seconds from AUTH/JOIN sent to REPLY received
+        self.confirm_latencies = [] # Seconds from first send to CONFIRM (UDP only)
+
+    def count(self, name, amount=1):
+        self.counters[name] += amount
+
+    def error(self, name):
+        self.errors[name] = self.errors.get(name, 0) + 1
+
+    def report(self, args, elapsed):
+        def percentiles(samples):
+            if not samples:
+                return {"count": 0}
+            ordered = sorted(samples)
+            pick = lambda q: ordered[min(int(q * len(ordered)), len(ordered) - 1)] * 1000
+            return {"count": len(ordered), "p50_ms": round(pick(0.50), 3), "p99_ms": round(pick(0.99), 3),
+                    "max_ms": round(ordered[-1] * 1000, 3)}
+
+        return {
+            "transport": args.transport, "clients": args.clients, "rate_per_client": args.rate,
+            "channels": args.channels, "session_lifetime_s": args.session_lifetime, "seed": args.seed,
+            "elapsed_s": round(elapsed, 3),
+            "throughput": {
+                "msg_sent_per_s": round(self.counters["msg_sent"] / elapsed, 1),
+                "msg_received_per_s": round(self.counters["msg_received"] / elapsed, 1),
+            },
+            "counters": self.counters,
+            "errors": self.errors,
+            "reply_latency": percentiles(self.reply_latencies),
+            "confirm_latency": percentiles(self.confirm_latencies),
+        }
+
+
+class VirtualClientBase:
+    """Session lifecycle shared by the TCP and UDP virtual clients."""
+    def __init__(self, client_id, args, stats, rng):
+        self.client_id = client_id
+        self.args = args
+        self.stats = stats
+        self.rng = rng
+        self.display_name = f"load{client_id}"
+        self.channel = f"load-{client_id % args.channels}" if args.channels > 0 else None
+
+    async def run(self, stop_at):
+        """Opens sessions back to back until stop_at; each lives session_lifetime seconds (churn)."""
+        loop = asyncio.get_running_loop()
+        while loop.time() < stop_at:
+            lifetime = self.args.session_lifetime or (stop_at - loop.time())
+            self.stats.count("sessions_started")
+            try:
+                ok = await self.session(min(loop.time() + lifetime, stop_at))
+            except (OSError, asyncio.TimeoutError, asyncio.IncompleteReadError) as e:
+                self.stats.error(type(e).__name__)
+                ok = False
+            if ok:
+                self.stats.count("sessions_completed")
+            else:
+                await asyncio.sleep(0.1 + self.rng.random() * 0.4) # Back off before reconnecting
+
+    def auth_secrets(self):
+        """Secrets to AUTH with in turn until one gets REPLY OK."""
+        if self.rng.random() * 100 < self.args.bad_auth:
+            return ("wrong-" + LOAD_SECRET, LOAD_SECRET)
+        return (LOAD_SECRET,)
+
+    async def authenticate(self, request):
+        """Sends AUTH via request(secret) -> ok, retrying after a REPLY NOK with the next secret."""
+        for attempt, secret in enumerate(self.auth_secrets()):
+            if attempt:
+                self.stats.count("auth_retries")
+            if await request(secret):
+                return True
+        return False
+
+    async def chat(self, session_end):
+        """Sends MSG at the configured rate until session_end."""
+        loop = asyncio.get_running_loop()
+        interval = 1 / self.args.rate if self.args.rate > 0 else None
+        sequence = 0
+        while loop.time() < session_end:
+            if interval is None:
+                await asyncio.sleep(session_end - loop.time())
+                break
+            # Exponential gaps give Poisson arrivals instead of lock-step bursts across clients
+            await asyncio.sleep(min(self.rng.expovariate(1 / interval), max(session_end - loop.time(), 0)))
+            if loop.time() >= session_end:
+                break
+            if not await self.send_msg(f"load message {sequence} from {self.display_name}"):
+                return False
+            self.stats.count("msg_sent")
+            sequence += 1
+        return True
+
+
+class TcpVirtualClient(VirtualClientBase):
+    async def session(self, session_end):
+        reader, writer = await asyncio.wait_for(
+            asyncio.open_connection(self.args.host, self.args.port), REPLY_TIMEOUT)
+        self.writer = writer
+        self.replies = asyncio.Queue()
+        receiver = asyncio.create_task(self.receive(reader))
+        try:
+            if not await self.authenticate(
+                    lambda secret: self.request(f"AUTH {self.display_name} AS {self.display_name} USING {secret}")):
+                return False
+            if self.channel and not await self.request(f"JOIN {self.channel} AS {self.display_name}"):
+                return False
+            ok = await self.chat(session_end)
+            self.send_line(f"BYE FROM {self.display_name}")
+            await writer.drain()
+            return ok
+        finally:
+            receiver.cancel()
+            writer.close()
+
+    def send_line(self, line):
+        self.writer.write((line + CRLF).encode(ENCODING))
+
+    async def request(self, line):
+        """Sends AUTH/JOIN and waits for its REPLY, recording the latency."""
+        loop = asyncio.get_running_loop()
+        started = loop.time()
+        self.send_line(line)
+        await self.writer.drain()
+        try:
+            ok = await asyncio.wait_for(self.replies.get(), REPLY_TIMEOUT)
+        except asyncio.TimeoutError:
+            self.stats.error("reply_timeout")
+            return False
+        self.stats.reply_latencies.append(loop.time() - started)
+        self.stats.count("reply_ok" if ok else "reply_nok")
+        return ok
+
+    async def send_msg(self, content):
+        self.send_line(f"MSG FROM {self.display_name} IS {content}")
+        await self.writer.drain()
+        return True
+
+    async def receive(self, reader):
+        framer = LineFramer()
+        while True:
+            data = await reader.read(65536)
+            if not data:
+                return
+            try:
+                lines = framer.feed(data)
+            except (UnicodeDecodeError, LineTooLongError):
+                self.stats.error("malformed_inbound")
+                return
+            for line in lines:
+                keyword, fields = parse_command(line)
+                if fields is None:
+                    self.stats.error("malformed_inbound")
+                elif keyword == "REPLY":
+                    self.replies.put_nowait(fields[0].upper() == "OK")
+                elif keyword == "MSG":
+                    self.stats.count("msg_received")
+                elif keyword == "ERR":
+                    self.stats.error("err_received")
+                elif keyword != "BYE":
+                    self.stats.error("malformed_inbound") # Client->server command
+
+
+class UdpVirtualClient(VirtualClientBase, asyncio.DatagramProtocol):
+    async def session(self, session_end):
+        loop = self.loop = asyncio.get_running_loop() # Also timestamps CONFIRM/REPLY in datagram_received()
+        self.server_addr = (self.args.host, self.args.port) # Switches to the dynamic port after REPLY
+        self.next_msg_id = 0
+        self.pending = {} # Key: MessageID, Value: [data, first_sent, attempts, TimerHandle, Future]
+        self.reply_waiters = {} # Key: Ref MessageID, Value: (Future, sent time)
+        self.seen = MessageIdWindow()
+        self.transport, _ = await loop.create_datagram_endpoint(lambda: self, local_addr=("0.0.0.0", 0))
+        try:
+            if not await self.authenticate(self.request_auth):
+                return False
+            if self.channel:
+                join_id = self.next_id()
+                if not await self.request(join_id, pack_join(join_id, self.channel, self.display_name)):
+                    return False
+            ok = await self.chat(session_end)
+            bye_id = self.next_id()
+            await self.send_reliable(bye_id, pack_bye(bye_id, self.display_name))
+            return ok
+        finally:
+            for entry in self.pending.values():
+                entry[3].cancel()
+            self.transport.close()
+
+    def request_auth(self, secret):
+        # A retry goes to the dynamic port the REPLY NOK came from
+        auth_id = self.next_id()
+        return self.request(auth_id, pack_auth(auth_id, self.display_name, self.display_name, secret))
+
+    def next_id(self):
+        msg_id = self.next_msg_id
+        self.next_msg_id = (self.next_msg_id + 1) % 65536
+        return msg_id
+
+    def send_reliable(self, msg_id, data):
+        """Sends a client message; the returned future resolves True on CONFIRM, False on give-up."""
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        handle = loop.call_later(UDP_CONFIRM_TIMEOUT, self.retransmit, msg_id)
+        self.pending[msg_id] = [data, loop.time(), 1, handle, future]
+        self.transport.sendto(data, self.server_addr)
+        return future
+
+    def retransmit(self, msg_id):
+        entry = self.pending.get(msg_id)
+        if entry is None:
+            return
+        if entry[2] > UDP_MAX_RETRIES:
+            del self.pending[msg_id]
+            self.stats.error("confirm_timeout")
+            entry[4].set_result(False)
+            return
+        entry[2] += 1
+        self.stats.count("retransmissions")
+        entry[3] = asyncio.get_running_loop().call_later(UDP_CONFIRM_TIMEOUT, self.retransmit, msg_id)
+        self.transport.sendto(entry[0], self.server_addr)
+
+    async def request(self, msg_id, data):
+        """Sends AUTH/JOIN reliably and waits for the REPLY referencing it."""
+        loop = asyncio.get_running_loop()
+        reply = loop.create_future()
+        self.reply_waiters[msg_id] = (reply, loop.time())
+        if not await self.send_reliable(msg_id, data):
+            return False
+        try:
+            ok = await asyncio.wait_for(reply, REPLY_TIMEOUT)
+        except asyncio.TimeoutError:
+            self.stats.error("reply_timeout")
+            return False
+        finally:
+            self.reply_waiters.pop(msg_id, None)
+        self.stats.count("reply_ok" if ok else "reply_nok")
+        return ok
+
+    async def send_msg(self, content):
+        msg_id = self.next_id()
+        return await self.send_reliable(msg_id, pack_msg(msg_id, self.display_name, content))
+
+    def datagram_received(self, data, addr):
+        header = parse_header(data)
+        if header is None:
+            self.stats.error("malformed_inbound")
+            return
+        msg_type, msg_id = header
+        if msg_type == MSG_TYPE_CONFIRM:
+            entry = self.pending.pop(msg_id, None)
+            if entry is not None:
+                entry[3].cancel()
+                self.stats.confirm_latencies.append(self.loop.time() - entry[1])
+                entry[4].set_result(True)
+            return
+
+        self.transport.sendto(pack_confirm(msg_id), addr)
+        self.server_addr = addr # Server messages come from the session's dynamic port
+        if self.seen.contains(msg_id):
+            return
+        self.seen.add(msg_id)
+        reply = parse_reply(data) if msg_type == MSG_TYPE_REPLY else None
+        if reply is not None:
+            _, result, ref_id, _ = reply
+            waiter = self.reply_waiters.get(ref_id)
+            if waiter and not waiter[0].done():
+                self.stats.reply_latencies.append(self.loop.time() - waiter[1])
+                waiter[0].set_result(result == 1)
+        elif msg_type == MSG_TYPE_MSG:
+            self.stats.count("msg_received")
+        elif msg_type == MSG_TYPE_ERR:
+            self.stats.error("err_received")
+        elif msg_type == MSG_TYPE_BYE:
+            self.stats.error("bye_received")
+
+    def error_received(self, exc):
+        self.stats.error(type(exc).__name__)
+
+
+async def run_load(args, client_class=None):
+    """Runs the load; client_class(client_id, args, stats, rng) overrides the client type for the transport."""
+    stats = LoadStats()
+    rng = random.Random(args.seed)
+    client_class = client_class or (TcpVirtualClient if args.transport == "tcp" else UdpVirtualClient)
+    loop = asyncio.get_running_loop()
+    started = loop.time()
+    stop_at = started + args.ramp + args.duration
+    tasks = []
+    for client_id in range(args.clients):
+        client = client_class(client_id, args, stats, random.Random(rng.random()))
+        tasks.append(asyncio.create_task(client.run(stop_at)))
+        if args.ramp > 0:
+            await asyncio.sleep(args.ramp / args.clients) # Spread connects over the ramp-up
+    await asyncio.gather(*tasks)
+    return stats.report(args, loop.time() - started)
+
+
+def parse_args():
+    """Parses command line options."""
+    parser = argparse.ArgumentParser(description="IPK25-CHAT load generator")
+    parser.add_argument("--transport", choices=("tcp", "udp"), default="tcp")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=4567)
+    parser.add_argument("--clients", type=int, default=100, help="Concurrent virtual clients")
+    parser.add_argument("--rate", type=float, default=1.0, help="MSG per second per client (0 = idle)")
+    parser.add_argument("--channels", type=int, default=10,
+                        help="Spread clients over this many channels (0 = stay in default)")
+    parser.add_argument("--duration", type=float, default=30.0, help="Seconds of load after ramp-up")
+    parser.add_argument("--ramp", type=float, default=0.0, help="Seconds over which clients connect")
+    parser.add_argument("--session-lifetime", type=float, default=0.0,
+                        help="Reconnect every N seconds to churn sessions (0 = one session per client)")
+    parser.add_argument("--bad-auth", type=float, default=0.0, metavar="PCT",
+                        help="Sessions that AUTH with a wrong secret first and retry after REPLY NOK (percent)")
+    parser.add_argument("--seed", type=int, default=None, help="RNG seed for reproducible schedules")
+    parser.add_argument("--output", default="-", help="JSON report path ('-' = stdout)")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    report = asyncio.run(run_load(args))
+    text = json.dumps(report, indent=2)
+    if args.output == "-":
+        print(text)
+    else:
+        with open(args.output, "w") as out:
+            out.write(text + "\n")
+        print(f"Report written to {args.output}", file=sys.stderr)
@@ -0,0 +1,153 @@
+import collections
+import threading
+
+# --- Rate Limiting ---
+# Token buckets shared by tcp_server.py and udp_server.py, kept separately for
+# AUTH, JOIN and MSG, per session and per source IP. A bucket is refilled
+# lazily: each check adds rate x elapsed tokens since its last check (capped at
+# the burst size), so idle sessions cost nothing and no periodic sweep is needed.
+# Traffic over a limit gets the configured action:
+#   drop       - the message is ignored (UDP still CONFIRMs it, so the client does not retransmit)
+#   delay      - the message is handled once the bucket has a token again; the token is taken
+#                up front so later messages queue behind it, and anything that would wait
+#                longer than MAX_DELAY is dropped instead, without taking a token
+#   disconnect - ERR is sent and the session is terminated
+# The caller passes the current time, from the same clock as its timers.
+
+THROTTLE_ACTIONS = ("drop", "delay", "disconnect")
+LIMITED_TYPES = ("AUTH", "JOIN", "MSG")
+MAX_DELAY = 5.0 # Seconds; longer waits are dropped rather than queued
+MAX_TRACKED_IPS = 65536 # Least recently seen source IPs beyond this lose their buckets
+
+
+class TokenBucket:
+    __slots__ = ("rate", "burst", "tokens", "updated")
+
+    def __init__(self, rate, burst, now):
+        self.rate = rate # Tokens per second
+        self.burst = burst
+        self.tokens = burst
+        self.updated = now
+
+    def wait(self, now):
+        """Refills the bucket. Returns 0 if a token is available, else the seconds until one will be."""
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def take(self):
+        """Takes one token; below one, the bucket goes into debt, which reserves the next slot for a delayed message."""
+        self.tokens -= 1
+
+
+class RateLimits:
+    """Configured limits: {message type: (rate per second, burst)} per session and per source IP."""
+    def __init__(self, session=None, per_ip=None, action="drop"):
+        if action not in THROTTLE_ACTIONS:
+            raise ValueError(f"Unknown throttle action '{action}'")
+        self.session = session or {}
+        self.per_ip = per_ip or {}
+        self.action = action
+
+    def is_active(self):
+        return bool(self.session or self.per_ip)
+
+
+class RateLimiter:
+    """Applies RateLimits; session buckets live on the session, per-IP buckets here.
+
+    on_throttle(label) is called for every message over a limit, with labels
+    like "MSG/session" or "AUTH/ip".
+    """
+    def __init__(self, limits, on_throttle=None):
+        self.limits = limits
+        self.action = limits.action
+        self.on_throttle = on_throttle
+        self.lock = threading.Lock() # Threaded TCP checks per-IP buckets from every client thread
+        self.ip_buckets = collections.OrderedDict() # Key: (ip, message type), Value: TokenBucket
+
+    def session_buckets(self, now):
+        """Returns the bucket dict a new session stores and passes back to check()."""
+        return {kind: TokenBucket(rate, burst, now) for kind, (rate, burst) in self.limits.session.items()}
+
+    def check(self, buckets, ip, kind, now):
+        """Returns (action, wait) for one message of type kind.
+
+        action is None when the message may be handled now, "delay" when it
+        should be handled after wait seconds, else "drop" or "disconnect".
+        """
+        debt = self.action == "delay"
+        wait = 0.0
+        session_bucket = buckets.get(kind) if buckets else None
+        if session_bucket is not None:
+            wait = session_bucket.wait(now)
+            if wait:
+                self._throttled(f"{kind}/session")
+        limit = self.limits.per_ip.get(kind)
+        if limit is not None and (not wait or debt):
+            with self.lock:
+                key = (ip, kind)
+                bucket = self.ip_buckets.get(key)
+                if bucket is None:
+                    bucket = self.ip_buckets[key] = TokenBucket(limit[0], limit[1], now)
+                    if len(self.ip_buckets) > MAX_TRACKED_IPS * len(LIMITED_TYPES):
+                        self.ip_buckets.popitem(last=False)
+                else:
+                    self.ip_buckets.move_to_end(key)
+                ip_wait = bucket.wait(now)
+                if self._handles(max(wait, ip_wait)):
+                    bucket.take() # Under the lock: all sessions of the IP share this bucket
+            if ip_wait:
+                self._throttled(f"{kind}/ip")
+                wait = max(wait, ip_wait)
+        if session_bucket is not None and self._handles(wait):
+            session_bucket.take()
+        if not wait:
+            return None, 0.0
+        if debt:
+            return ("delay" if wait <= MAX_DELAY else "drop"), wait
+        return self.action, wait
+
+    def _handles(self, wait):
+        """Whether a message that would wait this long is handled, now or delayed.
+
+        Only those take tokens: a dropped message must not push the buckets,
+        the per-IP one shared with other sessions, further into debt.
+        """
+        return not wait or self.action == "delay" and wait <= MAX_DELAY
+
+    def _throttled(self, label):
+        if self.on_throttle is not None:
+            self.on_throttle(label)
+
+
+def parse_limit(text):
+    """Parses TYPE:RATE[:BURST] (e.g. MSG:10:20) into (type, (rate, burst))."""
+    parts = text.split(":")
+    if len(parts) not in (2, 3) or parts[0].upper() not in LIMITED_TYPES:
+        raise ValueError(f"Expected TYPE:RATE[:BURST] with TYPE one of {'/'.join(LIMITED_TYPES)}, got '{text}'")
+    rate = float(parts[1])
+    burst = float(parts[2]) if len(parts) == 3 else max(rate, 1.0)
+    if rate <= 0 or burst < 1:
+        raise ValueError(f"Rate must be > 0 and burst >= 1 in '{text}'")
+    return parts[0].upper(), (rate, burst)
+
+
+def add_rate_limit_arguments(parser):
+    """Adds the rate limiting options shared by the test servers to an argparse parser."""
+    group = parser.add_argument_group("rate limiting (off unless a limit is given)")
+    group.add_argument("--rate-limit", action="append", default=[], metavar="TYPE:RATE[:BURST]",
+                       help="Token bucket per session for AUTH, JOIN or MSG, e.g. MSG:10:20 (repeatable)")
+    group.add_argument("--ip-rate-limit", action="append", default=[], metavar="TYPE:RATE[:BURST]",
+                       help="Token bucket per source IP, shared by all its sessions (repeatable)")
+    group.add_argument("--throttle-action", choices=THROTTLE_ACTIONS, default="drop",
+                       help="What happens to traffic over a limit")
+
+def limiter_from_args(args, on_throttle=None):
+    """Returns a RateLimiter, or None when no limit is configured."""
+    try:
+        limits = RateLimits(dict(parse_limit(text) for text in args.rate_limit),
+                            dict(parse_limit(text) for text in args.ip_rate_limit), args.throttle_action)
+    except ValueError as e:
+        raise SystemExit(f"Invalid rate limit: {e}")
+    return RateLimiter(limits, on_throttle) if limits.is_active() else None
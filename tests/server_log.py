@@ -0,0 +1,152 @@
+import atexit
+import collections
+import json
+import os
+import sys
+import threading
+import time
+
+# --- Asynchronous Logging ---
+# Takes print() off the packet hot path. A call on an enabled level appends one
+# tuple to a deque (atomic in CPython, no lock) and returns; a background thread
+# formats the records and writes them in batches, so a slow terminal or pipe
+# stalls only the writer. Disabled levels are rebound to a no-op, so a call
+# costs one function call; keep hot-path messages lazy ("%s" args, not f-strings).
+
+DEBUG, INFO, WARN, ERROR = 10, 20, 30, 40
+LEVEL_NAMES = {DEBUG: "DEBUG", INFO: "INFO", WARN: "WARN", ERROR: "ERROR"}
+LEVELS_BY_NAME = {name.lower(): level for level, name in LEVEL_NAMES.items()}
+
+FLUSH_INTERVAL = 0.05 # Seconds the writer waits between batches
+MAX_PENDING = 100000 # Records kept while the writer is behind; older ones are dropped beyond this
+
+
+def _noop(*args, **fields):
+    pass
+
+
+class Logger:
+    """Leveled logger with a lock-free hand-off queue and a batching writer thread."""
+    def __init__(self):
+        self.pending = collections.deque(maxlen=MAX_PENDING)
+        self.writer = None
+        self.start_lock = threading.Lock()
+        self.stream = sys.stdout
+        self.json_lines = False
+        self.sample_every = 1
+        self.packet_counter = 0
+        self.dropped = 0
+        self.level = DEBUG
+        self.context = {} # Fields added to every record, e.g. the worker id in pre-fork mode
+        self.prefix = ""
+        self.configure()
+        os.register_at_fork(after_in_child=self._after_fork)
+
+    def configure(self, level=DEBUG, json_lines=False, sample_every=1, stream=None):
+        """Sets the level, output format and per-packet sampling (log 1 of every N packets)."""
+        self.level = LEVELS_BY_NAME[level] if isinstance(level, str) else level
+        self.json_lines = json_lines
+        self.sample_every = max(int(sample_every), 1)
+        if stream is not None:
+            self.stream = stream
+        for level_value, name in LEVEL_NAMES.items():
+            method = self._emitter(level_value) if level_value >= self.level else _noop
+            setattr(self, name.lower(), method)
+        # Per-packet logs are DEBUG and additionally sampled
+        self.packet = self._sampled_packet if self.level <= DEBUG else _noop
+        self.packet_enabled = self.level <= DEBUG
+
+    def set_context(self, **fields):
+        """Tags every following record with fields (text lines get them as a [key=value] prefix)."""
+        self.context.update(fields)
+        self.prefix = "[" + " ".join(f"{key}={value}" for key, value in self.context.items()) + "] "
+
+    def _after_fork(self):
+        # Only the forking thread survives fork(): the writer must be started again in the child
+        self.writer = None
+        self.start_lock = threading.Lock()
+        self.pending.clear()
+
+    def _emitter(self, level):
+        pending = self.pending
+        def emit(message, *args, **fields):
+            if len(pending) == MAX_PENDING:
+                self.dropped += 1 # Approximate under contention; only used for reporting
+            pending.append((time.time(), level, message, args, fields))
+            if self.writer is None:
+                self._start_writer()
+        return emit
+
+    def _sampled_packet(self, message, *args, **fields):
+        self.packet_counter += 1
+        if self.packet_counter % self.sample_every == 0:
+            self.debug(message, *args, **fields)
+
+    def _start_writer(self):
+        with self.start_lock: # Several threads may log their first record at once
+            if self.writer is None:
+                self.writer = threading.Thread(target=self._run_writer, name="log-writer", daemon=True)
+                self.writer.start()
+                atexit.register(self.flush)
+
+    def _run_writer(self):
+        while True:
+            time.sleep(FLUSH_INTERVAL)
+            self._write_batch()
+
+    def _format(self, record):
+        timestamp, level, message, args, fields = record
+        if args:
+            try:
+                message = message % args
+            except (TypeError, ValueError):
+                message = f"{message} {args}"
+        if self.json_lines:
+            entry = {"ts": round(timestamp, 6), "level": LEVEL_NAMES[level], "msg": message}
+            entry.update(self.context)
+            entry.update(fields)
+            return json.dumps(entry, default=str)
+        if fields:
+            message += " " + " ".join(f"{key}={value}" for key, value in fields.items())
+        if level >= WARN:
+            message = f"{LEVEL_NAMES[level]}: {message}" # Same prefixes the servers used to print
+        return self.prefix + message
+
+    def _write_batch(self):
+        pending = self.pending
+        lines = []
+        try:
+            while True:
+                lines.append(self._format(pending.popleft()))
+        except IndexError:
+            pass # Drained
+        if self.dropped:
+            lines.append(f"WARN: {self.dropped} log record(s) dropped, writer fell behind")
+            self.dropped = 0
+        if lines:
+            try:
+                self.stream.write("\n".join(lines) + "\n")
+                self.stream.flush()
+            except (OSError, ValueError):
+                pass # Output closed; nothing sensible left to do with log lines
+
+    def flush(self):
+        """Writes everything queued so far; call before exiting."""
+        self._write_batch()
+
+
+log = Logger()
+
+
+def add_log_arguments(parser):
+    """Adds the logging options shared by the test servers to an argparse parser."""
+    group = parser.add_argument_group("logging")
+    group.add_argument("--log-level", choices=tuple(LEVELS_BY_NAME), default="debug",
+                       help="Lowest level written; debug includes per-packet SND/RCV lines")
+    group.add_argument("--log-format", choices=("text", "json"), default="text",
+                       help="Plain lines or one JSON object per line")
+    group.add_argument("--packet-sample", type=int, default=1, metavar="N",
+                       help="Log only every Nth per-packet line (1 logs all)")
+
+def configure_from_args(args):
+    log.configure(args.log_level, args.log_format == "json", args.packet_sample)
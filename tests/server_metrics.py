@@ -0,0 +1,318 @@
+import bisect
+import http.server
+import json
+import os
+import threading
+import time
+import urllib.parse
+
+from server_log import log
+
+# --- Metrics Registry ---
+# Counters, scrape-time gauges and fixed-bucket histograms shared by both test
+# servers. Updates are a dict increment or a bisect over 16 bucket bounds, cheap
+# enough to stay on during load tests. The asyncio and selector engines update
+# from one thread and take no lock; the threaded TCP engine calls
+# make_thread_safe(), which rebinds the update methods to locked variants (a
+# scrape may still see a histogram's sum and count one update apart). Gauges such as
+# sessions by state are computed from the session tables only when scraped, so
+# state transitions cost nothing. Exposed as Prometheus text on a local HTTP
+# port (--metrics-port) and as a JSON snapshot file rewritten periodically
+# (--metrics-json). Reports that take query parameters, such as the latency
+# sketches of one session or channel, are served as extra JSON paths.
+
+# Seconds; roughly x2 steps from 50 us to 5 s
+LATENCY_BUCKETS = (0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+                   0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+
+class Counter:
+    """Monotonic counter, optionally split by one label (e.g. message type)."""
+    kind = "counter"
+
+    def __init__(self, name, help_text, label=None):
+        self.name = name
+        self.help = help_text
+        self.label = label
+        self.values = {}
+        self.lock = None
+
+    def inc(self, label_value=None, amount=1):
+        self.values[label_value] = self.values.get(label_value, 0) + amount
+
+    def _locked_inc(self, label_value=None, amount=1):
+        with self.lock:
+            self.values[label_value] = self.values.get(label_value, 0) + amount
+
+    def make_thread_safe(self):
+        self.lock = threading.Lock()
+        self.inc = self._locked_inc
+
+    def samples(self):
+        return dict(self.values) or {None: 0}
+
+
+class Gauge:
+    """Value computed at scrape time by collect(), a number or a {label_value: number} dict."""
+    kind = "gauge"
+
+    def __init__(self, name, help_text, collect, label=None):
+        self.name = name
+        self.help = help_text
+        self.label = label
+        self.collect = collect
+
+    def make_thread_safe(self):
+        pass # collect() does its own locking
+
+    def samples(self):
+        value = self.collect()
+        return value if isinstance(value, dict) else {None: value}
+
+
+class Histogram:
+    """Cumulative-bucket histogram with fixed bounds, as Prometheus expects."""
+    kind = "histogram"
+
+    def __init__(self, name, help_text, buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help_text
+        self.label = None
+        self.bounds = buckets
+        self.counts = [0] * (len(buckets) + 1) # Last slot is +Inf
+        self.total = 0.0
+        self.count = 0
+        self.lock = None
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.total += value
+        self.count += 1
+
+    def _locked_observe(self, value):
+        index = bisect.bisect_left(self.bounds, value)
+        with self.lock:
+            self.counts[index] += 1
+            self.total += value
+            self.count += 1
+
+    def make_thread_safe(self):
+        self.lock = threading.Lock()
+        self.observe = self._locked_observe
+
+    def state(self):
+        return list(self.counts), self.total, self.count
+
+    def quantile(self, q, counts=None, count=None):
+        """Upper bound of the bucket holding quantile q, or None without observations."""
+        if counts is None:
+            counts, _, count = self.state()
+        if not count:
+            return None
+        rank = q * count
+        seen = 0
+        for bound, bucket_count in zip(self.bounds + (float("inf"),), counts):
+            seen += bucket_count
+            if seen >= rank:
+                return bound
+        return float("inf")
+
+
+def json_bound(bound):
+    """JSON has no infinity: a quantile in the overflow bucket is reported as "+Inf", as Prometheus spells that bound."""
+    return "+Inf" if bound == float("inf") else bound
+
+
+class MetricsRegistry:
+    """Ordered collection of metrics with Prometheus text and JSON renderers."""
+    def __init__(self):
+        self.metrics = []
+        self.reports = {} # Key: URL path, Value: callable(**query parameters) returning JSON-ready data
+
+    def counter(self, name, help_text, label=None):
+        return self._register(Counter(name, help_text, label))
+
+    def gauge(self, name, help_text, collect, label=None):
+        return self._register(Gauge(name, help_text, collect, label))
+
+    def histogram(self, name, help_text, buckets=LATENCY_BUCKETS):
+        return self._register(Histogram(name, help_text, buckets))
+
+    def _register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def make_thread_safe(self):
+        """Switches every metric to locked updates, for engines that update from many threads."""
+        for metric in self.metrics:
+            metric.make_thread_safe()
+
+    def render_prometheus(self):
+        lines = []
+        for metric in self.metrics:
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            if metric.kind == "histogram":
+                counts, total, count = metric.state()
+                cumulative = 0
+                for bound, bucket_count in zip(metric.bounds, counts):
+                    cumulative += bucket_count
+                    lines.append(f'{metric.name}_bucket{{le="{bound}"}} {cumulative}')
+                lines.append(f'{metric.name}_bucket{{le="+Inf"}} {count}')
+                lines.append(f"{metric.name}_sum {total}")
+                lines.append(f"{metric.name}_count {count}")
+                continue
+            for label_value, value in sorted(metric.samples().items(), key=lambda item: str(item[0])):
+                if label_value is None:
+                    lines.append(f"{metric.name} {value}")
+                else:
+                    lines.append(f'{metric.name}{{{metric.label}="{label_value}"}} {value}')
+        return "\n".join(lines) + "\n"
+
+    def snapshot(self):
+        data = {"ts": round(time.time(), 3)}
+        for metric in self.metrics:
+            if metric.kind == "histogram":
+                counts, total, count = metric.state()
+                data[metric.name] = {
+                    "count": count, "sum": round(total, 6),
+                    "p50": json_bound(metric.quantile(0.50, counts, count)),
+                    "p99": json_bound(metric.quantile(0.99, counts, count)),
+                }
+                continue
+            samples = metric.samples()
+            data[metric.name] = samples[None] if list(samples) == [None] else samples
+        return data
+
+
+class ServerMetrics(MetricsRegistry):
+    """The metric set both servers report; gauges are bound once the session tables exist."""
+    def __init__(self):
+        super().__init__()
+        self.messages_received = self.counter("ipk25_messages_received_total",
+                                              "Protocol messages received, by type", "type")
+        self.messages_sent = self.counter("ipk25_messages_sent_total",
+                                          "Protocol messages sent (including retransmissions), by type", "type")
+        self.bytes_received = self.counter("ipk25_bytes_received_total", "Payload bytes received from clients")
+        self.bytes_sent = self.counter("ipk25_bytes_sent_total", "Payload bytes sent to clients")
+        self.duplicates = self.counter("ipk25_duplicates_total", "Client messages dropped as duplicates (UDP)")
+        self.retransmissions = self.counter("ipk25_retransmissions_total", "Unconfirmed messages resent (UDP)")
+        self.pings_sent = self.counter("ipk25_pings_sent_total", "Keepalive PINGs sent (UDP)")
+        self.confirm_rtt = self.histogram("ipk25_confirm_rtt_seconds",
+                                          "Server message sent until CONFIRMed, first transmissions only (UDP)")
+        self.timeouts = self.counter("ipk25_session_timeouts_total",
+                                     "Sessions ended by idle expiry or exhausted retries", "reason")
+        self.slow_consumer = self.counter("ipk25_slow_consumer_events_total",
+                                          "Lines dropped or connections closed because a TCP client stopped reading",
+                                          "action")
+        self.throttled = self.counter("ipk25_throttled_total",
+                                      "Messages over a rate limit, by limit (e.g. MSG/session, AUTH/ip)", "limit")
+        self.auth_latency = self.histogram("ipk25_auth_reply_seconds", "AUTH received until REPLY sent")
+        self.broadcast_latency = self.histogram("ipk25_msg_broadcast_seconds",
+                                                "MSG received until fan-out to the channel completed")
+        self.auth_results = self.counter("ipk25_auth_results_total",
+                                         "AUTHs checked against --auth-db, by result (ok/rejected)", "result")
+        self.auth_cache = self.counter("ipk25_auth_cache_lookups_total",
+                                       "Verified-credential cache lookups, by result (hit/miss)", "result")
+        self.auth_verify_latency = self.histogram("ipk25_auth_verify_seconds",
+                                                  "Secret hashing off the loop for an AUTH the cache could not answer")
+        self.handoff_pause = self.histogram("ipk25_handoff_pause_seconds",
+                                            "Clients left unserved while the previous process handed over, see --handoff")
+
+    def record_auth(self, verdict):
+        """Counts one auth_backend.Verdict."""
+        self.auth_results.inc("ok" if verdict.ok else "rejected")
+        self.auth_cache.inc("hit" if verdict.cached else "miss")
+        if not verdict.cached:
+            self.auth_verify_latency.observe(verdict.seconds)
+
+    def bind_sessions(self, collect):
+        """collect() returns {state: count} for the sessions this process serves."""
+        self.gauge("ipk25_sessions", "Open sessions by protocol state", collect, "state")
+
+    def bind_latency(self, tracker):
+        """Serves a latency_tracker.LatencyTracker's sketches at /latency.json[?session=...|channel=...]."""
+        self.reports["/latency.json"] = tracker.report
+
+    def bind_history(self, collect):
+        """collect() returns {channel_id: bytes} held by the channel history."""
+        self.gauge("ipk25_channel_history_bytes", "Approximate memory held by replay history, by channel",
+                   collect, "channel")
+
+
+class _MetricsHandler(http.server.BaseHTTPRequestHandler):
+    registry = None
+
+    def do_GET(self):
+        url = urllib.parse.urlsplit(self.path)
+        report = self.registry.reports.get(url.path)
+        if url.path == "/metrics":
+            body = self.registry.render_prometheus().encode()
+            content_type = "text/plain; version=0.0.4"
+        elif url.path == "/metrics.json":
+            body = json.dumps(self.registry.snapshot()).encode()
+            content_type = "application/json"
+        elif report is not None:
+            try:
+                body = json.dumps(report(**dict(urllib.parse.parse_qsl(url.query)))).encode()
+            except TypeError: # Unknown query parameter
+                self.send_error(400)
+                return
+            content_type = "application/json"
+        else:
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass # Scrapes would otherwise flood the server log
+
+
+def start_http_endpoint(registry, host, port):
+    """Serves /metrics (Prometheus text) and /metrics.json from a daemon thread."""
+    handler = type("MetricsHandler", (_MetricsHandler,), {"registry": registry})
+    server = http.server.ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="metrics-http", daemon=True).start()
+    log.info(f"Metrics available at http://{host}:{port}/metrics")
+    return server
+
+
+def write_snapshots(registry, path, interval):
+    """Rewrites path with a JSON snapshot every interval seconds (atomically, via rename)."""
+    temporary = path + ".tmp"
+    while True:
+        time.sleep(interval)
+        try:
+            with open(temporary, "w") as out:
+                json.dump(registry.snapshot(), out)
+            os.replace(temporary, path)
+        except OSError as e:
+            log.warn(f"Could not write metrics snapshot to {path}: {e}")
+
+
+def add_metrics_arguments(parser):
+    """Adds the metrics options shared by the test servers to an argparse parser."""
+    group = parser.add_argument_group("metrics")
+    group.add_argument("--metrics-port", type=int, default=0,
+                       help="Serve Prometheus text on 127.0.0.1:PORT/metrics (0 disables; worker N uses PORT+N)")
+    group.add_argument("--metrics-json", default=None, metavar="PATH",
+                       help="Write a JSON snapshot to PATH every --metrics-interval seconds (worker N adds .N)")
+    group.add_argument("--metrics-interval", type=float, default=10.0)
+
+def start_from_args(registry, args, worker_id=None):
+    """Starts whichever exporters the options ask for; call in the process that serves clients."""
+    if args.metrics_port:
+        port = args.metrics_port + (worker_id or 0)
+        try:
+            start_http_endpoint(registry, "127.0.0.1", port)
+        except OSError as e:
+            log.warn(f"Could not start metrics endpoint on port {port}: {e}")
+    if args.metrics_json:
+        path = args.metrics_json if worker_id is None else f"{args.metrics_json}.{worker_id}"
+        threading.Thread(target=write_snapshots, args=(registry, path, args.metrics_interval),
+                         name="metrics-json", daemon=True).start()
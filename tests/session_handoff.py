@@ -0,0 +1,310 @@
+import base64
+import json
+import os
+import socket
+import struct
+import threading
+import time
+
+from server_log import log
+from sessions import SessionState
+
+# --- Live Session Handoff ---
+# Lets a new server process replace a running one without dropping a client.
+# With --handoff PATH a server listens for a successor on a Unix socket at PATH.
+# A server started later with the same PATH finds it there and takes over: the
+# old process stops serving, passes every socket it owns (TCP listening socket
+# and connections, UDP main, pooled and dynamic reply sockets, and the handoff
+# listener itself) as SCM_RIGHTS ancillary data, followed by a JSON snapshot of
+# its sessions, and exits once the successor confirms. Both processes refer to
+# the same kernel sockets, so whatever clients send meanwhile waits in the socket
+# buffers, and closing the old process's descriptors neither resets a
+# connection nor frees a port: clients only see a pause, which both sides log
+# and the successor reports as ipk25_handoff_pause_seconds. If the successor
+# fails or goes silent before confirming, the old process resumes serving.
+#
+# On the stream, after the successor's HELLO: a HEADER, the descriptors in
+# batches of FDS_PER_MESSAGE (each batch attached to one marker byte), the
+# snapshot, then the successor's ACK. Descriptor 0 is the handoff listener; the
+# snapshot refers to the others by their index in Takeover.sockets.
+
+HANDOFF_MAGIC = b"IPK25HND"
+HANDOFF_VERSION = 1
+HELLO = struct.Struct("<8sI") # Magic, successor pid
+HEADER = struct.Struct("<8sBII") # Magic, version, descriptor count, snapshot length
+FD_MARKER = b"F"
+ACK = b"A"
+FDS_PER_MESSAGE = 250 # Linux accepts at most 253 descriptors per message (SCM_MAX_FD)
+HANDOFF_TIMEOUT = 10.0 # Seconds either side waits for the other before giving up
+
+
+class HandoffError(Exception):
+    """The peer on the handoff socket sent something other than the expected handoff."""
+
+
+class HandoffChannel:
+    """The connection between a server and its successor (blocking, with HANDOFF_TIMEOUT)."""
+    def __init__(self, sock):
+        self.sock = sock
+        self.peer_pid = None
+        sock.settimeout(HANDOFF_TIMEOUT)
+
+    def send_state(self, snapshot, fds):
+        data = json.dumps(snapshot, separators=(",", ":")).encode("ascii")
+        self.sock.sendall(HEADER.pack(HANDOFF_MAGIC, HANDOFF_VERSION, len(fds), len(data)))
+        for start in range(0, len(fds), FDS_PER_MESSAGE):
+            socket.send_fds(self.sock, [FD_MARKER], fds[start:start + FDS_PER_MESSAGE])
+        self.sock.sendall(data)
+
+    def receive_state(self):
+        """Returns (snapshot, descriptors) as sent by send_state()."""
+        magic, version, fd_count, length = HEADER.unpack(self.receive_exactly(HEADER.size))
+        if magic != HANDOFF_MAGIC or version != HANDOFF_VERSION:
+            raise HandoffError(f"Expected a version {HANDOFF_VERSION} handoff")
+        fds = []
+        try:
+            while len(fds) < fd_count:
+                marker, received, flags, _ = socket.recv_fds(self.sock, 1, FDS_PER_MESSAGE)
+                fds.extend(received)
+                if marker != FD_MARKER or flags & socket.MSG_CTRUNC:
+                    raise HandoffError(f"Descriptor transfer cut short after {len(fds)} of {fd_count} "
+                                       "(is the open file limit lower than the old server's?)")
+            snapshot = json.loads(self.receive_exactly(length))
+        except BaseException:
+            for fd in fds:
+                os.close(fd)
+            raise
+        return snapshot, fds
+
+    def receive_exactly(self, size):
+        data = bytearray()
+        while len(data) < size:
+            chunk = self.sock.recv(size - len(data))
+            if not chunk:
+                raise HandoffError("Connection closed during the handoff")
+            data += chunk
+        return bytes(data)
+
+    def wait_ack(self):
+        """Returns True once the successor confirmed the takeover, False if it failed or went silent."""
+        try:
+            return self.sock.recv(1) == ACK
+        except OSError:
+            return False
+
+    def close(self):
+        self.sock.close()
+
+
+class Takeover:
+    """What a successor received: the predecessor's snapshot and the sockets it refers to."""
+    def __init__(self, channel, snapshot, sockets):
+        self.channel = channel
+        self.snapshot = snapshot
+        self.sockets = sockets
+        self.received = time.perf_counter()
+        self.after_exit = None # (callable, args) to run once the predecessor is gone
+
+    def when_predecessor_exits(self, callback, *args):
+        """Defers callback(*args), e.g. binding the metrics port the predecessor still holds."""
+        self.after_exit = (callback, args)
+
+    def complete(self, metrics):
+        """Tells the predecessor to exit; call once the state is rebuilt, before serving anything."""
+        try:
+            self.channel.sock.sendall(ACK)
+        except OSError as e:
+            raise SystemExit(f"Predecessor gave up on the handoff before it was confirmed: {e}")
+        pause = time.time() - self.snapshot["paused_at"]
+        metrics.handoff_pause.observe(pause)
+        log.info(f"Took over {len(self.snapshot['sessions'])} sessions and {len(self.sockets)} sockets from pid "
+                 f"{self.snapshot['pid']}: restore {(time.perf_counter() - self.received) * 1000:.1f} ms, "
+                 f"clients paused {pause * 1000:.1f} ms")
+        threading.Thread(target=self._wait_for_exit, name="handoff-exit", daemon=True).start()
+
+    def _wait_for_exit(self):
+        self.channel.sock.settimeout(None)
+        try:
+            while self.channel.sock.recv(1):
+                pass
+        except OSError:
+            pass
+        self.channel.close() # EOF: the predecessor's descriptors are closed
+        if self.after_exit is not None:
+            callback, args = self.after_exit
+            callback(*args)
+
+
+def accept_successor(listener):
+    """Accepts a successor on the handoff listener. Returns its HandoffChannel, or None."""
+    try:
+        sock, _ = listener.accept()
+    except (BlockingIOError, InterruptedError):
+        return None
+    except OSError as e:
+        log.error(f"Error accepting a successor: {e}")
+        return None
+    channel = HandoffChannel(sock)
+    try:
+        magic, pid = HELLO.unpack(channel.receive_exactly(HELLO.size))
+        if magic != HANDOFF_MAGIC:
+            raise HandoffError("Not a handoff request")
+    except (OSError, HandoffError) as e:
+        log.error(f"Ignoring connection on the handoff socket: {e}")
+        channel.close()
+        return None
+    channel.peer_pid = pid
+    log.info(f"Successor pid {pid} connected, handing over")
+    return channel
+
+
+def hand_off(channel, listener, snapshot_state, paused_at):
+    """Passes everything to the successor and waits until it has taken over.
+
+    snapshot_state() runs with the server paused and returns (snapshot dict,
+    sockets); paused_at is the time.time() at which clients stopped being served.
+    Returns True once the successor confirmed (call exit_after_handoff() next),
+    False if the server must resume.
+    """
+    started = time.perf_counter()
+    try:
+        snapshot, sockets = snapshot_state()
+    except Exception as e:
+        log.error(f"Could not snapshot the sessions for pid {channel.peer_pid}, resuming: {e}")
+        channel.close()
+        return False
+    snapshot["paused_at"] = paused_at
+    snapshot["pid"] = os.getpid()
+    fds = [listener.fileno()] + [sock.fileno() for sock in sockets]
+    prepared = time.perf_counter()
+    try:
+        channel.send_state(snapshot, fds)
+        confirmed = channel.wait_ack()
+    except OSError as e:
+        log.error(f"Handoff to pid {channel.peer_pid} failed: {e}")
+        confirmed = False
+    if not confirmed:
+        log.error(f"Successor pid {channel.peer_pid} did not take over, resuming")
+        channel.close()
+        return False
+    log.info(f"Handed off {len(snapshot['sessions'])} sessions and {len(sockets)} sockets to pid {channel.peer_pid}: "
+             f"snapshot {(prepared - started) * 1000:.1f} ms, transfer and restore "
+             f"{(time.perf_counter() - prepared) * 1000:.1f} ms, clients paused {(time.time() - paused_at) * 1000:.1f} ms")
+    return True
+
+
+def exit_after_handoff():
+    """Ends the old process; its sockets stay open in the successor, so no client sees a close."""
+    log.flush()
+    os._exit(0)
+
+
+# --- Snapshot Helpers ---
+# The parts of a snapshot both servers share. Bytes travel as base64 strings.
+
+def encode_bytes(data):
+    return base64.b64encode(data).decode("ascii")
+
+
+def decode_bytes(text):
+    return base64.b64decode(text)
+
+
+def snapshot_session(session):
+    """The Session fields (see sessions.py) as JSON data; each server adds its own."""
+    buckets = session.buckets
+    return {"addr": list(session.addr), "state": int(session.state), "display_name": session.display_name,
+            "current_channel": session.current_channel,
+            "buckets": {kind: [bucket.tokens, bucket.updated] for kind, bucket in buckets.items()} if buckets else None}
+
+
+def restore_session(session, data):
+    session.state = SessionState(data["state"])
+    session.display_name = data["display_name"]
+    session.current_channel = data["current_channel"]
+    if session.buckets and data["buckets"]: # Limits are the successor's; only the fill levels carry over
+        for kind, (tokens, updated) in data["buckets"].items():
+            bucket = session.buckets.get(kind)
+            if bucket is not None:
+                bucket.tokens = min(tokens, bucket.burst)
+                bucket.updated = updated
+
+
+def snapshot_channels(registry, position):
+    """Membership as [channel_id, [index into the snapshot's sessions...]] pairs, in join order."""
+    with registry.lock:
+        return [[channel_id, [position[member] for member in members if member in position]]
+                for channel_id, members in registry.channels.items()]
+
+
+def restore_channels(registry, data, sessions):
+    for channel_id, indexes in data:
+        for index in indexes:
+            registry.join(sessions[index], channel_id)
+
+
+def snapshot_history(history, transport):
+    if history is None:
+        return None
+    with history.lock:
+        return [[channel_id, [[entry.display_name, entry.content, encode_bytes(entry.frames[transport])]
+                              for entry in entries if transport in entry.frames]]
+                for channel_id, entries in history.channels.items()]
+
+
+def restore_history(history, data, transport):
+    if history is None or not data:
+        return
+    for channel_id, entries in data:
+        for display_name, content, frame in entries:
+            history.record(channel_id, display_name, content, transport, decode_bytes(frame))
+
+
+def listen_for_successor(path):
+    """Binds the handoff listener at path, replacing a stale socket file left by a dead server."""
+    if os.path.exists(path):
+        os.unlink(path)
+    listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    listener.bind(path)
+    listener.listen(1)
+    listener.setblocking(False)
+    log.info(f"Accepting a successor process on {path}")
+    return listener
+
+
+def add_handoff_arguments(parser):
+    """Adds the live handoff option shared by the test servers to an argparse parser."""
+    group = parser.add_argument_group("live handoff")
+    group.add_argument("--handoff", metavar="PATH", default=None,
+                       help="Unix socket for zero-downtime restarts: take over from the server listening there, "
+                            "if any, then listen there for a successor")
+
+def handoff_from_args(args, transport):
+    """Returns (listener, Takeover or None), or (None, None) when --handoff is not given.
+
+    When a server is listening on the path already, this blocks until its
+    snapshot and sockets have arrived; the caller rebuilds its state from the
+    Takeover and calls complete() before it serves anything.
+    """
+    if not args.handoff:
+        return None, None
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(args.handoff)
+    except (FileNotFoundError, ConnectionRefusedError):
+        sock.close()
+        return listen_for_successor(args.handoff), None
+    channel = HandoffChannel(sock)
+    try:
+        sock.sendall(HELLO.pack(HANDOFF_MAGIC, os.getpid()))
+        snapshot, fds = channel.receive_state()
+    except (OSError, HandoffError, ValueError) as e:
+        raise SystemExit(f"Could not take over from the server on {args.handoff}: {e}")
+    sockets = [socket.socket(fileno=fd) for fd in fds]
+    if snapshot.get("transport") != transport:
+        for sock in sockets:
+            sock.close()
+        raise SystemExit(f"The server on {args.handoff} is a {snapshot.get('transport')} server, not {transport}")
+    listener = sockets[0]
+    listener.setblocking(False)
+    return listener, Takeover(channel, snapshot, sockets[1:])
@@ -0,0 +1,132 @@
+import array
+import enum
+
+# --- Session Records ---
+# Shared by tcp_server.py and udp_server.py. A session is a __slots__ object
+# (no per-instance __dict__), its protocol state a small IntEnum, and the
+# servers keep sessions in a SessionTable, which also stores each session's
+# last-activity time in a float64 array column (8 bytes, instead of a float
+# object per session that is reallocated on every update). Nothing on the
+# common path allocates a dict or set per session: per-message state that used
+# to be a dict is either a pair of slots or created only while it is non-empty.
+# TCP never looks a session up by address or tracks its activity (a closed
+# socket ends the session), so tcp_server.py keeps its sessions in a SessionSet,
+# which has neither the address index nor the activity column.
+# bench_sessions.py measures bytes per session against the previous classes.
+
+
+class SessionState(enum.IntEnum):
+    NEEDS_AUTH = 0
+    WAITING_REPLY_CONFIRM = 1 # UDP: REPLY to AUTH sent, its CONFIRM not yet received
+    AUTHENTICATED = 2
+    SENT_ERR = 3 # UDP: torn down once the final message is confirmed
+    SENT_BYE = 4
+
+
+class Session:
+    """Protocol state common to a TCP connection and a UDP session."""
+    __slots__ = ("addr", "state", "display_name", "current_channel", "buckets", "slot")
+
+    def __init__(self, addr):
+        self.addr = addr # (ip, port) of the client
+        self.state = SessionState.NEEDS_AUTH
+        self.display_name = None
+        self.current_channel = "default" # Initial channel after auth
+        self.buckets = None # Token buckets by message type, see rate_limit.py
+        self.slot = -1 # Index into the SessionTable's columns while the session is in one
+
+
+class SessionTable:
+    """Sessions keyed by client address, plus compact per-session columns.
+
+    The servers use only the methods below, so another table (sharded,
+    persistent, instrumented...) can be plugged in by providing the same ones.
+    Not thread-safe: the servers call it under their own session lock.
+    """
+    def __init__(self):
+        self.sessions = {} # Key: session key, Value: Session
+        self.activity = array.array('d') # Last-activity time by slot
+        self.free_slots = [] # Slots of removed sessions, reused before the columns grow
+
+    def add(self, key, session, now):
+        if self.free_slots:
+            slot = self.free_slots.pop()
+            self.activity[slot] = now
+        else:
+            slot = len(self.activity)
+            self.activity.append(now)
+        session.slot = slot
+        self.sessions[key] = session
+
+    def get(self, key):
+        return self.sessions.get(key)
+
+    def remove(self, key):
+        """Removes and returns the session stored under key, or None."""
+        session = self.sessions.pop(key, None)
+        if session is not None and session.slot >= 0:
+            self.free_slots.append(session.slot)
+            session.slot = -1 # Late touches of a removed session must not hit a reused slot
+        return session
+
+    def touch(self, session, now):
+        if session.slot >= 0:
+            self.activity[session.slot] = now
+
+    def last_activity(self, session):
+        return self.activity[session.slot] if session.slot >= 0 else None
+
+    def clear(self):
+        for session in self.sessions.values():
+            session.slot = -1
+        self.sessions.clear()
+        del self.activity[:]
+        self.free_slots.clear()
+
+    def values(self):
+        return self.sessions.values()
+
+    def count_by_state(self, states=SessionState):
+        """Returns {state name: count}, including zero counts for the given states."""
+        return count_by_state(self.sessions.values(), states)
+
+    def __contains__(self, key):
+        return key in self.sessions
+
+    def __len__(self):
+        return len(self.sessions)
+
+
+class SessionSet:
+    """Sessions by membership only, for a server that neither looks them up by key nor tracks activity.
+
+    Not thread-safe: the server calls it under its own session lock.
+    """
+    def __init__(self):
+        self.sessions = set()
+
+    def add(self, session):
+        self.sessions.add(session)
+
+    def remove(self, session):
+        self.sessions.discard(session)
+
+    def values(self):
+        return self.sessions
+
+    def count_by_state(self, states=SessionState):
+        """Returns {state name: count}, including zero counts for the given states."""
+        return count_by_state(self.sessions, states)
+
+    def __contains__(self, session):
+        return session in self.sessions
+
+    def __len__(self):
+        return len(self.sessions)
+
+
+def count_by_state(sessions, states):
+    counts = [0] * len(SessionState)
+    for session in sessions:
+        counts[session.state] += 1
+    return {state.name: counts[state] for state in SessionState if state in states or counts[state]}
@@ -0,0 +1,238 @@
+import asyncio
+import collections
+import errno
+import selectors
+
+# --- Simulated Time and Network ---
+# Runs udp_server.py and the load_generator.py clients in one process against a
+# virtual clock, so hours of keepalives, expiries and retransmissions take as
+# long as the CPU work they cause. As in udp_impairment.py, a clock is any
+# zero-argument callable returning seconds: time.time in production, a
+# VirtualClock here. Virtual time only moves when nothing is runnable: the event
+# loop then jumps straight to its next scheduled callback instead of sleeping.
+# Datagrams travel through an in-memory SimulatedNetwork with a fixed one-way
+# latency, delivered through the same loop, so a run is fully determined by its
+# seeds and inputs and repeats exactly. See udp_soak.py for the wiring.
+
+EPHEMERAL_PORTS = 49152 # First port handed out for bind(port 0)
+LOCALHOST = "127.0.0.1"
+
+
+class VirtualClock:
+    """A clock that only moves when told to."""
+    __slots__ = ("now",)
+
+    def __init__(self, start=0.0):
+        self.now = start
+
+    def __call__(self):
+        return self.now
+
+    def advance(self, seconds):
+        self.now += seconds
+
+
+class VirtualSelector(selectors.DefaultSelector):
+    """Event loop selector that advances the clock instead of blocking.
+
+    Real file descriptors (the loop's own self-pipe) are still polled, without waiting.
+    """
+    def __init__(self, clock):
+        super().__init__()
+        self.clock = clock
+
+    def select(self, timeout=None):
+        ready = super().select(0)
+        if ready or timeout == 0:
+            return ready
+        if timeout is None:
+            raise RuntimeError("Simulation deadlock: nothing is scheduled and nothing can become ready")
+        self.clock.advance(timeout)
+        return []
+
+
+class SimulatedEventLoop(asyncio.SelectorEventLoop):
+    """asyncio loop on a VirtualClock whose datagram endpoints live on a SimulatedNetwork."""
+    def __init__(self, clock=None, latency=0.0):
+        self.clock = clock or VirtualClock()
+        super().__init__(VirtualSelector(self.clock))
+        self.network = SimulatedNetwork(self, latency)
+
+    def time(self):
+        return self.clock.now
+
+    async def create_datagram_endpoint(self, protocol_factory, local_addr=None, remote_addr=None, **kwargs):
+        protocol = protocol_factory()
+        transport = SimDatagramTransport(self.network, protocol, local_addr or ("0.0.0.0", 0), remote_addr)
+        protocol.connection_made(transport)
+        return transport, protocol
+
+
+class SimulatedNetwork:
+    """In-memory UDP between the endpoints bound on it; every datagram takes latency seconds."""
+    def __init__(self, loop, latency=0.0):
+        self.loop = loop
+        self.latency = latency
+        self.endpoints = {} # Key: (host, port), Value: SimSocket or SimDatagramTransport
+        self.next_port = EPHEMERAL_PORTS
+        self.in_flight = collections.deque() # (arrival time, destination, data, source), in send order
+        self.sent = 0
+        self.undeliverable = 0 # Datagrams to an address nobody is bound to (ICMP unreachable in real life)
+
+    def bind(self, endpoint, addr):
+        host, port = addr
+        host = LOCALHOST if host in ("", "0.0.0.0") else host
+        if port == 0:
+            while (host, self.next_port) in self.endpoints:
+                self.next_port += 1
+            port = self.next_port
+            self.next_port += 1
+        if (host, port) in self.endpoints:
+            raise OSError(errno.EADDRINUSE, "Address already in use")
+        self.endpoints[(host, port)] = endpoint
+        return (host, port)
+
+    def unbind(self, addr):
+        self.endpoints.pop(addr, None)
+
+    def send(self, data, source, destination):
+        # Datagrams queue here rather than as separate loop timers: asyncio does not keep
+        # timers with equal deadlines in FIFO order, and the network must not reorder
+        self.sent += 1
+        if not self.in_flight:
+            self.loop.call_at(self.loop.time() + self.latency, self._arrive)
+        self.in_flight.append((self.loop.time() + self.latency, destination, bytes(data), source))
+
+    def _arrive(self):
+        in_flight = self.in_flight
+        now = self.loop.time()
+        while in_flight and in_flight[0][0] <= now:
+            _, destination, data, source = in_flight.popleft()
+            endpoint = self.endpoints.get(destination) # Looked up on arrival, as the port may have closed meanwhile
+            if endpoint is None:
+                self.undeliverable += 1
+            else:
+                endpoint.receive(data, source)
+        if in_flight:
+            self.loop.call_at(in_flight[0][0], self._arrive)
+
+    def socket(self, family=None, kind=None):
+        """Drop-in for socket.socket(AF_INET, SOCK_DGRAM), for the server side."""
+        return SimSocket(self)
+
+
+class SimSocket:
+    """Non-blocking UDP socket on a SimulatedNetwork, driven through a SimSelector."""
+    def __init__(self, network):
+        self.network = network
+        self.addr = None
+        self.queue = collections.deque() # Received (data, source address)
+        self.on_readable = None # Set while registered with a SimSelector
+        self.notified = False
+
+    def bind(self, addr):
+        self.addr = self.network.bind(self, addr)
+
+    def setblocking(self, flag):
+        pass
+
+    def setsockopt(self, *args):
+        pass
+
+    def fileno(self):
+        return -1 if self.addr is None else self.addr[1]
+
+    def getsockname(self):
+        return self.addr
+
+    def sendto(self, data, addr):
+        if self.addr is None:
+            self.bind(("", 0))
+        self.network.send(data, self.addr, addr)
+        return len(data)
+
+    def recvfrom(self, bufsize):
+        if not self.queue:
+            raise BlockingIOError(errno.EAGAIN, "No datagram queued")
+        data, source = self.queue.popleft()
+        return data[:bufsize], source
+
+    def receive(self, data, source):
+        if self.addr is None:
+            return # Closed while the datagram was in flight
+        self.queue.append((data, source))
+        self._notify()
+
+    def _notify(self):
+        if self.on_readable is not None and not self.notified:
+            self.notified = True
+            self.network.loop.call_soon(self._readable)
+
+    def _readable(self):
+        self.notified = False
+        if self.on_readable is not None and self.queue:
+            self.on_readable(self)
+            if self.queue:
+                self._notify() # Level-triggered, like epoll: come back for what the handler left
+
+    def close(self):
+        if self.addr is not None:
+            self.network.unbind(self.addr)
+            self.addr = None
+        self.queue.clear()
+        self.on_readable = None
+
+
+class SimSelector:
+    """Stands in for the server's selectors.DefaultSelector over SimSockets.
+
+    Instead of being polled, it calls on_readable(sock, data) from the event
+    loop whenever a registered socket has datagrams queued.
+    """
+    def __init__(self, on_readable):
+        self.on_readable = on_readable
+
+    def register(self, sock, events, data=None):
+        sock.on_readable = lambda ready: self.on_readable(ready, data)
+        if sock.queue:
+            sock._notify()
+
+    def unregister(self, sock):
+        sock.on_readable = None
+
+    def close(self):
+        pass
+
+
+class SimDatagramTransport(asyncio.DatagramTransport):
+    """What SimulatedEventLoop.create_datagram_endpoint() hands to a DatagramProtocol."""
+    def __init__(self, network, protocol, local_addr, remote_addr=None):
+        super().__init__()
+        self.network = network
+        self.protocol = protocol
+        self.remote_addr = remote_addr
+        self.addr = network.bind(self, local_addr)
+        self.closing = False
+
+    def sendto(self, data, addr=None):
+        if not self.closing:
+            self.network.send(data, self.addr, addr or self.remote_addr)
+
+    def receive(self, data, source):
+        if not self.closing:
+            self.protocol.datagram_received(data, source)
+
+    def get_extra_info(self, name, default=None):
+        return self.addr if name == "sockname" else default
+
+    def is_closing(self):
+        return self.closing
+
+    def close(self):
+        if not self.closing:
+            self.closing = True
+            self.network.unbind(self.addr)
+            self.network.loop.call_soon(self.protocol.connection_lost, None)
+
+    def abort(self):
+        self.close()
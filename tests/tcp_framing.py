@@ -0,0 +1,61 @@
+# --- Incremental CRLF Framing for the TCP Receive Path ---
+# Replaces the "str buffer += chunk; split(CRLF, 1)" loop, which rescans and
+# copies the whole buffer for every message. Here every byte is scanned once
+# and copied once (into the decoded line), so the cost is linear in input size
+# no matter how the peer splits or pipelines its messages.
+
+CRLF = "\r\n"
+CRLF_BYTES = CRLF.encode()
+DEFAULT_MAX_LINE_LENGTH = 65536 # A 60000 char MSG plus its "MSG FROM ... IS " prefix fits
+
+
+class LineTooLongError(ValueError):
+    """Raised when a peer sends more than max_line_length bytes without a CRLF."""
+
+
+class LineFramer:
+    """Splits a TCP byte stream into CRLF-terminated lines."""
+    def __init__(self, max_line_length=DEFAULT_MAX_LINE_LENGTH, encoding='us-ascii'):
+        self.max_line_length = max_line_length
+        self.encoding = encoding
+        self.buffer = bytearray()
+        self.scan_from = 0 # Bytes before this offset are known not to start a CRLF
+
+    def feed(self, data):
+        """Appends received bytes and returns the list of complete decoded lines.
+
+        Raises UnicodeDecodeError for a line that is not valid in the encoding
+        and LineTooLongError when a line exceeds max_line_length.
+        """
+        buffer = self.buffer
+        buffer += data
+        end = buffer.find(CRLF_BYTES, self.scan_from)
+        if end < 0:
+            # Fast path for a partial line: nothing to decode, just remember where to resume
+            self._check_pending(len(buffer))
+            return []
+
+        lines = []
+        start = 0
+        max_line_length = self.max_line_length
+        encoding = self.encoding
+        with memoryview(buffer) as view:
+            while end >= 0:
+                if end - start > max_line_length:
+                    raise LineTooLongError(f"Line of {end - start} bytes exceeds {max_line_length}")
+                lines.append(str(view[start:end], encoding))
+                start = end + 2
+                end = buffer.find(CRLF_BYTES, start)
+
+        del buffer[:start] # bytearray drops a prefix without moving the remainder on every call
+        self._check_pending(len(buffer))
+        return lines
+
+    def _check_pending(self, pending):
+        if pending > self.max_line_length:
+            raise LineTooLongError(f"Partial line of {pending} bytes exceeds {self.max_line_length}")
+        # Keep the last byte scannable in case it is the CR of a CRLF split across chunks
+        self.scan_from = pending - 1 if pending else 0
+
+    def pending_bytes(self):
+        return len(self.buffer)
@@ -0,0 +1,73 @@
+import re
+
+# --- IPK25-CHAT TCP Grammar ---
+# Single-pass parser for the text protocol. The keyword is read once from the
+# start of the line, upper-cased (keywords are case-insensitive in the grammar)
+# and looked up in a table that jumps straight to the command's field pattern,
+# instead of trying one anchored regex per command in turn. Fields are checked
+# against the ABNF character classes:
+#   ID      = 1*20  (ALPHA / DIGIT / "_" / "-")     username, channel
+#   SECRET  = 1*128 (ALPHA / DIGIT / "_" / "-")
+#   DNAME   = 1*20  VCHAR                           display name
+#   CONTENT = 1*60000 (VCHAR / SP / LF)
+# Separators are runs of whitespace, as before. The field patterns are plain
+# regexes matched from the end of the keyword: under CPython a compiled pattern
+# beats splitting and checking tokens in Python. Sub-keywords (AS, USING, FROM,
+# IS, OK/NOK) are spelled as case-insensitive character classes rather than with
+# re.IGNORECASE, which would slow every character class down. CONTENT is taken
+# with a DOTALL ".", then checked in one bytes.translate() pass, which is several
+# times faster than a regex character class over long messages.
+
+MAX_KEYWORD_LENGTH = 5 # "REPLY"
+CONTENT_BYTES = bytes(range(0x20, 0x7F)) + b"\n" # VCHAR / SP / LF
+ENCODING = 'us-ascii'
+
+
+def _word(word):
+    return "".join(f"[{char.upper()}{char.lower()}]" for char in word)
+
+_ID = r"([a-zA-Z0-9_-]{1,20})"
+_SECRET = r"([a-zA-Z0-9_-]{1,128})"
+_DNAME = r"([\x21-\x7E]{1,20})"
+_CONTENT = r"(.{1,60000})"
+
+# Key: keyword, Value: fullmatch of the rest of the line, starting at the separator after the keyword
+FIELD_PATTERNS = {
+    "AUTH": re.compile(rf"\s+{_ID}\s+{_word('AS')}\s+{_DNAME}\s+{_word('USING')}\s+{_SECRET}").fullmatch,
+    "JOIN": re.compile(rf"\s+{_ID}\s+{_word('AS')}\s+{_DNAME}").fullmatch,
+    "MSG": re.compile(rf"\s+{_word('FROM')}\s+{_DNAME}\s+{_word('IS')}\s+{_CONTENT}", re.DOTALL).fullmatch,
+    "ERR": re.compile(rf"\s+{_word('FROM')}\s+{_DNAME}\s+{_word('IS')}\s+{_CONTENT}", re.DOTALL).fullmatch,
+    "BYE": re.compile(rf"\s+{_word('FROM')}\s+{_DNAME}").fullmatch,
+    "REPLY": re.compile(rf"\s+({_word('OK')}|{_word('NOK')})\s+{_word('IS')}\s+{_CONTENT}", re.DOTALL).fullmatch,
+}
+FREE_TEXT_COMMANDS = frozenset(("MSG", "ERR", "REPLY")) # Last field is CONTENT
+
+
+def is_content(value):
+    # Deleting every allowed byte must leave nothing
+    return value.isascii() and not value.encode(ENCODING).translate(None, CONTENT_BYTES)
+
+
+def parse_command(line):
+    """Returns (KEYWORD, fields) for one line without CRLF.
+
+    KEYWORD is the upper-cased command keyword ("" for an empty line or one
+    starting with whitespace); only keys of FIELD_PATTERNS are known commands.
+    fields is the tuple of the command's values in protocol order (REPLY gives
+    the result as sent, e.g. "ok"), or None if the keyword is unknown or the line
+    does not match the command's grammar.
+    """
+    if not line or line[0].isspace():
+        return "", None
+    # The keyword is short, so only the start of the line is split
+    keyword = line[:MAX_KEYWORD_LENGTH + 1].split(None, 1)[0].upper()
+    match = FIELD_PATTERNS.get(keyword)
+    if match is None:
+        return keyword, None
+    match = match(line, len(keyword))
+    if match is None:
+        return keyword, None
+    fields = match.groups()
+    if keyword in FREE_TEXT_COMMANDS and not is_content(fields[-1]):
+        return keyword, None
+    return keyword, fields
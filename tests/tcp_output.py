@@ -0,0 +1,334 @@
+import abc
+import asyncio
+import collections
+import itertools
+import selectors
+import socket
+import threading
+
+# --- Per-connection Output Buffering ---
+# Every line the server sends to a TCP client goes through an output buffer
+# instead of a blocking sendall(). Lines queued while a chunk of input is being
+# processed, or while the socket is not writable, leave in a single
+# sendmsg()/write call. Queued bytes are bounded by high/low watermarks, and a
+# client that does not read is handled by the slow-consumer policy:
+#   drop       - discard new lines above the high watermark until the queue drains below the low one
+#   disconnect - send ERR (best effort) and close the connection
+#   pause      - stop reading from that client until its queue drains below the low watermark;
+#                lines from other clients are still queued, up to PAUSE_HARD_LIMIT x high
+# No policy ever blocks the thread or coroutine that produced the line, so one
+# stalled client cannot hold up a broadcast to the rest of its channel.
+# when_written(callback) runs callback once what is queued so far has been
+# written, e.g. to time a traced MSG up to the recipient's socket; callbacks of
+# lines that are dropped or never written are discarded.
+
+SLOW_CONSUMER_POLICIES = ("drop", "disconnect", "pause")
+DEFAULT_HIGH_WATER = 256 * 1024 # Bytes
+DEFAULT_LOW_WATER = 64 * 1024
+PAUSE_HARD_LIMIT = 4 # Multiple of the high watermark after which "pause" disconnects anyway
+MAX_IOVECS = 64 # Buffers handed to one sendmsg() call
+MAX_COALESCE = 64 * 1024 # Bytes collected for one write before flushing early (capped by the low watermark)
+CLOSE_LINGER = 2.0 # Seconds a closing connection may spend sending its last queued lines
+DRAIN_POLL = 0.5 # Seconds between checks for a closed connection while a reader is paused
+
+
+class OutputLimits:
+    """Watermarks and slow-consumer policy shared by all connections of a server."""
+    def __init__(self, high_water=DEFAULT_HIGH_WATER, low_water=DEFAULT_LOW_WATER, policy="pause"):
+        if policy not in SLOW_CONSUMER_POLICIES:
+            raise ValueError(f"Unknown slow-consumer policy '{policy}'")
+        if not 0 <= low_water <= high_water:
+            raise ValueError("Output watermarks must satisfy 0 <= low <= high")
+        self.high_water = high_water
+        self.low_water = low_water
+        self.policy = policy
+
+
+class OutputBuffer(abc.ABC):
+    """Watermark bookkeeping common to the threaded and asyncio writers.
+
+    on_event(action) is called with "drop" for each discarded line and with
+    "disconnect" when the connection is closed for not reading.
+    """
+    def __init__(self, limits, overflow_message, on_event=None):
+        self.limits = limits
+        self.overflow_message = overflow_message # Encoded ERR line sent before a forced close
+        self.on_event = on_event
+        self.dropping = False # "drop" policy: above high, not yet back below low
+        self.closed = False
+        self.written_callbacks = None # Run once the queue has been written out, see when_written()
+        # Coalesced but not yet written bytes must not count as a slow consumer on their own
+        self.coalesce_limit = max(min(MAX_COALESCE, limits.low_water), 1)
+
+    def _admit(self, size, backlog):
+        """Decides whether a line of size bytes may be queued behind backlog bytes."""
+        limits = self.limits
+        if self.dropping:
+            if backlog > limits.low_water:
+                self._event("drop")
+                return False
+            self.dropping = False
+        if backlog + size <= limits.high_water:
+            return True
+        if limits.policy == "drop":
+            self.dropping = True
+            self._event("drop")
+            return False
+        if limits.policy == "pause" and backlog + size <= limits.high_water * PAUSE_HARD_LIMIT:
+            return True # The owner's reader stops; other producers keep queueing up to the hard limit
+        self._event("disconnect")
+        self._overflow()
+        return False
+
+    def _run_written(self):
+        callbacks, self.written_callbacks = self.written_callbacks, None
+        for callback in callbacks:
+            callback()
+
+    def _event(self, action):
+        if self.on_event is not None:
+            self.on_event(action)
+
+    @abc.abstractmethod
+    def _overflow(self):
+        """Sends overflow_message (best effort) and closes the connection."""
+
+
+class SocketOutput(OutputBuffer):
+    """Threaded engine: queues lines for a blocking socket and sends them with non-blocking sendmsg().
+
+    Any thread may write(). The connection's own thread corks the buffer while it
+    processes a chunk of input, so all replies to that chunk leave in one call.
+    Whatever the socket cannot take right away is finished by the shared
+    OutputPump thread once the socket becomes writable.
+    """
+    def __init__(self, sock, pump, limits, overflow_message, on_event=None):
+        super().__init__(limits, overflow_message, on_event)
+        self.sock = sock
+        self.pump = pump
+        self.lock = threading.Lock()
+        self.chunks = collections.deque()
+        self.queued = 0
+        self.corked = False
+        self.waiting = False # Handed to the pump, which flushes when the socket is writable
+        self.drained = threading.Event() # Set while queued <= low watermark
+        self.drained.set()
+
+    def write(self, data):
+        with self.lock:
+            if self.closed or not self._admit(len(data), self.queued):
+                return
+            self.chunks.append(data)
+            self.queued += len(data)
+            if self.queued > self.limits.low_water:
+                self.drained.clear()
+            if not self.waiting and (not self.corked or self.queued >= self.coalesce_limit):
+                self._flush_locked()
+
+    def cork(self):
+        with self.lock:
+            self.corked = True
+
+    def uncork(self):
+        with self.lock:
+            self.corked = False
+            if not self.waiting and not self.closed:
+                self._flush_locked()
+
+    def when_written(self, callback):
+        with self.lock:
+            if self.chunks:
+                if self.written_callbacks is None:
+                    self.written_callbacks = []
+                self.written_callbacks.append(callback)
+                return
+        if not self.closed:
+            callback()
+
+    def wait_drained(self):
+        """Blocks the connection's own reader while its queue is above the low watermark ("pause")."""
+        while not self.drained.wait(DRAIN_POLL):
+            if self.closed:
+                return
+
+    def on_writable(self):
+        """Pump callback. Returns True if the socket should stay watched."""
+        with self.lock:
+            self.waiting = False
+            if not self.closed:
+                self._flush_locked()
+            return self.waiting
+
+    def close(self):
+        """Sends what is still queued (bounded by CLOSE_LINGER) and stops accepting lines."""
+        with self.lock:
+            if self.closed:
+                return
+            self.closed = True
+            self.written_callbacks = None
+            pending = b"".join(self.chunks)
+            self.chunks.clear()
+            self.queued = 0
+            self.drained.set()
+        if pending:
+            try:
+                self.sock.settimeout(CLOSE_LINGER)
+                self.sock.sendall(pending)
+            except OSError:
+                pass # Peer gone or not reading; nothing more to do
+
+    def _flush_locked(self):
+        chunks = self.chunks
+        while chunks:
+            batch = list(itertools.islice(chunks, MAX_IOVECS))
+            try:
+                sent = self.sock.sendmsg(batch, [], socket.MSG_DONTWAIT)
+            except BlockingIOError:
+                break # Socket buffer full
+            except OSError:
+                self._discard_locked() # Connection is broken; the reader thread will notice and close
+                return
+            self.queued -= sent
+            complete = sent == sum(len(chunk) for chunk in batch)
+            while sent:
+                head = chunks[0]
+                if sent >= len(head):
+                    chunks.popleft()
+                    sent -= len(head)
+                else:
+                    chunks[0] = memoryview(head)[sent:] # Partial write: keep the unsent tail
+                    sent = 0
+            if not complete:
+                break # Socket buffer full
+        if self.queued <= self.limits.low_water:
+            self.drained.set()
+        if not chunks and self.written_callbacks:
+            self._run_written()
+        if chunks and not self.waiting:
+            self.waiting = True
+            self.pump.watch(self)
+
+    def _discard_locked(self):
+        self.closed = True
+        self.written_callbacks = None
+        self.chunks.clear()
+        self.queued = 0
+        self.drained.set()
+
+    def _overflow(self):
+        # Called with self.lock held, possibly from another client's thread
+        self._discard_locked()
+        try:
+            self.sock.send(self.overflow_message, socket.MSG_DONTWAIT)
+        except OSError:
+            pass # Best effort: the client is not reading anyway
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR) # Wakes the connection's reader, which closes it
+        except OSError:
+            pass
+
+
+class OutputPump:
+    """One thread finishing partial writes for every SocketOutput whose socket was full."""
+    def __init__(self):
+        self.selector = selectors.DefaultSelector()
+        self.lock = threading.Lock()
+        self.pending = [] # Outputs to start watching, handed over from other threads
+        self.wake_reader, self.wake_writer = socket.socketpair()
+        self.wake_reader.setblocking(False)
+        self.selector.register(self.wake_reader, selectors.EVENT_READ, None)
+        threading.Thread(target=self._run, name="output-pump", daemon=True).start()
+
+    def watch(self, output):
+        with self.lock:
+            self.pending.append(output)
+        try:
+            self.wake_writer.send(b"\0", socket.MSG_DONTWAIT)
+        except BlockingIOError:
+            pass # Already woken
+
+    def _run(self):
+        while True:
+            for key, _ in self.selector.select():
+                if key.data is None:
+                    try:
+                        while self.wake_reader.recv(4096):
+                            pass
+                    except BlockingIOError:
+                        pass
+                    continue
+                self.selector.unregister(key.fileobj)
+                output = key.data
+                if output.on_writable():
+                    self._register(output)
+            with self.lock:
+                pending, self.pending = self.pending, []
+            for output in pending:
+                self._register(output)
+
+    def _register(self, output):
+        fd = output.sock.fileno()
+        if fd < 0:
+            return # Connection closed meanwhile
+        stale = self.selector.get_map().get(fd)
+        if stale is not None:
+            self.selector.unregister(stale.fileobj) # A closed connection's fd was reused
+        self.selector.register(output.sock, selectors.EVENT_WRITE, output)
+
+
+class TransportOutput(OutputBuffer):
+    """Asyncio engine: collects the lines of one loop iteration and writes them to the transport at once.
+
+    The transport's own buffer holds what the socket could not take; its size
+    counts towards the watermarks, and set_write_buffer_limits() makes
+    StreamWriter.drain() pause the connection's reader ("pause").
+    """
+    def __init__(self, transport, limits, overflow_message, on_event=None):
+        super().__init__(limits, overflow_message, on_event)
+        self.transport = transport
+        self.loop = asyncio.get_running_loop()
+        self.chunks = []
+        self.pending = 0
+        transport.set_write_buffer_limits(high=limits.high_water, low=limits.low_water)
+
+    def write(self, data):
+        if self.closed or self.transport.is_closing():
+            return
+        if not self._admit(len(data), self.transport.get_write_buffer_size() + self.pending):
+            return
+        self.chunks.append(data)
+        self.pending += len(data)
+        if self.pending >= self.coalesce_limit:
+            self.flush() # Pending call_soon() then finds nothing to do
+        elif len(self.chunks) == 1:
+            self.loop.call_soon(self.flush)
+
+    def when_written(self, callback):
+        if self.chunks:
+            if self.written_callbacks is None:
+                self.written_callbacks = []
+            self.written_callbacks.append(callback)
+        elif not self.closed and not self.transport.is_closing():
+            callback()
+
+    def flush(self):
+        if not self.chunks:
+            return
+        data = b"".join(self.chunks) if len(self.chunks) > 1 else self.chunks[0]
+        self.chunks.clear()
+        self.pending = 0
+        if not self.closed and not self.transport.is_closing():
+            self.transport.write(data) # Tries the socket right away; the rest waits in the transport's buffer
+            if self.written_callbacks:
+                self._run_written()
+        else:
+            self.written_callbacks = None
+
+    def _overflow(self):
+        self.closed = True
+        self.written_callbacks = None
+        self.chunks.clear()
+        self.pending = 0
+        self.transport.write(self.overflow_message) # Queued behind the backlog: best effort
+        self.transport.close()
+        self.loop.call_later(CLOSE_LINGER, self.transport.abort) # Don't wait forever for a stalled peer
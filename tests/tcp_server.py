@@ -1,45 +1,303 @@
+import argparse
+import asyncio
+import functools
+import resource
 import socket
-import re
+import selectors
 import signal
 import sys
 import threading
+import time
+
+from auth_backend import add_auth_arguments, authenticator_from_args
+from channel_history import add_history_arguments, history_from_args
+from chat_core import ChatCore
+from frame_trace import add_trace_arguments, trace_from_args
+from latency_tracker import add_latency_arguments, latency_from_args
+from server_log import add_log_arguments, configure_from_args, log
+from rate_limit import LIMITED_TYPES, add_rate_limit_arguments, limiter_from_args
+from sessions import Session, SessionSet, SessionState
+from server_metrics import ServerMetrics, add_metrics_arguments, start_from_args as start_metrics
+from session_handoff import (accept_successor, add_handoff_arguments, decode_bytes, encode_bytes, exit_after_handoff,
+                             hand_off, handoff_from_args, restore_channels, restore_history, restore_session,
+                             snapshot_channels, snapshot_history, snapshot_session)
+from tcp_framing import CRLF, DEFAULT_MAX_LINE_LENGTH, LineFramer, LineTooLongError
+from tcp_grammar import parse_command
+from tcp_output import SLOW_CONSUMER_POLICIES, OutputLimits, OutputPump, SocketOutput, TransportOutput
+from worker_bus import fork_workers
 
 # --- Configuration ---
 HOST = "127.0.0.1"  # Listen on localhost
 PORT = 4567        # Default IPK25-CHAT port
 BUFFER_SIZE = 4096 # Reasonably large buffer
-CRLF = "\r\n"
 ENCODING = 'us-ascii' # As specified in the protocol
+MAX_LINE_LENGTH = DEFAULT_MAX_LINE_LENGTH # Longest accepted line without CRLF, in bytes
+ACCEPT_BACKLOG = 4096 # Listen backlog, large enough for connection storms in load tests
+HANDOFF_QUIESCE_TIMEOUT = 2.0 # Seconds connections get to finish what they are doing before a handoff gives up
+HANDOFF_POLL = 0.001 # Seconds between checks while waiting for connections to go quiet
+WORKERS = 1 # Processes sharing PORT via SO_REUSEPORT, see --workers
+BUS_FLUSH_INTERVAL = 0.05 # Seconds between retries of bus frames a busy worker had no room for
+OUTPUT_LIMITS = OutputLimits() # Per-connection output watermarks and slow-consumer policy, see --slow-consumer
+TRANSPORT = "tcp" # Key of this server's frames in the channel history
+OVERFLOW_ERR = f"ERR FROM Server IS Output buffer overflow, client is not reading{CRLF}".encode(ENCODING)
 
-# --- Pre-compiled Regex Patterns (Based on ABNF) ---
-# Note: These are simplified for parsing, not strict validation
-#       They assume the client sends correctly formatted messages for basic testing.
-RE_AUTH = re.compile(r"^AUTH\s+([a-zA-Z0-9_-]{1,20})\s+AS\s+([\x21-\x7E]{1,20})\s+USING\s+([a-zA-Z0-9_-]{1,128})$")
-RE_JOIN = re.compile(r"^JOIN\s+([a-zA-Z0-9_-]{1,20})\s+AS\s+([\x21-\x7E]{1,20})$")
-RE_MSG = re.compile(r"^MSG\s+FROM\s+([\x21-\x7E]{1,20})\s+IS\s+(.*)$", re.DOTALL) # DOTALL for multiline messages potentially ending before CRLF
-RE_BYE = re.compile(r"^BYE\s+FROM\s+([\x21-\x7E]{1,20})$")
+MESSAGE_TYPES = frozenset(("AUTH", "JOIN", "MSG", "BYE", "ERR", "REPLY")) # Metric labels; anything else is UNKNOWN
 
 # --- Global variable for the server socket ---
 server_socket = None
+output_pump = None # Finishes partial writes of the threaded engine, started with the server
+handoff_listener = None # Listening Unix socket when --handoff is given (asyncio engine)
+handing_off = False # Set while connections are being quiesced for a successor
+connections_starting = 0 # Accepted (asyncio) connections whose handler has not registered them yet
+connection_tasks = set() # The loop keeps only weak references to tasks; these must live until they finish
 
-def send_message(sock, message):
-    """Encodes and sends a message with CRLF."""
-    try:
-        print(f"SND: {message}")
-        sock.sendall((message + CRLF).encode(ENCODING))
-    except OSError as e:
-        print(f"Error sending message: {e}")
-    except Exception as e:
-        print(f"An unexpected error occurred during send: {e}")
+
+class ServerStats:
+    """Thread-safe counters used to compare the threaded and asyncio engines."""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.active_connections = 0
+        self.peak_connections = 0
+        self.messages_processed = 0
+        self.clients = SessionSet() # Open ClientConnections, for the sessions-by-state gauge and handoff
+
+    def connection_opened(self, client):
+        with self.lock:
+            self.clients.add(client)
+            self.active_connections += 1
+            self.peak_connections = max(self.peak_connections, self.active_connections)
+
+    def connection_closed(self, client):
+        with self.lock:
+            self.clients.remove(client)
+            self.active_connections -= 1
+
+    def sessions_by_state(self):
+        with self.lock:
+            return self.clients.count_by_state((SessionState.NEEDS_AUTH, SessionState.AUTHENTICATED))
+
+    def message_processed(self):
+        with self.lock:
+            self.messages_processed += 1
+
+
+stats = ServerStats()
+metrics = ServerMetrics()
+metrics.bind_sessions(stats.sessions_by_state)
+core = ChatCore() # Channels, fan-out and history (--history); chat_server.py shares one with udp_server.py
+worker_bus = None # WorkerBus linking this process to the other workers when WORKERS > 1
+limiter = None # RateLimiter when --rate-limit/--ip-rate-limit is given
+trace = None # TraceRecorder when --trace is given
+authenticator = None # Authenticator when --auth-db is given; without it every AUTH succeeds
+latency = None # LatencyTracker when --latency is given
+
+
+def encode_msg_line(display_name, content):
+    return f"MSG FROM {display_name} IS {content}{CRLF}".encode(ENCODING)
+
+
+class ClientConnection(Session):
+    """Per-connection protocol state shared by the threaded and asyncio engines."""
+    __slots__ = ("send_raw", "framer", "output", "idle")
+    transport = TRANSPORT # Channel member interface, see chat_core.py
+    encode_msg = staticmethod(encode_msg_line)
+
+    def __init__(self, addr, send_raw):
+        super().__init__(addr) # Starts in NEEDS_AUTH, see sessions.py
+        self.send_raw = send_raw # Callable taking already encoded bytes
+        self.output = None # SocketOutput or TransportOutput behind send_raw
+        # Asyncio engine only, for handing the connection over to a successor process
+        self.framer = None
+        self.idle = False # Waiting for input with nothing buffered
+        if limiter is not None:
+            self.buckets = limiter.session_buckets(time.monotonic())
+
+    def send(self, message):
+        """Encodes and sends a message with CRLF through the engine's writer."""
+        log.packet("SND: %s", message)
+        data = (message + CRLF).encode(ENCODING)
+        metrics.messages_sent.inc(message_type(message))
+        metrics.bytes_sent.inc(amount=len(data))
+        self.send_raw(data)
+
+    def deliver(self, frame, msg_trace=None):
+        """Sends a MSG line made by encode_msg(), e.g. one broadcast to the whole channel."""
+        metrics.messages_sent.inc("MSG")
+        metrics.bytes_sent.inc(amount=len(frame))
+        self.send_raw(frame)
+        if msg_trace is not None:
+            self.output.when_written(functools.partial(latency.written, msg_trace, self))
+
+
+def message_type(message):
+    """Metric label for a protocol line: its keyword, or UNKNOWN."""
+    keyword = message.partition(" ")[0].upper()
+    return keyword if keyword in MESSAGE_TYPES else "UNKNOWN"
+
+
+def check_rate(client, message):
+    """Applies the rate limits to a received line. Returns (action, wait) as RateLimiter.check().
+
+    The caller skips a dropped line and waits before handling a delayed one; for
+    "disconnect" the ERR is queued here and the caller closes the connection.
+    """
+    kind = message_type(message)
+    if kind not in LIMITED_TYPES:
+        return None, 0.0
+    action, wait = limiter.check(client.buckets, client.addr[0], kind, time.monotonic())
+    if action == "disconnect":
+        log.info(f"Client {client.addr} exceeded the {kind} rate limit. Sending ERR.")
+        client.send("ERR FROM Server IS Rate limit exceeded.")
+    elif action is not None:
+        log.debug("Throttled %s from %s: %s for %.3f s", kind, client.addr, action, wait)
+    return action, wait
+
+
+def count_throttled(label):
+    metrics.throttled.inc(label) # Looked up per call: the threaded engine swaps in a locked inc()
+
+
+def publish_to_bus(channel_id, display_name, content, frames):
+    """ChatCore.on_broadcast with --workers: passes the broadcast on to members connected to other workers."""
+    worker_bus.publish(channel_id, frames.get(TRANSPORT) or encode_msg_line(display_name, content))
+
+
+def deliver_from_bus(sock):
+    """Fans out broadcasts other workers published to channels with members here."""
+    for channel_id, data in worker_bus.receive(sock):
+        members = core.channels.members(channel_id)
+        for member in members:
+            member.send_raw(data)
+        count_fan_out(len(members), data)
+        if core.history is not None:
+            core.history.record(channel_id, None, None, TRANSPORT, data)
+
+
+def count_fan_out(recipients, data):
+    # Every broadcast line is a MSG (chat messages and the server's join/leave notices)
+    if recipients:
+        metrics.messages_sent.inc("MSG", recipients)
+        metrics.bytes_sent.inc(amount=recipients * len(data))
+
+
+async def verify_auth_line(message):
+    """Asyncio engine: checks the credentials of an AUTH line in the pool. Returns the Verdict, or None if not an AUTH."""
+    keyword, fields = parse_command(message)
+    if keyword != "AUTH" or fields is None:
+        return None
+    username, _, secret = fields
+    return await authenticator.verify_async(username, secret)
+
+
+def process_message(client, message, verdict=None, received_at=None):
+    """Runs one received message through the AUTH/JOIN/MSG/BYE state machine.
+
+    verdict is the asyncio engine's already awaited check of an AUTH (and
+    received_at when it started); the threaded engine verifies here, blocking
+    only its own client thread. Returns False when the connection should be closed.
+    """
+    addr = client.addr
+    received_at = received_at or time.perf_counter()
+    keyword, fields = parse_command(message) # Tokenized once; keywords are case-insensitive
+    metrics.messages_received.inc(keyword if keyword in MESSAGE_TYPES else "UNKNOWN")
+
+    # --- State Machine Logic ---
+    if client.state == SessionState.NEEDS_AUTH:
+        if keyword == "AUTH" and fields is not None:
+            username, received_dname, secret = fields
+            log.debug("AUTH attempt: User='%s', Display='%s', Secret='%s...'", username, received_dname, secret[:5])
+            if authenticator is not None:
+                if verdict is None:
+                    verdict = authenticator.verify(username, secret)
+                metrics.record_auth(verdict)
+                if not verdict.ok:
+                    # Stays in NEEDS_AUTH: the client may retry with other credentials
+                    log.info(f"Client {addr} failed to authenticate as '{username}'.")
+                    client.send("REPLY NOK IS Authentication failed.")
+                    metrics.auth_latency.observe(time.perf_counter() - received_at)
+                    return True
+            client.display_name = received_dname # Store display name
+            client.send("REPLY OK IS Auth success.")
+            metrics.auth_latency.observe(time.perf_counter() - received_at)
+            client.state = SessionState.AUTHENTICATED
+            # According to FSM, server joins client to default channel implicitly
+            core.join(client, client.current_channel)
+            log.info(f"Client {addr} authenticated as '{client.display_name}'. State -> AUTHENTICATED")
+            return True
+        else:
+            log.info(f"Invalid AUTH format from {addr} or wrong state.")
+            client.send("REPLY NOK IS Authentication failed or bad format.")
+            # Keep state as NEEDS_AUTH or terminate? Spec implies ERR leads to termination.
+            # Let's send ERR for protocol violation.
+            client.send(f"ERR FROM Server IS Malformed AUTH message or wrong state.")
+            return False # Terminate handler for this client
+
+    elif client.state == SessionState.AUTHENTICATED:
+        # --- Handle JOIN ---
+        if keyword == "JOIN" and fields is not None:
+            channel_id, received_dname = fields
+            # The client sends its display name again, maybe for consistency?
+            # A real server might validate if received_dname matches the stored one.
+            if received_dname != client.display_name:
+                 log.warn(f"JOIN display name '{received_dname}' differs from authenticated '{client.display_name}'")
+                 # Let's allow it for testing flexibility, but log a warning.
+                 # Or send ERR? Let's send ERR for stricter testing.
+                 #client.send(f"ERR FROM Server IS JOIN DisplayName mismatch.")
+                 #return False
+            log.debug("JOIN attempt: Channel='%s', Display='%s'", channel_id, received_dname)
+            client.send("REPLY OK IS Join success.")
+            core.join(client, channel_id) # Update current channel and notify both channels
+            log.info(f"Client '{client.display_name}' joined channel '{client.current_channel}'.")
+            return True # Process next message if any
+
+        # --- Handle MSG ---
+        if keyword == "MSG" and fields is not None:
+            sender_dname, msg_content = fields
+             # Check if sender name matches authenticated name
+            if sender_dname != client.display_name:
+                log.warn(f"MSG FROM display name '{sender_dname}' differs from authenticated '{client.display_name}'")
+                # Decide whether to reject (ERR) or just log. Let's reject.
+                client.send(f"ERR FROM Server IS MSG DisplayName mismatch.")
+                return False # Terminate handler
+
+            log.debug("MSG received: From='%s', Content='%s...'", sender_dname, msg_content[:50])
+            msg_trace = latency.start(client.current_channel, received_at) if latency is not None else None
+            # Relay to everyone else in the channel. No REPLY is sent for MSG according to the spec.
+            core.relay(client, sender_dname, msg_content, msg_trace)
+            metrics.broadcast_latency.observe(time.perf_counter() - received_at)
+            return True # Process next message if any
+
+        # --- Handle BYE ---
+        if keyword == "BYE" and fields is not None:
+            sender_dname, = fields
+            if sender_dname != client.display_name:
+                 log.warn(f"BYE FROM display name '{sender_dname}' differs from authenticated '{client.display_name}'")
+                 # Rejecting BYE might prevent graceful close. Let's just log and accept.
+            log.info(f"BYE received from '{sender_dname}'. Closing connection.")
+            # No confirmation needed for BYE in TCP.
+            return False # Exit the handler loop gracefully
+
+        # --- Handle Unknown / Malformed ---
+        log.info(f"Unknown or malformed message from {addr} in AUTHENTICATED state: {message}")
+        client.send(f"ERR FROM Server IS Unknown command or malformed message.")
+        return False # Terminate handler
+
+    else: # Should not happen
+        log.error(f"Unknown client state '{client.state.name}' for {addr}.")
+        return False # Terminate handler
 
 
 def handle_client(conn, addr):
-    """Handles a single client connection."""
-    print(f"Connection accepted from {addr}")
-    client_state = "NEEDS_AUTH" # Initial state
-    display_name = None
-    current_channel = "default" # Initial channel after auth
-    incoming_buffer = ""
+    """Handles a single client connection (threaded engine)."""
+    log.info(f"Connection accepted from {addr}")
+    # Other threads write here when broadcasting; never blocks them, see tcp_output.py
+    output = SocketOutput(conn, output_pump, OUTPUT_LIMITS, OVERFLOW_ERR, metrics.slow_consumer.inc)
+    client = ClientConnection(addr, output.write if trace is None else trace.tap(addr, output.write))
+    client.output = output
+    framer = LineFramer(MAX_LINE_LENGTH, ENCODING)
+    stats.connection_opened(client)
+    if trace is not None:
+        trace.open_session(addr)
 
     try:
         while True:
@@ -47,148 +305,220 @@ def handle_client(conn, addr):
             try:
                 data = conn.recv(BUFFER_SIZE)
                 if not data:
-                    print(f"Client {addr} disconnected unexpectedly.")
+                    log.info(f"Client {addr} disconnected unexpectedly.")
                     break # Connection closed by client
+                metrics.bytes_received.inc(amount=len(data))
+                if trace is not None:
+                    trace.inbound(addr, data)
 
-                incoming_buffer += data.decode(ENCODING)
+                messages = framer.feed(data)
             except UnicodeDecodeError:
-                 print(f"RCV from {addr}: Invalid {ENCODING} data. Sending ERR.")
-                 send_message(conn, f"ERR FROM Server IS Invalid character encoding")
+                 log.info(f"RCV from {addr}: Invalid {ENCODING} data. Sending ERR.")
+                 client.send(f"ERR FROM Server IS Invalid character encoding")
+                 break
+            except LineTooLongError as e:
+                 log.info(f"RCV from {addr}: {e}. Sending ERR.")
+                 client.send(f"ERR FROM Server IS Message too long")
                  break
             except OSError as e:
-                 print(f"Error receiving data from {addr}: {e}")
+                 log.error(f"Error receiving data from {addr}: {e}")
                  break # Socket error
 
             # --- Process Complete Messages ---
-            while CRLF in incoming_buffer:
-                message, incoming_buffer = incoming_buffer.split(CRLF, 1)
-                print(f"RCV from {addr}: {message}")
-
-                # --- State Machine Logic ---
-                if client_state == "NEEDS_AUTH":
-                    match = RE_AUTH.match(message)
-                    if match:
-                        username, received_dname, secret = match.groups()
-                        # Basic validation simulation (in real server, check credentials)
-                        print(f"AUTH attempt: User='{username}', Display='{received_dname}', Secret='{secret[:5]}...'")
-                        display_name = received_dname # Store display name
-                        send_message(conn, "REPLY OK IS Auth success.")
-                        # According to FSM, server joins client to default channel implicitly
-                        send_message(conn, f"MSG FROM Server IS {display_name} joined {current_channel}.")
-                        client_state = "AUTHENTICATED"
-                        print(f"Client {addr} authenticated as '{display_name}'. State -> AUTHENTICATED")
-                    else:
-                        print(f"Invalid AUTH format from {addr} or wrong state.")
-                        send_message(conn, "REPLY NOK IS Authentication failed or bad format.")
-                        # Keep state as NEEDS_AUTH or terminate? Spec implies ERR leads to termination.
-                        # Let's send ERR for protocol violation.
-                        send_message(conn, f"ERR FROM Server IS Malformed AUTH message or wrong state.")
-                        return # Terminate handler for this client
-
-                elif client_state == "AUTHENTICATED":
-                    # --- Handle JOIN ---
-                    match = RE_JOIN.match(message)
-                    if match:
-                        channel_id, received_dname = match.groups()
-                        # The client sends its display name again, maybe for consistency?
-                        # A real server might validate if received_dname matches the stored one.
-                        if received_dname != display_name:
-                             print(f"WARN: JOIN display name '{received_dname}' differs from authenticated '{display_name}'")
-                             # Let's allow it for testing flexibility, but log a warning.
-                             # Or send ERR? Let's send ERR for stricter testing.
-                             #send_message(conn, f"ERR FROM Server IS JOIN DisplayName mismatch.")
-                             #return
-                        print(f"JOIN attempt: Channel='{channel_id}', Display='{received_dname}'")
-                        current_channel = channel_id # Update current channel
-                        send_message(conn, "REPLY OK IS Join success.")
-                        send_message(conn, f"MSG FROM Server IS {display_name} joined {current_channel}.")
-                        print(f"Client '{display_name}' joined channel '{current_channel}'.")
-                        continue # Process next message if any
-
-                    # --- Handle MSG ---
-                    match = RE_MSG.match(message)
-                    if match:
-                        sender_dname, msg_content = match.groups()
-                         # Check if sender name matches authenticated name
-                        if sender_dname != display_name:
-                            print(f"WARN: MSG FROM display name '{sender_dname}' differs from authenticated '{display_name}'")
-                            # Decide whether to reject (ERR) or just log. Let's reject.
-                            send_message(conn, f"ERR FROM Server IS MSG DisplayName mismatch.")
-                            return # Terminate handler
-
-                        print(f"MSG received: From='{sender_dname}', Content='{msg_content[:50]}...'")
-                        # In a real server, you'd broadcast this to others in the channel.
-                        # Here, we just acknowledge receipt on the server side.
-                        # No REPLY is sent for MSG according to the spec.
-                        continue # Process next message if any
-
-                    # --- Handle BYE ---
-                    match = RE_BYE.match(message)
-                    if match:
-                        sender_dname = match.group(1)
-                        if sender_dname != display_name:
-                             print(f"WARN: BYE FROM display name '{sender_dname}' differs from authenticated '{display_name}'")
-                             # Rejecting BYE might prevent graceful close. Let's just log and accept.
-                        print(f"BYE received from '{sender_dname}'. Closing connection.")
-                        # No confirmation needed for BYE in TCP.
-                        return # Exit the handler loop gracefully
-
-                    # --- Handle Unknown / Malformed ---
-                    print(f"Unknown or malformed message from {addr} in AUTHENTICATED state: {message}")
-                    send_message(conn, f"ERR FROM Server IS Unknown command or malformed message.")
-                    return # Terminate handler
-
-                else: # Should not happen
-                    print(f"FATAL: Unknown client state '{client_state}' for {addr}.")
-                    return # Terminate handler
+            # Replies to the whole chunk leave in one sendmsg() when uncorked
+            output.cork()
+            for message in messages:
+                log.packet("RCV from %s: %s", addr, message)
+                stats.message_processed()
+                if limiter is not None:
+                    action, wait = check_rate(client, message)
+                    if action == "drop":
+                        continue
+                    if action == "disconnect":
+                        return
+                    if action == "delay":
+                        output.uncork() # Replies so far leave before this thread sleeps
+                        time.sleep(wait)
+                        output.cork()
+                if not process_message(client, message):
+                    return
+            output.uncork()
+            if OUTPUT_LIMITS.policy == "pause":
+                output.wait_drained() # Don't read more requests while the replies pile up
 
     except ConnectionResetError:
-        print(f"Client {addr} reset the connection.")
+        log.info(f"Client {addr} reset the connection.")
     except BrokenPipeError:
-         print(f"Client {addr} connection broken.")
+         log.info(f"Client {addr} connection broken.")
     except Exception as e:
-        print(f"An unexpected error occurred with client {addr}: {e}")
+        log.error(f"An unexpected error occurred with client {addr}: {e}")
         # Try sending an ERR if the socket is still usable
         try:
-            send_message(conn, f"ERR FROM Server IS An internal server error occurred.")
+            client.send(f"ERR FROM Server IS An internal server error occurred.")
         except Exception:
             pass # Ignore if sending fails now
     finally:
-        print(f"Closing connection to {addr}")
+        log.info(f"Closing connection to {addr}")
+        core.leave(client)
+        stats.connection_closed(client)
+        output.close() # Sends the lines still queued, e.g. a final ERR
+        if latency is not None:
+            latency.forget(client) # After close(): no written callback can run any more
         conn.close()
+        if trace is not None:
+            trace.close_session(addr)
+
+
+def new_async_client(writer, addr):
+    """Creates the ClientConnection of an asyncio connection, with its writer and framer attached."""
+    output = TransportOutput(writer.transport, OUTPUT_LIMITS, OVERFLOW_ERR, metrics.slow_consumer.inc)
+    client = ClientConnection(addr, output.write if trace is None else trace.tap(addr, output.write))
+    client.output = output
+    client.framer = LineFramer(MAX_LINE_LENGTH, ENCODING)
+    return client
+
+
+async def handle_client_async(reader, writer, client=None):
+    """Handles a single client connection (asyncio engine); client is set for one taken over."""
+    if client is None:
+        client = new_async_client(writer, writer.get_extra_info("peername"))
+        log.info(f"Connection accepted from {client.addr}")
+        if trace is not None:
+            trace.open_session(client.addr)
+    addr = client.addr
+    output = client.output
+    framer = client.framer
+    stats.connection_opened(client)
+    if handing_off:
+        writer.transport.pause_reading() # Accepted just before the handoff started
+
+    try:
+        while True:
+            # --- Receive Data ---
+            try:
+                client.idle = True
+                data = await reader.read(BUFFER_SIZE)
+                client.idle = False
+                if not data:
+                    log.info(f"Client {addr} disconnected unexpectedly.")
+                    break # Connection closed by client
+                metrics.bytes_received.inc(amount=len(data))
+                if trace is not None:
+                    trace.inbound(addr, data)
+
+                messages = framer.feed(data)
+            except UnicodeDecodeError:
+                 log.info(f"RCV from {addr}: Invalid {ENCODING} data. Sending ERR.")
+                 client.send(f"ERR FROM Server IS Invalid character encoding")
+                 break
+            except LineTooLongError as e:
+                 log.info(f"RCV from {addr}: {e}. Sending ERR.")
+                 client.send(f"ERR FROM Server IS Message too long")
+                 break
+
+            # --- Process Complete Messages ---
+            keep_open = True
+            for message in messages:
+                log.packet("RCV from %s: %s", addr, message)
+                stats.message_processed()
+                if limiter is not None:
+                    action, wait = check_rate(client, message)
+                    if action == "drop":
+                        continue
+                    if action == "disconnect":
+                        keep_open = False
+                        break
+                    if action == "delay":
+                        output.flush()
+                        await asyncio.sleep(wait) # Only this connection waits
+                verdict = received_at = None
+                if authenticator is not None and client.state == SessionState.NEEDS_AUTH:
+                    received_at = time.perf_counter()
+                    verdict = await verify_auth_line(message) # Hashing runs in the pool, the loop goes on
+                keep_open = process_message(client, message, verdict, received_at)
+                if not keep_open:
+                    break
+
+            # Flush everything the state machine queued for this chunk at once
+            output.flush()
+            if OUTPUT_LIMITS.policy == "pause":
+                await writer.drain() # Waits while the transport buffer is above the high watermark
+            if not keep_open:
+                break
+
+    except ConnectionResetError:
+        log.info(f"Client {addr} reset the connection.")
+    except BrokenPipeError:
+         log.info(f"Client {addr} connection broken.")
+    except Exception as e:
+        log.error(f"An unexpected error occurred with client {addr}: {e}")
+        # Try sending an ERR if the transport is still usable
+        try:
+            client.send(f"ERR FROM Server IS An internal server error occurred.")
+            output.flush()
+        except Exception:
+            pass # Ignore if sending fails now
+    finally:
+        client.idle = False
+        log.info(f"Closing connection to {addr}")
+        core.leave(client)
+        output.flush()
+        writer.close()
+        if latency is not None:
+            latency.forget(client) # After close(): no written callback can run any more
+        if trace is not None:
+            trace.close_session(addr)
+        try:
+            await writer.wait_closed()
+        except OSError:
+            pass # Peer may already be gone
+        finally:
+            stats.connection_closed(client) # Only now: a handoff waits for the last lines to leave
+
+
+def run_bus_receiver():
+    """Threaded engine: waits for frames from the other workers."""
+    bus_selector = selectors.DefaultSelector()
+    for sock in worker_bus.sockets():
+        bus_selector.register(sock, selectors.EVENT_READ)
+    while True:
+        for key, _ in bus_selector.select(timeout=BUS_FLUSH_INTERVAL):
+            deliver_from_bus(key.fileobj)
+            if key.fileobj.fileno() < 0:
+                bus_selector.unregister(key.fileobj) # Peer worker exited
+        worker_bus.flush()
 
 
 def signal_handler(sig, frame):
     """Handles Ctrl+C for graceful shutdown."""
     global server_socket
-    print("\nShutting down server...")
+    log.info("Shutting down server...")
     if server_socket:
         server_socket.close()
-        print("Server socket closed.")
+        log.info("Server socket closed.")
     sys.exit(0)
 
 
 def start_server():
     """Starts the TCP chat server."""
-    global server_socket
+    global server_socket, output_pump
+    metrics.make_thread_safe() # Every client thread updates the counters
+    output_pump = OutputPump()
     # --- Set up signal handler ---
     signal.signal(signal.SIGINT, signal_handler)
 
     # --- Create and Bind Socket ---
-    server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    # Allow reusing the address shortly after closing (useful for development)
-    server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-
     try:
-        server_socket.bind((HOST, PORT))
-        server_socket.listen()
-        print(f"TCP Server listening on {HOST}:{PORT}...")
+        server_socket = open_listening_socket()
+        log.info(f"TCP Server listening on {HOST}:{PORT}...")
     except OSError as e:
-        print(f"Error binding or listening: {e}")
+        log.error(f"Error binding or listening: {e}")
         sys.exit(1)
     except Exception as e:
-         print(f"An unexpected error occurred during setup: {e}")
+         log.error(f"An unexpected error occurred during setup: {e}")
          sys.exit(1)
+    if worker_bus is not None:
+        threading.Thread(target=run_bus_receiver, daemon=True).start()
 
 
     # --- Accept Connections Loop ---
@@ -197,7 +527,7 @@ def start_server():
             try:
                 conn, addr = server_socket.accept()
                 # Handle each client in a separate thread (simple approach)
-                # Warning: For many clients, a different concurrency model (like asyncio or select) is better.
+                # For many clients, run with --mode asyncio instead.
                 client_thread = threading.Thread(target=handle_client, args=(conn, addr))
                 client_thread.daemon = True # Allows main thread to exit even if client threads are running
                 client_thread.start()
@@ -205,16 +535,311 @@ def start_server():
                 # the handle_client function itself is blocking for that specific client.
             except OSError:
                 # This might happen if the socket is closed by the signal handler
-                print("Server socket closed, exiting accept loop.")
+                log.info("Server socket closed, exiting accept loop.")
                 break
             except Exception as e:
-                 print(f"Error accepting connection: {e}")
+                 log.error(f"Error accepting connection: {e}")
                  # Continue trying to accept new connections unless it's a fatal error
 
     finally:
         if server_socket:
             server_socket.close()
-            print("Server socket closed.")
+            log.info("Server socket closed.")
+
+
+def open_listening_socket():
+    """Binds and listens on HOST:PORT (both engines)."""
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    # Allow reusing the address shortly after closing (useful for development)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    if WORKERS > 1:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1) # Kernel balances accepts across workers
+    try:
+        sock.bind((HOST, PORT))
+        sock.listen(ACCEPT_BACKLOG)
+    except OSError:
+        sock.close()
+        raise
+    return sock
+
+
+async def serve_async(takeover=None):
+    """Runs the asyncio engine until cancelled, or resumes the connections a predecessor handed over."""
+    loop = asyncio.get_running_loop()
+    restored = []
+    if takeover is None:
+        listen_socket = open_listening_socket()
+        log.info(f"TCP Server (asyncio) listening on {HOST}:{PORT}...")
+    else:
+        listen_socket, restored = await take_over_connections(takeover)
+        takeover.complete(metrics)
+    # Accepting here rather than through asyncio.start_server() lets a handoff stop and resume it
+    listen_socket.setblocking(False)
+    loop.add_reader(listen_socket, accept_connections, listen_socket)
+    if handoff_listener is not None:
+        loop.add_reader(handoff_listener, on_successor, loop, listen_socket)
+    for reader, writer, client in restored:
+        keep_task(handle_client_async(reader, writer, client))
+    if worker_bus is not None:
+        for sock in worker_bus.sockets():
+            loop.add_reader(sock, on_bus_readable, loop, sock)
+        asyncio.create_task(flush_bus_periodically())
+    await loop.create_future() # Serves until the loop is stopped
+
+
+def accept_connections(listen_socket):
+    """Reader callback: accepts the queued connections (at most a backlog's worth per wakeup)."""
+    global connections_starting
+    for _ in range(ACCEPT_BACKLOG):
+        try:
+            conn, _ = listen_socket.accept()
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError as e:
+            log.error(f"Error accepting connection: {e}")
+            return
+        conn.setblocking(False)
+        connections_starting += 1
+        keep_task(start_connection(conn))
+
+
+def keep_task(coroutine):
+    task = asyncio.ensure_future(coroutine)
+    connection_tasks.add(task)
+    task.add_done_callback(connection_tasks.discard)
+
+
+async def start_connection(conn):
+    global connections_starting
+    try:
+        reader, writer = await asyncio.open_connection(sock=conn)
+    except OSError as e:
+        log.info(f"Connection lost before it was set up: {e}")
+        conn.close()
+        return
+    finally:
+        connections_starting -= 1
+    # No await before the handler registers the client, so a handoff sees it
+    await handle_client_async(reader, writer)
+
+
+# --- Live Handoff (asyncio engine) ---
+# A successor connecting to --handoff gets the listening socket and every
+# connection, see session_handoff.py. Accepting stops and every connection stops
+# reading; the handoff waits until each one is idle in read() with its replies
+# written out, so what remains per connection is its protocol state and at most
+# a partial input line. Anything a client sends meanwhile waits in the kernel for
+# the successor. A connection that does not go quiet within HANDOFF_QUIESCE_TIMEOUT
+# (e.g. a paused slow consumer) cancels the handoff and everything resumes.
+
+def on_successor(loop, listen_socket):
+    """Handoff socket callback: starts quiescing the connections for the successor."""
+    channel = accept_successor(handoff_listener)
+    if channel is None:
+        return
+    if handing_off:
+        channel.close() # One successor at a time
+        return
+    keep_task(hand_off_connections(loop, listen_socket, channel))
+
+
+def is_quiet(client):
+    transport = client.output.transport
+    return client.idle and not client.output.pending and not transport.get_write_buffer_size()
+
+
+async def hand_off_connections(loop, listen_socket, channel):
+    """Quiesces every connection, then passes them and the listening socket to the successor."""
+    global handing_off
+    paused_at = time.time()
+    handing_off = True
+    loop.remove_reader(listen_socket) # New connections queue in the backlog, which the successor inherits
+    for client in list(stats.clients.values()):
+        client.output.transport.pause_reading()
+    deadline = time.monotonic() + HANDOFF_QUIESCE_TIMEOUT
+    while True:
+        # Sleep before checking: a connection woken by data read just before the pause looks idle until it runs
+        await asyncio.sleep(HANDOFF_POLL)
+        if not connections_starting and all(is_quiet(client) for client in list(stats.clients.values())):
+            log.info(f"Connections quiet after {(time.time() - paused_at) * 1000:.1f} ms")
+            if hand_off(channel, handoff_listener, lambda: snapshot_connections(listen_socket), paused_at):
+                exit_after_handoff()
+            break
+        if time.monotonic() > deadline:
+            busy = sum(not is_quiet(client) for client in list(stats.clients.values()))
+            log.error(f"{busy} connection(s) did not go quiet for the handoff, resuming")
+            channel.close()
+            break
+    handing_off = False
+    for client in list(stats.clients.values()):
+        client.output.transport.resume_reading()
+    loop.add_reader(listen_socket, accept_connections, listen_socket)
+
+
+def snapshot_connections(listen_socket):
+    """Returns the handoff snapshot and the sockets it refers to by index (listening socket first)."""
+    if trace is not None:
+        trace.flush()
+    sockets = [listen_socket]
+    position = {} # Key: ClientConnection, Value: index in the snapshot's sessions
+    sessions = []
+    for client in stats.clients.values():
+        data = snapshot_session(client)
+        data.update(socket=len(sockets), input=encode_bytes(client.framer.buffer))
+        sockets.append(client.output.transport.get_extra_info("socket"))
+        position[client] = len(sessions)
+        sessions.append(data)
+    snapshot = {"transport": TRANSPORT, "sessions": sessions, "channels": snapshot_channels(core.channels, position),
+                "history": snapshot_history(core.history, TRANSPORT),
+                "trace": trace.export_sessions() if trace is not None else None}
+    return snapshot, sockets
+
+
+async def take_over_connections(takeover):
+    """Rebuilds the connections in a predecessor's snapshot. Returns the listening socket and (reader, writer, client)s."""
+    snapshot = takeover.snapshot
+    sockets = takeover.sockets
+    for sock in sockets:
+        sock.setblocking(False)
+    streams = await asyncio.gather(*(asyncio.open_connection(sock=sockets[data["socket"]])
+                                     for data in snapshot["sessions"]))
+    restored = []
+    clients = []
+    for data, (reader, writer) in zip(snapshot["sessions"], streams):
+        client = new_async_client(writer, tuple(data["addr"]))
+        restore_session(client, data)
+        client.framer.feed(decode_bytes(data["input"])) # Only ever a partial line, so nothing to process yet
+        clients.append(client)
+        restored.append((reader, writer, client))
+    restore_channels(core.channels, snapshot["channels"], clients)
+    restore_history(core.history, snapshot["history"], TRANSPORT)
+    if trace is not None:
+        trace.adopt_sessions(snapshot["trace"])
+    return sockets[0], restored
+
+
+def on_bus_readable(loop, sock):
+    deliver_from_bus(sock)
+    if sock.fileno() < 0:
+        loop.remove_reader(sock) # Peer worker exited
+
+
+async def flush_bus_periodically():
+    while True:
+        await asyncio.sleep(BUS_FLUSH_INTERVAL)
+        worker_bus.flush()
+
+
+def start_async_server(takeover=None):
+    """Starts the TCP chat server on a single asyncio event loop."""
+    try:
+        asyncio.run(serve_async(takeover))
+    except KeyboardInterrupt:
+        log.info("Shutting down server...")
+    except OSError as e:
+        log.error(f"Error binding or listening: {e}")
+        sys.exit(1)
+
+
+def report_stats(engine, interval):
+    """Periodically prints connection count, message rate and memory per session."""
+    last_count = 0
+    last_time = time.time()
+    while True:
+        time.sleep(interval)
+        now = time.time()
+        with stats.lock:
+            active = stats.active_connections
+            peak = stats.peak_connections
+            count = stats.messages_processed
+        rate = (count - last_count) / (now - last_time)
+        last_count, last_time = count, now
+        max_rss_kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss # KiB on Linux
+        per_session = f"{max_rss_kb / peak:.1f} KiB" if peak else "n/a"
+        log.info("STATS [%s]: connections=%d peak=%d msgs/s=%.0f max_rss=%d KiB rss/peak_session=%s",
+                 engine, active, peak, rate, max_rss_kb, per_session)
+        if core.history is not None:
+            log.info("HISTORY: %s", core.history.describe())
+        if trace is not None:
+            log.info("TRACE: %s", trace.describe())
+        if authenticator is not None:
+            log.info("AUTH: %s", authenticator.describe())
+        if latency is not None:
+            log.info("LATENCY: %s", latency.describe())
+
+
+def parse_args():
+    """Parses command line options."""
+    parser = argparse.ArgumentParser(description="IPK25-CHAT TCP test server")
+    parser.add_argument("--mode", choices=("threaded", "asyncio"), default="threaded",
+                        help="Concurrency engine: one thread per connection or a single asyncio loop")
+    parser.add_argument("--max-line-length", type=int, default=MAX_LINE_LENGTH,
+                        help="Longest accepted message line in bytes; longer lines get ERR and disconnect")
+    parser.add_argument("--stats-interval", type=float, default=0,
+                        help="Print engine statistics every N seconds (0 disables)")
+    parser.add_argument("--slow-consumer", choices=SLOW_CONSUMER_POLICIES, default=OUTPUT_LIMITS.policy,
+                        help="What to do with a client whose output queue passes the high watermark")
+    parser.add_argument("--output-high-water", type=int, default=OUTPUT_LIMITS.high_water,
+                        help="Queued output bytes per connection at which the slow-consumer policy applies")
+    parser.add_argument("--output-low-water", type=int, default=OUTPUT_LIMITS.low_water,
+                        help="Queued output bytes below which a dropping or paused connection recovers")
+    parser.add_argument("--workers", type=int, default=WORKERS,
+                        help="Fork N worker processes sharing the port via SO_REUSEPORT (1 = single process)")
+    add_history_arguments(parser)
+    add_rate_limit_arguments(parser)
+    add_auth_arguments(parser)
+    add_latency_arguments(parser)
+    add_trace_arguments(parser)
+    add_handoff_arguments(parser)
+    add_log_arguments(parser)
+    add_metrics_arguments(parser)
+    return parser.parse_args()
+
+
+def run_engine(args, worker_id=None):
+    """Runs one server process (the only one, or one pre-fork worker)."""
+    global trace, handoff_listener
+    handoff_listener, takeover = handoff_from_args(args, TRANSPORT)
+    if takeover is None:
+        start_metrics(metrics, args, worker_id)
+    else:
+        takeover.when_predecessor_exits(start_metrics, metrics, args, worker_id) # It still holds the metrics port
+    trace = trace_from_args(args, TRANSPORT, worker_id=worker_id)
+    if args.stats_interval > 0:
+        threading.Thread(target=report_stats, args=(args.mode, args.stats_interval), daemon=True).start()
+    if args.mode == "asyncio":
+        start_async_server(takeover)
+    else:
+        start_server()
+
+
+def run_worker(bus, args):
+    """Entry point of a pre-fork worker: links the channel registry to the bus, then serves."""
+    global worker_bus
+    worker_bus = bus
+    core.channels.on_channel_opened = bus.subscribe
+    core.channels.on_channel_closed = bus.unsubscribe
+    core.on_broadcast = publish_to_bus
+    run_engine(args, bus.worker_id)
+
 
 if __name__ == "__main__":
-    start_server()
\ No newline at end of file
+    args = parse_args()
+    MAX_LINE_LENGTH = args.max_line_length
+    WORKERS = args.workers
+    if args.handoff and (WORKERS > 1 or args.mode != "asyncio"):
+        raise SystemExit("--handoff needs the asyncio engine in a single process (--mode asyncio --workers 1)")
+    OUTPUT_LIMITS = OutputLimits(args.output_high_water, args.output_low_water, args.slow_consumer)
+    configure_from_args(args)
+    core.history, core.history_replay = history_from_args(args)
+    if core.history is not None:
+        metrics.bind_history(core.history.memory_by_channel)
+    limiter = limiter_from_args(args, count_throttled)
+    authenticator = authenticator_from_args(args)
+    latency = latency_from_args(args)
+    if latency is not None:
+        metrics.bind_latency(latency)
+    if WORKERS > 1:
+        fork_workers(WORKERS, lambda bus: run_worker(bus, args))
+    else:
+        run_engine(args)
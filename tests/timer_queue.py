@@ -0,0 +1,120 @@
+import heapq
+import itertools
+
+# --- Timer Queue ---
+# A binary heap of deadlines with lazy cancellation. Scheduling and cancelling
+# are O(log n) / O(1), and running due timers costs only as much as the number
+# of timers that are actually due, never a scan over every pending timer.
+# Not thread-safe: owned by the server's single event loop. On an asyncio loop
+# (chat_server.py, the simulated soak runs) a TimerDriver runs the due timers.
+
+
+class Timer:
+    """Handle returned by TimerQueue.schedule(); pass it to TimerQueue.cancel()."""
+    __slots__ = ("deadline", "callback", "args", "cancelled")
+
+    def __init__(self, deadline, callback, args):
+        self.deadline = deadline
+        self.callback = callback
+        self.args = args
+        self.cancelled = False
+
+
+class TimerQueue:
+    """Runs callbacks once their deadline has passed."""
+    def __init__(self):
+        self.heap = [] # Entries: (deadline, sequence, Timer)
+        self.sequence = itertools.count() # Tie-breaker keeps equal deadlines FIFO
+        self.cancelled_count = 0
+        self.on_schedule = None # Optional callback(deadline), e.g. to wake a loop sleeping until the earliest deadline
+
+    def schedule(self, deadline, callback, *args):
+        timer = Timer(deadline, callback, args)
+        heapq.heappush(self.heap, (deadline, next(self.sequence), timer))
+        if self.on_schedule is not None:
+            self.on_schedule(deadline)
+        return timer
+
+    def cancel(self, timer):
+        if timer is not None and not timer.cancelled:
+            timer.cancelled = True
+            self.cancelled_count += 1
+            # Most timers (retransmits) are cancelled; rebuild before dead entries dominate the heap
+            if self.cancelled_count > 64 and self.cancelled_count * 2 > len(self.heap):
+                self.heap = [entry for entry in self.heap if not entry[2].cancelled]
+                heapq.heapify(self.heap)
+                self.cancelled_count = 0
+
+    def next_deadline(self):
+        """Returns the earliest live deadline, or None when nothing is scheduled."""
+        heap = self.heap
+        while heap and heap[0][2].cancelled:
+            heapq.heappop(heap)
+            self.cancelled_count -= 1
+        return heap[0][0] if heap else None
+
+    def run_due(self, now):
+        """Runs every timer whose deadline is <= now. Returns how many ran."""
+        ran = 0
+        # Re-read self.heap every round: a callback may cancel timers and trigger a rebuild
+        while self.heap and self.heap[0][0] <= now:
+            _, _, timer = heapq.heappop(self.heap)
+            if timer.cancelled:
+                self.cancelled_count -= 1
+                continue
+            timer.cancelled = True # Fired timers can no longer be cancelled
+            timer.callback(*timer.args)
+            ran += 1
+        return ran
+
+    def pending(self):
+        """Returns the live timers in deadline order, e.g. to hand them to another process."""
+        return [timer for _, _, timer in sorted(self.heap) if not timer.cancelled]
+
+    def __len__(self):
+        return len(self.heap) - self.cancelled_count
+
+
+class TimerDriver:
+    """Runs a TimerQueue's due timers from an asyncio loop, waking only at its earliest deadline.
+
+    Call kick() after anything that may have scheduled an earlier timer, or
+    install wake() as the queue's on_schedule callback.
+    """
+    def __init__(self, loop, timers, clock):
+        self.loop = loop
+        self.timers = timers
+        self.clock = clock
+        self.handle = None
+        self.deadline = None
+        self.firing = False
+
+    def kick(self):
+        deadline = self.timers.next_deadline()
+        # A wakeup that turns out early (its timer was cancelled) is cheaper than
+        # re-arming: cancelled handles stay in asyncio's heap and slow every push and pop
+        if deadline is None or (self.deadline is not None and self.deadline <= deadline):
+            return
+        if self.handle is not None:
+            self.handle.cancel()
+        self.deadline = deadline
+        self.handle = self.loop.call_at(deadline, self._fire)
+
+    def wake(self, deadline):
+        """TimerQueue.on_schedule callback: re-arms only for a timer due before the current wakeup."""
+        if not self.firing and (self.deadline is None or deadline < self.deadline):
+            self.kick()
+
+    def _fire(self):
+        self.handle = self.deadline = None
+        self.firing = True # Timers the callbacks schedule are covered by the kick() below
+        try:
+            self.timers.run_due(self.clock())
+        finally:
+            self.firing = False
+        self.kick()
+
+    def stop(self):
+        if self.handle is not None:
+            self.handle.cancel()
+        self.handle = self.deadline = None
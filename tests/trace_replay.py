@@ -0,0 +1,358 @@
+import argparse
+import asyncio
+import json
+import sys
+
+from frame_trace import (FLAG_MAIN_SOCKET, KIND_CLOSE, KIND_GAP, KIND_IN, KIND_NAMES, KIND_OPEN, KIND_OUT,
+                         read_trace)
+from udp_codec import MESSAGE_TYPE_NAMES, parse_header
+
+# --- Trace Replay ---
+# Re-drives a live server or client from a frame trace written with --trace
+# (see frame_trace.py):
+#   dump   - prints the records
+#   server - plays the client side of every recorded session against a server
+#   client - plays the server side: accepts clients and answers with the recorded frames
+# --speed 1 keeps the recorded timing, N plays N times faster, 0 as fast as
+# possible. Timing alone breaks down at high speed, so each frame also waits
+# (up to --causality-timeout) until the peer has sent what preceded it in the
+# trace: as many bytes (TCP) or datagrams (UDP) as were recorded the other way.
+# A session whose peer sent a different amount than recorded is reported as
+# diverged, which is usually where a bug reproduces.
+
+DEFAULT_CAUSALITY_TIMEOUT = 2.0 # Seconds a frame waits for the peer's preceding frames
+
+
+class RecordedSession:
+    """One session's frames from a trace."""
+    __slots__ = ("session_id", "transport", "addr", "opened", "closed", "frames")
+
+    def __init__(self, session_id, transport, addr, opened):
+        self.session_id = session_id
+        self.transport = transport
+        self.addr = addr
+        self.opened = opened
+        self.closed = None
+        self.frames = [] # (timestamp, kind, flags, payload), KIND_IN/KIND_OUT only
+
+
+def load_sessions(path):
+    """Returns (sessions in the order they opened, number of records lost to KIND_GAP)."""
+    sessions = {}
+    ordered = []
+    lost = 0
+    for record in read_trace(path):
+        if record.kind == KIND_OPEN:
+            transport, host, port = record.payload.decode("ascii").split()
+            session = sessions[record.session_id] = RecordedSession(record.session_id, transport,
+                                                                    (host, int(port)), record.timestamp)
+            ordered.append(session)
+        elif record.kind == KIND_GAP:
+            lost += int(record.payload)
+        elif record.session_id in sessions:
+            session = sessions[record.session_id]
+            if record.kind == KIND_CLOSE:
+                session.closed = record.timestamp
+            else:
+                session.frames.append((record.timestamp, record.kind, record.flags, record.payload))
+    return ordered, lost
+
+
+def describe_frame(transport, payload):
+    if transport == "udp":
+        header = parse_header(payload)
+        if header is None:
+            return f"malformed {payload[:16]!r}"
+        msg_type, msg_id = header
+        name = MESSAGE_TYPE_NAMES.get(msg_type) or f"type 0x{msg_type:02X}"
+        return f"{name} id={msg_id} {payload[3:60]!r}"
+    return repr(payload[:80])
+
+
+def dump(path):
+    origin = None
+    transports = {}
+    for record in read_trace(path):
+        origin = record.timestamp if origin is None else origin
+        offset = record.timestamp - origin
+        kind = KIND_NAMES.get(record.kind, str(record.kind))
+        if record.kind == KIND_OPEN:
+            transports[record.session_id] = record.payload.split()[0].decode("ascii")
+            detail = record.payload.decode("ascii")
+        elif record.kind in (KIND_IN, KIND_OUT):
+            detail = describe_frame(transports.get(record.session_id), record.payload)
+            if record.flags & FLAG_MAIN_SOCKET:
+                detail = "main " + detail
+        else:
+            detail = record.payload.decode("ascii")
+        print(f"{offset:12.6f} s{record.session_id:<6} {kind:5} {detail}")
+
+
+class ReplayStats:
+    def __init__(self):
+        self.sessions = 0
+        self.frames_sent = 0
+        self.diverged = [] # Recorded session ids whose peer sent a different amount than recorded
+
+    def report(self, args, elapsed, span, lost):
+        return {
+            "mode": args.mode, "speed": args.speed, "sessions": self.sessions, "frames_sent": self.frames_sent,
+            "diverged_sessions": self.diverged, "records_lost_in_trace": lost,
+            "recorded_span_s": round(span, 3), "elapsed_s": round(elapsed, 3),
+        }
+
+
+class SessionReplayer:
+    """Sends one side of a recorded session, paced by the trace and by what the peer sends back.
+
+    Subclasses provide open(), send(payload, flags) and close(), and call
+    received(amount) for everything the peer sends.
+    """
+    def __init__(self, recorded, send_kind, args, stats, origin):
+        self.recorded = recorded
+        self.send_kind = send_kind
+        self.per_frame = recorded.transport == "udp" # UDP counts datagrams, TCP counts bytes
+        self.args = args
+        self.stats = stats
+        self.origin = origin # (trace timestamp, loop time) that correspond to each other
+        self.got = 0
+        self.waiting = None # (target, Future) while send() waits for the peer
+
+    async def wait_until(self, timestamp):
+        if self.args.speed > 0:
+            loop = asyncio.get_running_loop()
+            delay = self.origin[1] + (timestamp - self.origin[0]) / self.args.speed - loop.time()
+            if delay > 0:
+                await asyncio.sleep(delay)
+
+    async def wait_received(self, target):
+        if self.got >= target:
+            return True
+        future = asyncio.get_running_loop().create_future()
+        self.waiting = (target, future)
+        try:
+            await asyncio.wait_for(future, self.args.causality_timeout)
+            return True
+        except asyncio.TimeoutError:
+            return False
+        finally:
+            self.waiting = None
+
+    def received(self, amount):
+        self.got += amount
+        if self.waiting is not None and self.got >= self.waiting[0] and not self.waiting[1].done():
+            self.waiting[1].set_result(None)
+
+    async def run(self):
+        self.stats.sessions += 1
+        expected = 0
+        try:
+            await self.open()
+            for timestamp, kind, flags, payload in self.recorded.frames:
+                if kind != self.send_kind:
+                    expected += 1 if self.per_frame else len(payload)
+                    continue
+                await self.wait_received(expected)
+                await self.wait_until(timestamp)
+                self.send(payload, flags)
+                self.stats.frames_sent += 1
+            await self.wait_received(expected)
+            if self.recorded.closed is not None:
+                await self.wait_until(self.recorded.closed)
+        except OSError as e:
+            print(f"Session {self.recorded.session_id}: {e}", file=sys.stderr)
+        finally:
+            self.close()
+        if self.got != expected:
+            self.stats.diverged.append(self.recorded.session_id)
+
+
+class TcpReplayer(SessionReplayer):
+    """Common to both TCP sides: counts the bytes the peer sends and writes the recorded frames."""
+    reader = None
+    writer = None
+    reading = None # Task running read() once the connection is up
+
+    def start_reading(self):
+        self.reading = asyncio.ensure_future(self.read())
+
+    async def read(self):
+        while True:
+            data = await self.reader.read(65536)
+            if not data:
+                return
+            self.received(len(data))
+
+    def send(self, payload, flags):
+        self.writer.write(payload)
+
+    def close(self):
+        if self.reading is not None:
+            self.reading.cancel()
+        if self.writer is not None:
+            self.writer.close()
+
+
+class TcpClientSide(TcpReplayer):
+    """Plays a recorded TCP client against a server."""
+    async def open(self):
+        self.reader, self.writer = await asyncio.open_connection(self.args.host, self.args.port)
+        self.start_reading()
+
+
+class TcpServerSide(TcpReplayer):
+    """Plays a recorded TCP server to a client connection that was accepted."""
+    def __init__(self, recorded, args, stats, reader, writer):
+        super().__init__(recorded, KIND_OUT, args, stats, (recorded.opened, asyncio.get_running_loop().time()))
+        self.reader = reader
+        self.writer = writer
+
+    async def open(self):
+        self.start_reading()
+
+
+class UdpClientSide(SessionReplayer, asyncio.DatagramProtocol):
+    """Plays a recorded UDP client against a server; follows the server to its session port."""
+    async def open(self):
+        self.server_addr = None
+        self.transport, _ = await asyncio.get_running_loop().create_datagram_endpoint(
+            lambda: self, local_addr=("0.0.0.0", 0))
+
+    def datagram_received(self, data, addr):
+        if addr[1] != self.args.port:
+            self.server_addr = addr
+        self.received(1)
+
+    def send(self, payload, flags):
+        main = (self.args.host, self.args.port)
+        self.transport.sendto(payload, main if flags & FLAG_MAIN_SOCKET else (self.server_addr or main))
+
+    def close(self):
+        if hasattr(self, "transport"):
+            self.transport.close()
+
+
+class UdpServerSide(SessionReplayer, asyncio.DatagramProtocol):
+    """Plays a recorded UDP server to one client: main-socket frames from the listener, the rest from a session port."""
+    def __init__(self, recorded, args, stats, listener, client_addr):
+        super().__init__(recorded, KIND_OUT, args, stats, (recorded.opened, asyncio.get_running_loop().time()))
+        self.listener = listener
+        self.client_addr = client_addr
+        self.transport = None
+
+    async def open(self):
+        self.transport, _ = await asyncio.get_running_loop().create_datagram_endpoint(
+            lambda: self, local_addr=(self.args.host, 0))
+
+    def datagram_received(self, data, addr):
+        self.received(1)
+
+    def send(self, payload, flags):
+        (self.listener.transport if flags & FLAG_MAIN_SOCKET else self.transport).sendto(payload, self.client_addr)
+
+    def close(self):
+        if self.transport is not None:
+            self.transport.close()
+
+
+class UdpListener(asyncio.DatagramProtocol):
+    """Main port of the client mode: each new source address gets the next recorded UDP session."""
+    def __init__(self, sessions, args, stats, tasks):
+        self.pending = list(sessions)
+        self.args = args
+        self.stats = stats
+        self.tasks = tasks
+        self.replayers = {} # Key: client address, Value: UdpServerSide
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        replayer = self.replayers.get(addr)
+        if replayer is None:
+            if not self.pending:
+                return
+            replayer = self.replayers[addr] = UdpServerSide(self.pending.pop(0), self.args, self.stats, self, addr)
+            self.tasks.append(asyncio.ensure_future(replayer.run()))
+        replayer.received(1)
+
+
+async def drive_server(sessions, args, stats):
+    loop = asyncio.get_running_loop()
+    origin = (sessions[0].opened, loop.time())
+    replayers = []
+    for recorded in sessions:
+        side = TcpClientSide if recorded.transport == "tcp" else UdpClientSide
+        replayers.append(side(recorded, KIND_IN, args, stats, origin))
+
+    async def start(replayer):
+        await replayer.wait_until(replayer.recorded.opened)
+        await replayer.run()
+
+    await asyncio.gather(*(start(replayer) for replayer in replayers))
+
+
+async def drive_client(sessions, args, stats):
+    loop = asyncio.get_running_loop()
+    tasks = []
+    tcp_sessions = [session for session in sessions if session.transport == "tcp"]
+    udp_sessions = [session for session in sessions if session.transport == "udp"]
+    server = None
+    if tcp_sessions:
+        async def accept(reader, writer):
+            if tcp_sessions:
+                replayer = TcpServerSide(tcp_sessions.pop(0), args, stats, reader, writer)
+                tasks.append(asyncio.ensure_future(replayer.run()))
+            else:
+                writer.close()
+        server = await asyncio.start_server(accept, args.host, args.port)
+    listener = None
+    if udp_sessions:
+        _, listener = await loop.create_datagram_endpoint(
+            lambda: UdpListener(udp_sessions, args, stats, tasks), local_addr=(args.host, args.port))
+    print(f"Waiting for {len(sessions)} client session(s) on {args.host}:{args.port}...", file=sys.stderr)
+    while tcp_sessions or (listener is not None and listener.pending) or not all(task.done() for task in tasks):
+        await asyncio.sleep(0.05)
+    if server is not None:
+        server.close()
+    if listener is not None:
+        listener.transport.close()
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Dump or replay an IPK25-CHAT frame trace")
+    parser.add_argument("mode", choices=("dump", "server", "client"),
+                        help="dump records, drive a server with the recorded clients, or drive a client")
+    parser.add_argument("trace", help="Trace file written with --trace")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=4567,
+                        help="Server to connect to (server mode) or port to listen on (client mode)")
+    parser.add_argument("--speed", type=float, default=1.0, help="Playback speed factor (0 = as fast as possible)")
+    parser.add_argument("--causality-timeout", type=float, default=DEFAULT_CAUSALITY_TIMEOUT,
+                        help="Seconds a frame waits for the peer frames recorded before it")
+    parser.add_argument("--session", type=int, action="append", default=[], metavar="ID",
+                        help="Replay only this recorded session (repeatable)")
+    return parser.parse_args()
+
+
+async def replay(args):
+    sessions, lost = load_sessions(args.trace)
+    if args.session:
+        sessions = [session for session in sessions if session.session_id in args.session]
+    if not sessions:
+        raise SystemExit("No sessions to replay")
+    span = max(session.closed or (session.frames[-1][0] if session.frames else session.opened)
+               for session in sessions) - sessions[0].opened
+    stats = ReplayStats()
+    loop = asyncio.get_running_loop()
+    started = loop.time()
+    await (drive_server if args.mode == "server" else drive_client)(sessions, args, stats)
+    return stats.report(args, loop.time() - started, span, lost)
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    if args.mode == "dump":
+        dump(args.trace)
+    else:
+        print(json.dumps(asyncio.run(replay(args)), indent=2))
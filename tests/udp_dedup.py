@@ -0,0 +1,58 @@
+# --- Duplicate Detection for Client MessageIDs ---
+# Replaces the per-session set of every MessageID ever received. The set grows
+# for the life of the session and, once the uint16 MessageID wraps, marks real
+# new messages as duplicates. This is an anti-replay style sliding window: the
+# highest MessageID seen so far plus a bitmask of the WINDOW_SIZE IDs behind it.
+# Memory per session is constant and every check is O(1).
+
+MESSAGE_ID_SPACE = 65536 # MessageID is a uint16
+HALF_SPACE = MESSAGE_ID_SPACE // 2 # Serial number arithmetic (RFC 1982): "ahead" means less than half the space
+WINDOW_SIZE = 64 # How far behind the high-water mark a late retransmit is still recognised; clients are stop-and-wait
+WINDOW_MASK = (1 << WINDOW_SIZE) - 1
+
+
+def window_contains(high, mask, msg_id):
+    """True if msg_id was already received, or is too old to tell (treated as a duplicate).
+
+    high is the highest MessageID seen (None before the first one) and bit n of
+    mask is set when MessageID (high - n) was received.
+    """
+    if high is None:
+        return False
+    behind = (high - msg_id) % MESSAGE_ID_SPACE
+    if behind >= HALF_SPACE:
+        return False # Ahead of the high-water mark: new
+    if behind >= WINDOW_SIZE:
+        return True # Older than the window; a late retransmit at best
+    return (mask >> behind) & 1 == 1
+
+def window_add(high, mask, msg_id):
+    """Records msg_id. Returns the new (high, mask)."""
+    if high is None:
+        return msg_id, 1
+    ahead = (msg_id - high) % MESSAGE_ID_SPACE
+    if 0 < ahead < HALF_SPACE:
+        # Slide the window forward; bits pushed past WINDOW_SIZE are dropped
+        return msg_id, (((mask << ahead) | 1) & WINDOW_MASK if ahead < WINDOW_SIZE else 1)
+    behind = (high - msg_id) % MESSAGE_ID_SPACE
+    if behind < WINDOW_SIZE:
+        mask |= 1 << behind
+    return high, mask
+
+
+class MessageIdWindow:
+    """Wraparound-aware record of recently received client MessageIDs.
+
+    Session records embed the same two fields as slots and call the functions above directly.
+    """
+    __slots__ = ("high", "mask")
+
+    def __init__(self):
+        self.high = None # Highest MessageID seen (in serial order), None before the first one
+        self.mask = 0 # Bit n set = MessageID (high - n) was received
+
+    def contains(self, msg_id):
+        return window_contains(self.high, self.mask, msg_id)
+
+    def add(self, msg_id):
+        self.high, self.mask = window_add(self.high, self.mask, msg_id)
@@ -0,0 +1,167 @@
+import collections
+import random
+import time
+
+from server_log import log
+
+# --- Network Impairment Simulator ---
+# Sits between the UDP server logic and sendto()/recvfrom() and misbehaves in a
+# controlled, reproducible way: loss, duplication, reordering and delay/jitter.
+# Delayed and held-back packets are scheduled on the server's TimerQueue, so no
+# thread ever sleeps and the main loop keeps serving other sessions meanwhile.
+
+DELAY_DISTRIBUTIONS = ("constant", "uniform", "normal", "exponential")
+
+
+class ImpairmentConfig:
+    """Impairment parameters for one direction. Percentages are 0-100, times are seconds."""
+    def __init__(self, loss=0.0, duplicate=0.0, reorder=0.0, reorder_window=3, reorder_timeout=0.5,
+                 delay=0.0, jitter=0.0, distribution="constant"):
+        if distribution not in DELAY_DISTRIBUTIONS:
+            raise ValueError(f"Unknown delay distribution '{distribution}'")
+        self.loss = loss / 100
+        self.duplicate = duplicate / 100
+        self.reorder = reorder / 100
+        self.reorder_window = reorder_window # Held packet is released after this many later packets...
+        self.reorder_timeout = reorder_timeout # ...or after this long, whichever comes first
+        self.delay = delay
+        self.jitter = jitter
+        self.distribution = distribution
+
+    def is_active(self):
+        return bool(self.loss or self.duplicate or self.reorder or self.delay or self.jitter)
+
+
+class ImpairmentStats:
+    __slots__ = ("passed", "dropped", "duplicated", "reordered", "delayed")
+
+    def __init__(self):
+        self.passed = 0
+        self.dropped = 0
+        self.duplicated = 0
+        self.reordered = 0
+        self.delayed = 0
+
+    def __str__(self):
+        return (f"passed={self.passed} dropped={self.dropped} duplicated={self.duplicated} "
+                f"reordered={self.reordered} delayed={self.delayed}")
+
+
+class ImpairedPath:
+    """Applies one ImpairmentConfig to a stream of packets handed to a deliver callback."""
+    def __init__(self, config, timers, rng, clock=time.time):
+        self.config = config
+        self.timers = timers
+        self.rng = rng
+        self.clock = clock
+        self.held = collections.deque() # Reordered packets: [packets_to_wait, deliver, args, timer]
+        self.stats = ImpairmentStats()
+
+    def submit(self, deliver, *args):
+        """Passes a packet through the impairments; deliver(*args) performs the real I/O."""
+        self.stats.passed += 1
+        overtaken = self._count_down_held() if self.held else ()
+        self._impair(deliver, args)
+        # Held packets go out after the packet that overtook them
+        for entry in overtaken:
+            self._delay(entry[1], entry[2])
+
+    def _impair(self, deliver, args):
+        config = self.config
+        random_value = self.rng.random
+        if config.loss and random_value() < config.loss:
+            self.stats.dropped += 1
+            return
+        copies = 1
+        if config.duplicate and random_value() < config.duplicate:
+            self.stats.duplicated += 1
+            copies = 2
+        for _ in range(copies):
+            if config.reorder and random_value() < config.reorder:
+                self._hold(deliver, args)
+            else:
+                self._delay(deliver, args)
+
+    def _sample_delay(self):
+        config = self.config
+        if config.distribution == "constant":
+            delay = config.delay
+        elif config.distribution == "uniform":
+            delay = config.delay + self.rng.uniform(-config.jitter, config.jitter)
+        elif config.distribution == "normal":
+            delay = self.rng.gauss(config.delay, config.jitter)
+        else: # exponential: mean = delay, shifted by jitter as a fixed floor
+            delay = config.jitter + (self.rng.expovariate(1 / config.delay) if config.delay else 0)
+        return max(delay, 0.0)
+
+    def _delay(self, deliver, args):
+        delay = self._sample_delay() if (self.config.delay or self.config.jitter) else 0
+        if delay <= 0:
+            deliver(*args)
+            return
+        self.stats.delayed += 1
+        self.timers.schedule(self.clock() + delay, deliver, *args)
+
+    def _hold(self, deliver, args):
+        self.stats.reordered += 1
+        entry = [self.config.reorder_window, deliver, args, None]
+        entry[3] = self.timers.schedule(self.clock() + self.config.reorder_timeout, self._release, entry)
+        self.held.append(entry)
+
+    def _count_down_held(self):
+        """Counts one more packet past every held packet; returns (and unholds) those now due."""
+        due = []
+        for entry in self.held:
+            entry[0] -= 1
+            if entry[0] <= 0:
+                due.append(entry)
+        for entry in due:
+            self.held.remove(entry)
+            self.timers.cancel(entry[3])
+        return due
+
+    def _release(self, entry):
+        """Timer callback: the reorder timeout passed before enough packets overtook this one."""
+        try:
+            self.held.remove(entry)
+        except ValueError:
+            return # Already released by the packet counter
+        self._delay(entry[1], entry[2])
+
+
+class ImpairedLink:
+    """Wraps outbound sendto() and inbound datagram dispatch with independent impairments."""
+    def __init__(self, outbound, inbound, timers, seed=None, clock=time.time):
+        rng = random.Random(seed) # One seeded RNG keeps whole runs reproducible
+        self.outbound = ImpairedPath(outbound, timers, rng, clock) if outbound.is_active() else None
+        self.inbound = ImpairedPath(inbound, timers, rng, clock) if inbound.is_active() else None
+
+    def sendto(self, sock, data, addr):
+        if self.outbound is None:
+            sock.sendto(data, addr)
+        else:
+            self.outbound.submit(_send_if_open, sock, data, addr)
+
+    def deliver(self, handler, *args):
+        """Hands a received datagram to handler(*args), possibly late, twice or never."""
+        if self.inbound is None:
+            handler(*args)
+        else:
+            self.inbound.submit(handler, *args)
+
+    def describe(self):
+        parts = []
+        if self.outbound:
+            parts.append(f"outbound: {self.outbound.stats}")
+        if self.inbound:
+            parts.append(f"inbound: {self.inbound.stats}")
+        return "; ".join(parts) or "no impairment"
+
+
+def _send_if_open(sock, data, addr):
+    # A delayed packet may outlive the session whose socket it was queued on
+    if sock.fileno() >= 0:
+        try:
+            sock.sendto(data, addr)
+        except OSError as e:
+            log.error("Error sending delayed UDP to %s: %s", addr, e)
@@ -1,12 +1,34 @@
+import argparse
+import itertools
+import resource
+import selectors
 import socket
-import struct
 import sys
 import signal
 import threading
 import time
-import select
 import random
 
+from auth_backend import add_auth_arguments, authenticator_from_args
+from channel_history import add_history_arguments, history_from_args
+from chat_core import ChatCore
+from frame_trace import FLAG_MAIN_SOCKET, add_trace_arguments, trace_from_args
+from latency_tracker import add_latency_arguments, latency_from_args, update_rtt
+from sessions import Session, SessionState, SessionTable
+from server_log import add_log_arguments, configure_from_args, log
+from rate_limit import add_rate_limit_arguments, limiter_from_args
+from server_metrics import ServerMetrics, add_metrics_arguments, start_from_args as start_metrics
+from session_handoff import (accept_successor, add_handoff_arguments, decode_bytes, encode_bytes, exit_after_handoff,
+                             hand_off, handoff_from_args, restore_channels, restore_history, restore_session,
+                             snapshot_channels, snapshot_history, snapshot_session)
+from timer_queue import TimerQueue
+from udp_dedup import window_add, window_contains
+from udp_codec import (HEADER, HEADER_SIZE, MESSAGE_TYPE_NAMES, MSG_TYPE_AUTH, MSG_TYPE_BYE, MSG_TYPE_CONFIRM,
+                       MSG_TYPE_ERR, MSG_TYPE_JOIN, MSG_TYPE_MSG, MSG_TYPE_PING, MSG_TYPE_REPLY, pack_body,
+                       pack_confirm, pack_err, pack_ping, pack_reply, parse_header, unpack_strings)
+from udp_impairment import DELAY_DISTRIBUTIONS, ImpairedLink, ImpairmentConfig
+from worker_bus import fork_workers
+
 # --- Configuration ---
 HOST = "127.0.0.1"  # Listen on localhost
 PORT = 4567        # Default IPK25-CHAT port for AUTH
@@ -14,40 +36,68 @@ BUFFER_SIZE = 65535 # Max UDP datagram size technically possible (though MTU lim
 ENCODING = 'us-ascii' # As specified in the protocol
 PING_INTERVAL = 15 # Send PING every 15 seconds (example)
 CLIENT_TIMEOUT = 60 # Remove inactive client session after 60 seconds (example)
+REPLY_SOCKET_POOL_SIZE = 0 # 0 = one dynamic socket per session (as in the spec), N = share N reply sockets
+CONFIRM_TIMEOUT = 0.25 # Seconds to wait for the client's CONFIRM before retransmitting (spec default 250 ms)
+MAX_RETRIES = 3 # Retransmissions before the session is torn down (spec default 3)
+RECV_BATCH = 64 # Max datagrams drained from one readable socket per wakeup
+WORKERS = 1 # Processes sharing PORT via SO_REUSEPORT, see --workers
+TRANSPORT = "udp" # Key of this server's MSG bodies in the channel history
 
-
-# --- Message Types (from spec) ---
-MSG_TYPE_CONFIRM = 0x00
-MSG_TYPE_REPLY   = 0x01
-MSG_TYPE_AUTH    = 0x02
-MSG_TYPE_JOIN    = 0x03
-MSG_TYPE_MSG     = 0x04
-MSG_TYPE_PING    = 0xFD
-MSG_TYPE_ERR     = 0xFE
-MSG_TYPE_BYE     = 0xFF
+# Message types, their names and packers live in udp_codec.py
+LIMITED_MESSAGE_TYPES = frozenset((MSG_TYPE_JOIN, MSG_TYPE_MSG)) # Session messages under --rate-limit; AUTH is checked on the main socket
 
 # --- Session Management ---
-client_sessions = {} # Key: client_addr (ip, port), Value: SessionData object
+client_sessions = SessionTable() # Key: client_addr (ip, port), Value: SessionData object
 sessions_lock = threading.Lock() # To protect access to client_sessions
-
-# --- Sockets for select ---
+core = ChatCore() # Channels, MSG fan-out and history (--history); chat_server.py shares one with tcp_server.py
+timers = TimerQueue() # Retransmission deadlines of every session, driven by the main loop
+impairment = None # ImpairedLink when the server should simulate a bad network, see --loss etc.
+worker_bus = None # WorkerBus linking this process to the other workers when WORKERS > 1
+limiter = None # RateLimiter when --rate-limit/--ip-rate-limit is given
+trace = None # TraceRecorder when --trace is given
+authenticator = None # Authenticator when --auth-db is given; without it every AUTH succeeds
+auth_pending = {} # Key: client_addr, Value: MessageID of its AUTH from the main socket being verified
+latency = None # LatencyTracker when --latency is given
+metrics = ServerMetrics()
+clock = time.time # Wall clock for every deadline and activity time; simulation.py swaps in a VirtualClock
+
+# --- Sockets ---
+# selectors picks epoll/kqueue where available: O(ready sockets) per wakeup and no FD_SETSIZE cap
+SOCKET_MAIN = "main"
+SOCKET_DYNAMIC = "dynamic" # Dedicated to one session
+SOCKET_POOL = "pool" # Shared reply socket serving many sessions
+SOCKET_BUS = "bus" # Unix socket to another pre-fork worker
+SOCKET_HANDOFF = "handoff" # Unix socket a successor process connects to, see --handoff
+SOCKET_AUTH = "auth" # Readable when the authenticator has verdicts for the loop
 main_socket = None
-monitored_sockets = [] # List of sockets to monitor with select() [main_socket, dynamic_socket1, ...]
-socket_to_session = {} # Map socket object back to client_addr for dynamic sockets
-
-class SessionData:
+make_socket = socket.socket # Replaced by SimulatedNetwork.socket under simulation.py
+selector = selectors.DefaultSelector()
+socket_to_session = {} # Map dedicated dynamic socket back to client_addr
+reply_socket_pool = [] # Shared reply sockets when REPLY_SOCKET_POOL_SIZE > 0
+reply_socket_cycle = None # Round-robin assignment of sessions to pooled sockets
+handoff_listener = None # Listening Unix socket when --handoff is given
+
+class SessionData(Session):
     """Stores state for an active client session."""
+    __slots__ = ("socket", "server_message_id", "seen_high", "seen_mask", "auth_reply_id", "outstanding",
+                 "ping_timer", "expiry_timer", "srtt", "rttvar")
+    transport = TRANSPORT # Channel member interface, see chat_core.py
+    encode_msg = staticmethod(pack_body)
+
     def __init__(self, client_addr, dynamic_socket):
-        self.client_addr = client_addr
+        super().__init__(client_addr) # Last activity lives in client_sessions, see sessions.py
         self.socket = dynamic_socket # The dynamic socket for this session
-        self.state = "NEEDS_AUTH" # Initial state before REPLY is sent
-        self.display_name = None
-        self.current_channel = "default"
         self.server_message_id = 0 # Counter for messages sent BY SERVER
-        self.received_client_message_ids = set() # IDs received FROM CLIENT
-        self.last_activity_time = time.time()
-        self.last_ping_time = time.time()
-        self.pending_auth_reply = None # Store details needed for AUTH REPLY after CONFIRM
+        self.seen_high = None # IDs received FROM CLIENT, bounded and wrap-aware, see udp_dedup.py
+        self.seen_mask = 0
+        self.auth_reply_id = None # MessageID of the AUTH REPLY whose CONFIRM completes authentication
+        self.outstanding = None # Key: server MessageID, Value: OutstandingMessage awaiting CONFIRM; None while empty
+        self.ping_timer = None # TimerQueue handles, see schedule_keepalive()
+        self.expiry_timer = None
+        self.srtt = None # Smoothed CONFIRM round trip and its variation in seconds, see latency_tracker.py
+        self.rttvar = None
+        if limiter is not None:
+            self.buckets = limiter.session_buckets(clock())
 
     def get_next_server_msg_id(self):
         msg_id = self.server_message_id
@@ -55,299 +105,420 @@ class SessionData:
         return msg_id
 
     def add_received_client_id(self, msg_id):
-        self.received_client_message_ids.add(msg_id)
+        self.seen_high, self.seen_mask = window_add(self.seen_high, self.seen_mask, msg_id)
 
     def has_received_client_id(self, msg_id):
-        return msg_id in self.received_client_message_ids
+        return window_contains(self.seen_high, self.seen_mask, msg_id)
+
+    def deliver(self, body, msg_trace=None):
+        """Sends a pre-encoded MSG body reliably under this session's next MessageID."""
+        # Only the header differs per recipient: each session has its own MessageID sequence
+        msg_id = self.get_next_server_msg_id()
+        send_reliable(self, msg_id, HEADER.pack(MSG_TYPE_MSG, msg_id) + body, msg_trace)
+        if msg_trace is not None:
+            latency.written(msg_trace, self)
 
-    def update_activity(self):
-        self.last_activity_time = time.time()
+
+class OutstandingMessage:
+    """A server message that has been sent but not yet CONFIRMed by the client."""
+    __slots__ = ("data", "first_sent", "attempts", "timer", "msg_trace")
+
+    def __init__(self, data, first_sent, msg_trace=None):
+        self.data = data
+        self.first_sent = first_sent
+        self.attempts = 1
+        self.timer = None
+        self.msg_trace = msg_trace # MessageTrace of a traced MSG, timed until its CONFIRM
 
 
 # --- Message Packing / Unpacking Helpers ---
+# Packers and field parsing live in udp_codec.py; this wrapper keeps the old call shape.
+
+GAUGE_STATES = (SessionState.NEEDS_AUTH, SessionState.WAITING_REPLY_CONFIRM, SessionState.AUTHENTICATED)
+
+def sessions_by_state():
+    """Gauge callback for the metrics endpoint."""
+    with sessions_lock:
+        return client_sessions.count_by_state(GAUGE_STATES)
+
+metrics.bind_sessions(sessions_by_state)
 
-def pack_confirm(ref_message_id):
-    # CONFIRM has no MessageID of its own, only Ref_MessageID
-    return struct.pack('>BH', MSG_TYPE_CONFIRM, ref_message_id)
-
-def pack_reply(message_id, result, ref_message_id, content):
-    # >B H B H s x (Type, MsgID, Result, RefMsgID, Content, Null)
-    encoded_content = content.encode(ENCODING)
-    fmt = f'>BHBH{len(encoded_content)}sx' # x for the null terminator
-    return struct.pack(fmt, MSG_TYPE_REPLY, message_id, result, ref_message_id, encoded_content)
-
-def pack_auth(message_id, username, display_name, secret):
-    # >B H s x s x s x
-    enc_user = username.encode(ENCODING)
-    enc_display = display_name.encode(ENCODING)
-    enc_secret = secret.encode(ENCODING)
-    fmt = f'>BH{len(enc_user)}sx{len(enc_display)}sx{len(enc_secret)}sx'
-    return struct.pack(fmt, MSG_TYPE_AUTH, message_id, enc_user, enc_display, enc_secret)
-
-def pack_join(message_id, channel_id, display_name):
-     # >B H s x s x
-    enc_channel = channel_id.encode(ENCODING)
-    enc_display = display_name.encode(ENCODING)
-    fmt = f'>BH{len(enc_channel)}sx{len(enc_display)}sx'
-    return struct.pack(fmt, MSG_TYPE_JOIN, message_id, enc_channel, enc_display)
-
-def pack_msg(message_id, display_name, content):
-    # >B H s x s x
-    enc_display = display_name.encode(ENCODING)
-    enc_content = content.encode(ENCODING)
-    fmt = f'>BH{len(enc_display)}sx{len(enc_content)}sx'
-    return struct.pack(fmt, MSG_TYPE_MSG, message_id, enc_display, enc_content)
-
-def pack_err(message_id, display_name, content):
-    # Same structure as MSG
-    enc_display = display_name.encode(ENCODING)
-    enc_content = content.encode(ENCODING)
-    fmt = f'>BH{len(enc_display)}sx{len(enc_content)}sx'
-    return struct.pack(fmt, MSG_TYPE_ERR, message_id, enc_display, enc_content)
-
-def pack_bye(message_id, display_name):
-    # >B H s x
-    enc_display = display_name.encode(ENCODING)
-    fmt = f'>BH{len(enc_display)}sx'
-    return struct.pack(fmt, MSG_TYPE_BYE, message_id, enc_display)
-
-def pack_ping(message_id):
-    # >B H
-    return struct.pack('>BH', MSG_TYPE_PING, message_id)
 
 def parse_udp_message(data):
-    """Parses the header and identifies the type. Returns (type, msg_id, remaining_data) or None."""
-    if len(data) < 3:
-        return None # Not enough data for header
-    msg_type, msg_id = struct.unpack('>BH', data[:3])
-    return msg_type, msg_id, data[3:]
-
-def unpack_string_from(data):
-    """Finds the first null byte and returns the decoded string and remaining data."""
-    try:
-        null_pos = data.index(b'\x00')
-        value = data[:null_pos].decode(ENCODING)
-        remaining = data[null_pos+1:]
-        return value, remaining
-    except (ValueError, UnicodeDecodeError): # Null byte not found or decode error
-        return None, data
+    """Parses the header and identifies the type. Returns (type, msg_id) or None."""
+    return parse_header(data)
 
 
 # --- Server Logic ---
 
+def log_sent_packet(message_bytes, target_addr):
+    """Logs type and MsgID (RefID for CONFIRM) of an outgoing datagram."""
+    msg_type = message_bytes[0]
+    type_name = MESSAGE_TYPE_NAMES.get(msg_type) or f"UNKNOWN(0x{msg_type:02X})"
+    if len(message_bytes) < HEADER_SIZE:
+        log.packet("SND to %s: %s (Malformed header?)", target_addr, type_name)
+    elif msg_type == MSG_TYPE_CONFIRM:
+        log.packet("SND to %s: %s (RefID: %d)", target_addr, type_name, HEADER.unpack_from(message_bytes)[1])
+    else:
+        log.packet("SND to %s: %s (MsgID: %d)", target_addr, type_name, HEADER.unpack_from(message_bytes)[1])
+
+
 def send_udp(sock, message_bytes, target_addr):
     """Sends UDP data and logs it."""
     try:
-        # Simple logging: Type and maybe MsgID if not CONFIRM
-        msg_type = message_bytes[0]
-        type_name = {
-            0x00: "CONFIRM", 0x01: "REPLY", 0x02: "AUTH", 0x03: "JOIN",
-            0x04: "MSG", 0xFD: "PING", 0xFE: "ERR", 0xFF: "BYE"
-        }.get(msg_type, f"UNKNOWN(0x{msg_type:02X})")
-
-        if msg_type == MSG_TYPE_CONFIRM and len(message_bytes) >= 3:
-            ref_id = struct.unpack('>H', message_bytes[1:3])[0]
-            print(f"SND to {target_addr}: {type_name} (RefID: {ref_id})")
-        elif len(message_bytes) >= 3:
-             msg_id = struct.unpack('>H', message_bytes[1:3])[0]
-             print(f"SND to {target_addr}: {type_name} (MsgID: {msg_id})")
+        if log.packet_enabled: # Header is only decoded when the line can actually be written
+            log_sent_packet(message_bytes, target_addr)
+        metrics.messages_sent.inc(MESSAGE_TYPE_NAMES.get(message_bytes[0], "UNKNOWN"))
+        metrics.bytes_sent.inc(amount=len(message_bytes))
+        if trace is not None:
+            trace.outbound(target_addr, message_bytes, FLAG_MAIN_SOCKET if sock is main_socket else 0)
+
+        if impairment is None:
+            sock.sendto(message_bytes, target_addr)
         else:
-             print(f"SND to {target_addr}: {type_name} (Malformed header?)")
-
-        sock.sendto(message_bytes, target_addr)
+            impairment.sendto(sock, message_bytes, target_addr)
     except OSError as e:
-        print(f"Error sending UDP to {target_addr}: {e}")
+        log.error(f"Error sending UDP to {target_addr}: {e}")
     except Exception as e:
-        print(f"Unexpected error sending UDP: {e}")
-
-
-def handle_auth(data, client_addr):
-    """Handles an AUTH message received on the main socket."""
-    global monitored_sockets, socket_to_session
-
+        log.error(f"Unexpected error sending UDP: {e}")
+
+
+def send_reliable(session, msg_id, message_bytes, msg_trace=None):
+    """Sends a server message and retransmits it until the client CONFIRMs it."""
+    now = clock()
+    entry = OutstandingMessage(message_bytes, now, msg_trace)
+    if session.outstanding is None:
+        session.outstanding = {}
+    session.outstanding[msg_id] = entry
+    entry.timer = timers.schedule(now + CONFIRM_TIMEOUT, retransmit, session, msg_id)
+    send_udp(session.socket, message_bytes, session.addr)
+
+
+def retransmit(session, msg_id):
+    """Timer callback: resends an unconfirmed message or gives up on the session."""
+    entry = session.outstanding.get(msg_id) if session.outstanding else None
+    if entry is None or client_sessions.get(session.addr) is not session:
+        return # Confirmed or session already gone
+    if entry.attempts > MAX_RETRIES:
+        log.error(f"No CONFIRM for MsgID {msg_id} from {session.addr} after {MAX_RETRIES} retries.")
+        metrics.timeouts.inc("retries")
+        terminate_session(session.addr, session.socket, "CONFIRM retries exhausted")
+        return
+    entry.attempts += 1
+    metrics.retransmissions.inc()
+    log.info("Retransmitting MsgID %d to %s (attempt %d)", msg_id, session.addr, entry.attempts)
+    entry.timer = timers.schedule(clock() + CONFIRM_TIMEOUT, retransmit, session, msg_id)
+    send_udp(session.socket, entry.data, session.addr)
+
+
+def handle_confirm(session, ref_msg_id):
+    """Matches a CONFIRM to its outstanding message. Returns the entry, or None if unknown."""
+    outstanding = session.outstanding
+    entry = outstanding.pop(ref_msg_id, None) if outstanding else None
+    if entry is None:
+        return None
+    if not outstanding:
+        session.outstanding = None # Idle sessions hold no dict
+    timers.cancel(entry.timer)
+    elapsed = clock() - entry.first_sent
+    log.debug("CONFIRM for MsgID %d from %s: %.1f ms after first send, %d attempt(s)",
+              ref_msg_id, session.addr, elapsed * 1000, entry.attempts)
+    if entry.attempts == 1: # Karn: after a retransmission the CONFIRM may answer either copy
+        update_rtt(session, elapsed)
+        metrics.confirm_rtt.observe(elapsed)
+        if latency is not None:
+            latency.rtt(session, elapsed)
+    if entry.msg_trace is not None:
+        latency.confirmed(entry.msg_trace, session)
+    return entry
+
+
+def publish_to_bus(channel_id, display_name, content, frames):
+    """ChatCore.on_broadcast with --workers: passes the broadcast on to sessions served by other workers."""
+    worker_bus.publish(channel_id, frames.get(TRANSPORT) or pack_body(display_name, content))
+
+
+def handle_auth(data, client_addr, admitted=False):
+    """Handles an AUTH message received on the main socket.
+
+    admitted is True when the rate limiter delayed this AUTH and it is now handled.
+    """
+    received_at = time.perf_counter()
     parsed = parse_udp_message(data)
+    if not admitted:
+        metrics.messages_received.inc(MESSAGE_TYPE_NAMES.get(parsed[0], "UNKNOWN") if parsed else "UNKNOWN")
     if not parsed or parsed[0] != MSG_TYPE_AUTH:
-        print(f"RCV from {client_addr} on main: Ignoring non-AUTH or malformed message.")
+        log.info(f"RCV from {client_addr} on main: Ignoring non-AUTH or malformed message.")
         return # Ignore non-AUTH on main port
 
-    msg_type, msg_id, content = parsed
-    print(f"RCV from {client_addr}: AUTH (MsgID: {msg_id})")
+    msg_type, msg_id = parsed
+    log.packet("RCV from %s: AUTH (MsgID: %d)", client_addr, msg_id)
 
     # --- Check for existing session trying to re-AUTH ---
     # A simple approach: If already exists, just confirm the AUTH again.
     # A stricter server might reject re-authentication attempts.
     with sessions_lock:
-        if client_addr in client_sessions:
-            session = client_sessions[client_addr]
-            print(f"Client {client_addr} already has session, confirming AUTH {msg_id} again from main socket.")
+        session = client_sessions.get(client_addr)
+        if session is not None:
+            log.info(f"Client {client_addr} already has session, confirming AUTH {msg_id} again from main socket.")
             if not session.has_received_client_id(msg_id):
                  session.add_received_client_id(msg_id) # Track it even if re-auth
-                 session.update_activity()
+                 client_sessions.touch(session, clock())
             # Send CONFIRM from the *main* socket as per spec diagram for initial AUTH
             confirm_msg = pack_confirm(msg_id)
             send_udp(main_socket, confirm_msg, client_addr)
             return # Don't create a new session
+    if client_addr in auth_pending:
+        log.debug("AUTH %d from %s is still being verified, confirming it again", msg_id, client_addr)
+        send_udp(main_socket, pack_confirm(msg_id), client_addr)
+        return
+
+    # --- Rate limit new sessions per source IP ---
+    if limiter is not None and not admitted:
+        now = clock()
+        action, wait = limiter.check(None, client_addr[0], "AUTH", now)
+        if action is not None:
+            # CONFIRM anyway, so the client does not retransmit into the limit
+            send_udp(main_socket, pack_confirm(msg_id), client_addr)
+            if action == "delay":
+                log.debug("Throttled AUTH from %s: handling it in %.3f s", client_addr, wait)
+                timers.schedule(now + wait, handle_delayed_auth, data, client_addr)
+            elif action == "disconnect":
+                log.info(f"Client {client_addr} exceeded the AUTH rate limit. Sending ERR.")
+                send_udp(main_socket, pack_err(0, "Server", "Rate limit exceeded."), client_addr) # No session to retransmit from
+            else:
+                log.debug("Throttled AUTH from %s: dropped", client_addr)
+            return
 
     # --- Parse AUTH content ---
-    username, remaining = unpack_string_from(content)
-    if username is None: return print_err("Malformed AUTH: Cannot parse Username")
-    display_name, remaining = unpack_string_from(remaining)
-    if display_name is None: return print_err("Malformed AUTH: Cannot parse DisplayName")
-    secret, remaining = unpack_string_from(remaining)
-    if secret is None: return print_err("Malformed AUTH: Cannot parse Secret")
+    fields = unpack_strings(data, 3)
+    if fields is None: return print_err("Malformed AUTH: Cannot parse Username, DisplayName and Secret")
+    username, display_name, secret = fields
+
+    log.debug("AUTH details: User='%s', Display='%s', Secret='%s...'", username, display_name, secret[:5])
+
+    # --- Send CONFIRM for AUTH (from main socket) ---
+    # Right away, so the client does not retransmit while the secret is being checked
+    send_udp(main_socket, pack_confirm(msg_id), client_addr)
+    if authenticator is None:
+        open_session(client_addr, msg_id, display_name, received_at)
+    else:
+        auth_pending[client_addr] = msg_id
+        authenticator.verify_later(username, secret, open_session, client_addr, msg_id, display_name, received_at)
+
 
-    print(f"AUTH details: User='{username}', Display='{display_name}', Secret='{secret[:5]}...'")
+def open_session(client_addr, msg_id, display_name, received_at, verdict=None):
+    """Creates the session for an AUTH from the main socket and sends the REPLY from its own socket.
+
+    verdict is None when AUTH is not checked. A rejected AUTH gets a session too,
+    left in NEEDS_AUTH, so the client can retry from the port the REPLY NOK came from.
+    """
+    if verdict is not None:
+        del auth_pending[client_addr]
+        metrics.record_auth(verdict)
 
     # --- Create Dynamic Socket and Session ---
-    try:
-        dynamic_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        dynamic_sock.bind((HOST, 0)) # Bind to ephemeral port
-        dynamic_port = dynamic_sock.getsockname()[1]
-        print(f"Allocated dynamic port {dynamic_port} for {client_addr}")
-    except OSError as e:
-        print(f"Error creating dynamic socket for {client_addr}: {e}")
-        # Maybe send ERR back from main socket? Difficult without established session.
-        return
+    if reply_socket_pool:
+        dynamic_sock = next(reply_socket_cycle)
+        log.info(f"Assigned pooled port {dynamic_sock.getsockname()[1]} to {client_addr}")
+    else:
+        try:
+            dynamic_sock = open_reply_socket()
+            log.info(f"Allocated dynamic port {dynamic_sock.getsockname()[1]} for {client_addr}")
+        except OSError as e:
+            log.error(f"Error creating dynamic socket for {client_addr}: {e}")
+            # Maybe send ERR back from main socket? Difficult without established session.
+            return
 
     # --- Store Session ---
     session = SessionData(client_addr, dynamic_sock)
-    session.display_name = display_name # Store display name now
     session.add_received_client_id(msg_id) # Mark AUTH msg_id as received
-    session.pending_auth_reply = { # Store details for REPLY after CONFIRM
-        "ref_msg_id": msg_id,
-        "content": "Auth success."
-    }
 
     with sessions_lock:
-        client_sessions[client_addr] = session
-        monitored_sockets.append(dynamic_sock) # Add new socket to select list
-        socket_to_session[dynamic_sock] = client_addr # Map socket back to client
+        client_sessions.add(client_addr, session, clock())
+        if not reply_socket_pool:
+            selector.register(dynamic_sock, selectors.EVENT_READ, SOCKET_DYNAMIC)
+            socket_to_session[dynamic_sock] = client_addr # Map socket back to client
 
-    # --- Send CONFIRM for AUTH (from main socket) ---
-    confirm_msg = pack_confirm(msg_id)
-    send_udp(main_socket, confirm_msg, client_addr)
+    schedule_keepalive(session)
+    reply_to_auth(session, msg_id, display_name, verdict is None or verdict.ok, received_at)
 
-    # --- Send REPLY for AUTH (from dynamic socket) ---
-    # This happens immediately after CONFIRM in this simple server
+
+def reply_to_auth(session, msg_id, display_name, ok, received_at):
+    """Sends the REPLY to the AUTH msg_id from the session's socket; on success the session joins the default channel."""
     reply_msg_id = session.get_next_server_msg_id()
-    reply_content = session.pending_auth_reply["content"]
-    reply_ref_id = session.pending_auth_reply["ref_msg_id"]
-    reply_msg = pack_reply(reply_msg_id, 1, reply_ref_id, reply_content) # 1 = success
-    send_udp(session.socket, reply_msg, session.client_addr)
-    session.state = "WAITING_REPLY_CONFIRM" # State change after sending REPLY
-    session.pending_auth_reply = None
-    session.update_activity()
-    print(f"Session created for {client_addr}. State -> WAITING_REPLY_CONFIRM")
-
-     # Send the initial "Joined default" MSG right after REPLY
-    msg_join_id = session.get_next_server_msg_id()
-    msg_join_content = f"{session.display_name} joined {session.current_channel}."
-    msg_join = pack_msg(msg_join_id, "Server", msg_join_content)
-    send_udp(session.socket, msg_join, session.client_addr)
+    if not ok:
+        log.info(f"Client {session.addr} failed to authenticate. State stays NEEDS_AUTH")
+        send_reliable(session, reply_msg_id, pack_reply(reply_msg_id, 0, msg_id, "Authentication failed."))
+        metrics.auth_latency.observe(time.perf_counter() - received_at)
+        return
+    session.display_name = display_name # Store display name now
+    reply_msg = pack_reply(reply_msg_id, 1, msg_id, "Auth success.") # 1 = success, ref_id = AUTH msg id
+    session.auth_reply_id = reply_msg_id
+    send_reliable(session, reply_msg_id, reply_msg)
+    metrics.auth_latency.observe(time.perf_counter() - received_at)
+    session.state = SessionState.WAITING_REPLY_CONFIRM # State change after sending REPLY
+    client_sessions.touch(session, clock())
+    log.info(f"Session created for {session.addr}. State -> WAITING_REPLY_CONFIRM")
+
+    # Join the default channel right after REPLY; this sends the "joined default" MSG
+    core.join(session, session.current_channel)
+
+
+def finish_auth_retry(session, msg_id, display_name, received_at, verdict):
+    """verify_later() callback for an AUTH retried on the session's socket."""
+    if client_sessions.get(session.addr) is not session or session.state != SessionState.NEEDS_AUTH:
+        return # Terminated, or an earlier retry succeeded meanwhile
+    metrics.record_auth(verdict)
+    reply_to_auth(session, msg_id, display_name, verdict.ok, received_at)
+
+
+def handle_delayed_auth(data, client_addr):
+    """Timer callback handling an AUTH the rate limiter delayed."""
+    try:
+        handle_auth(data, client_addr, admitted=True)
+    except Exception as e:
+        log.error(f"Unexpected error handling delayed AUTH from {client_addr}: {e}")
 
 
 def handle_dynamic_message(sock, data, client_addr):
     """Handles messages received on a dynamic client socket."""
-    session = None
+    received_at = time.perf_counter()
+    metrics.messages_received.inc(MESSAGE_TYPE_NAMES.get(data[0], "UNKNOWN"))
     with sessions_lock:
-        # Verify the message source matches the session associated with this socket
-        if sock in socket_to_session and socket_to_session[sock] == client_addr:
-            session = client_sessions.get(client_addr)
+        session = client_sessions.get(client_addr)
+    # Verify the message arrived on the socket assigned to this session (dedicated or pooled)
+    if session and session.socket is not sock:
+        session = None
 
     if not session:
-        print(f"RCV on dynamic socket {sock.getsockname()} from {client_addr}: No matching session found. Ignoring.")
+        log.info(f"RCV on dynamic socket {sock.getsockname()} from {client_addr}: No matching session found. Ignoring.")
         return
 
-    session.update_activity() # Update activity on any valid message
+    client_sessions.touch(session, clock()) # Update activity on any valid message
 
     # --- Handle CONFIRM ---
     if data[0] == MSG_TYPE_CONFIRM:
         if len(data) < 3: return print_err(f"Malformed CONFIRM from {client_addr}")
-        ref_msg_id = struct.unpack('>H', data[1:3])[0]
-        print(f"RCV from {client_addr}: CONFIRM (RefID: {ref_msg_id})")
-        # Server doesn't explicitly wait for confirms in this simple model,
-        # but we can use this to transition state, e.g., after sending REPLY.
-        if session.state == "WAITING_REPLY_CONFIRM": # Assuming RefID matches the REPLY msg ID
-             print(f"Authentication for {client_addr} confirmed. State -> AUTHENTICATED")
-             session.state = "AUTHENTICATED"
-        # Handle confirm for ERR/BYE if needed for cleanup states
-        elif session.state == "SENT_ERR" or session.state == "SENT_BYE":
-             print(f"CONFIRM received for final message from {client_addr}. Ready for cleanup.")
-             # Mark session for cleanup? Or just let timeout handle it.
+        ref_msg_id = HEADER.unpack_from(data)[1]
+        log.packet("RCV from %s: CONFIRM (RefID: %d)", client_addr, ref_msg_id)
+        if handle_confirm(session, ref_msg_id) is None:
+            log.info(f"CONFIRM from {client_addr} for unknown or already confirmed MsgID {ref_msg_id}. Ignoring.")
+            return
+        # Use the confirmed message to transition state, e.g., after sending REPLY.
+        if session.state == SessionState.WAITING_REPLY_CONFIRM and ref_msg_id == session.auth_reply_id:
+             log.info(f"Authentication for {client_addr} confirmed. State -> AUTHENTICATED")
+             session.state = SessionState.AUTHENTICATED
+        elif session.state >= SessionState.SENT_ERR and not session.outstanding: # SENT_ERR or SENT_BYE
+             log.info(f"CONFIRM received for final message from {client_addr}. Cleaning up.")
+             terminate_session(client_addr, sock, f"Final message confirmed ({session.state.name})")
         return # No further processing for CONFIRM
 
     # --- Parse Non-CONFIRM Message ---
     parsed = parse_udp_message(data)
     if not parsed:
-        print(f"RCV from {client_addr}: Malformed message header.")
+        log.info(f"RCV from {client_addr}: Malformed message header.")
         # Send ERR? Need a message ID from the client to confirm. Difficult. Ignore for now.
         return
 
-    msg_type, msg_id, content = parsed
+    msg_type, msg_id = parsed
 
     # --- Duplicate Check ---
     if session.has_received_client_id(msg_id):
-        print(f"RCV from {client_addr}: Duplicate message (Type: 0x{msg_type:02X}, MsgID: {msg_id}). Sending CONFIRM only.")
+        log.debug("RCV from %s: Duplicate message (Type: 0x%02X, MsgID: %d). Sending CONFIRM only.", client_addr, msg_type, msg_id)
+        metrics.duplicates.inc()
         confirm_msg = pack_confirm(msg_id)
-        send_udp(session.socket, confirm_msg, session.client_addr)
+        send_udp(session.socket, confirm_msg, session.addr)
         return # Stop processing duplicate
 
     # --- Add new message ID to received set ---
     session.add_received_client_id(msg_id)
-    print(f"RCV from {client_addr}: Type=0x{msg_type:02X}, MsgID={msg_id}")
+    log.packet("RCV from %s: Type=0x%02X, MsgID=%d", client_addr, msg_type, msg_id)
 
     # --- Send CONFIRM for the new message ---
     confirm_msg = pack_confirm(msg_id)
-    send_udp(session.socket, confirm_msg, session.client_addr)
+    send_udp(session.socket, confirm_msg, session.addr)
+
+    # --- Rate Limits ---
+    # AUTH retries after a REPLY NOK arrive here rather than on the main socket, and count against the AUTH limits
+    if limiter is not None and ((msg_type in LIMITED_MESSAGE_TYPES and session.state == SessionState.AUTHENTICATED)
+                                or (msg_type == MSG_TYPE_AUTH and session.state == SessionState.NEEDS_AUTH)):
+        kind = MESSAGE_TYPE_NAMES[msg_type]
+        now = clock()
+        action, wait = limiter.check(session.buckets, client_addr[0], kind, now)
+        if action == "delay":
+            log.debug("Throttled %s from %s: handling it in %.3f s", kind, client_addr, wait)
+            timers.schedule(now + wait, process_delayed_message, session, sock, data, msg_type, msg_id,
+                            client_addr, received_at)
+            return
+        if action == "drop":
+            log.debug("Throttled %s from %s: dropped", kind, client_addr)
+            return
+        if action == "disconnect":
+            log.info(f"Client {client_addr} exceeded the {kind} rate limit. Sending ERR.")
+            reject_session(session, "Rate limit exceeded.")
+            return
+
+    process_session_message(session, sock, data, msg_type, msg_id, client_addr, received_at)
+
+
+def process_delayed_message(session, sock, data, msg_type, msg_id, client_addr, received_at):
+    """Timer callback handling a message the rate limiter delayed, if its session still exists."""
+    with sessions_lock:
+        if client_sessions.get(client_addr) is not session:
+            return
+    try:
+        process_session_message(session, sock, data, msg_type, msg_id, client_addr, received_at)
+    except Exception as e:
+        log.error(f"Unexpected error handling delayed message from {client_addr}: {e}")
+
 
-    # --- Process based on Type and State ---
-    if session.state == "AUTHENTICATED":
+def process_session_message(session, sock, data, msg_type, msg_id, client_addr, received_at):
+    """Handles a new, already CONFIRMed message according to the session state."""
+    if session.state == SessionState.AUTHENTICATED:
         if msg_type == MSG_TYPE_JOIN:
-            channel_id, remaining = unpack_string_from(content)
-            if channel_id is None: return print_err(f"Malformed JOIN from {client_addr}: Cannot parse ChannelID")
-            display_name_join, remaining = unpack_string_from(remaining) # Client sends this again
-            if display_name_join is None: return print_err(f"Malformed JOIN from {client_addr}: Cannot parse DisplayName")
+            fields = unpack_strings(data, 2)
+            if fields is None: return print_err(f"Malformed JOIN from {client_addr}: Cannot parse ChannelID and DisplayName")
+            channel_id, display_name_join = fields # Client sends the display name again
             if display_name_join != session.display_name:
-                print(f"WARN: JOIN DisplayName '{display_name_join}' mismatch for {client_addr}")
+                log.warn(f"JOIN DisplayName '{display_name_join}' mismatch for {client_addr}")
                 # Send ERR? Let's allow it but log.
                 # err_msg_id = session.get_next_server_msg_id()
                 # err_msg = pack_err(err_msg_id, "Server", "JOIN DisplayName mismatch.")
-                # send_udp(session.socket, err_msg, session.client_addr)
+                # send_udp(session.socket, err_msg, session.addr)
                 # session.state = "SENT_ERR" # Or maybe allow continue? For testing, let's allow.
 
-            print(f"Client {client_addr} joining channel '{channel_id}'")
-            session.current_channel = channel_id
+            log.info(f"Client {client_addr} joining channel '{channel_id}'")
 
             # Send REPLY for JOIN
             reply_msg_id = session.get_next_server_msg_id()
             reply_msg = pack_reply(reply_msg_id, 1, msg_id, "Join success.") # 1=OK, ref_id=JOIN msg id
-            send_udp(session.socket, reply_msg, session.client_addr)
+            send_reliable(session, reply_msg_id, reply_msg)
 
-            # Send MSG notification
-            msg_join_id = session.get_next_server_msg_id()
-            msg_join_content = f"{session.display_name} joined {session.current_channel}."
-            msg_join = pack_msg(msg_join_id, "Server", msg_join_content)
-            send_udp(session.socket, msg_join, session.client_addr)
+            # Switch channels; notifies members of the old and the new channel
+            core.join(session, channel_id)
 
 
         elif msg_type == MSG_TYPE_MSG:
-            display_name_msg, remaining = unpack_string_from(content)
-            if display_name_msg is None: return print_err(f"Malformed MSG from {client_addr}: Cannot parse DisplayName")
-            message_content, remaining = unpack_string_from(remaining)
-            if message_content is None: return print_err(f"Malformed MSG from {client_addr}: Cannot parse MessageContent")
+            fields = unpack_strings(data, 2)
+            if fields is None: return print_err(f"Malformed MSG from {client_addr}: Cannot parse DisplayName and MessageContent")
+            display_name_msg, message_content = fields
 
             if display_name_msg != session.display_name:
-                 print(f"WARN: MSG DisplayName '{display_name_msg}' mismatch for {client_addr}")
+                 log.warn(f"MSG DisplayName '{display_name_msg}' mismatch for {client_addr}")
                  # Send ERR? Let's allow and log for testing.
 
-            print(f"MSG from {client_addr} ({display_name_msg}) in '{session.current_channel}': {message_content[:60]}...")
-            # In real server: find other clients in session.current_channel and relay
-            # Here: Just acknowledge receipt by having sent CONFIRM.
+            log.debug("MSG from %s (%s) in '%s': %s...", client_addr, display_name_msg, session.current_channel, message_content[:60])
+            msg_trace = latency.start(session.current_channel, received_at) if latency is not None else None
+            # Relay to the other members of the channel
+            core.relay(session, display_name_msg, message_content, msg_trace)
+            metrics.broadcast_latency.observe(time.perf_counter() - received_at)
 
         elif msg_type == MSG_TYPE_BYE:
-            display_name_bye, remaining = unpack_string_from(content)
-            if display_name_bye is None: return print_err(f"Malformed BYE from {client_addr}: Cannot parse DisplayName")
-            print(f"BYE received from {client_addr} ({display_name_bye}). Session will be terminated.")
+            fields = unpack_strings(data, 1)
+            if fields is None: return print_err(f"Malformed BYE from {client_addr}: Cannot parse DisplayName")
+            display_name_bye = fields[0]
+            log.info(f"BYE received from {client_addr} ({display_name_bye}). Session will be terminated.")
             # Mark session for termination. CONFIRM already sent.
             terminate_session(client_addr, sock, "Client sent BYE")
 
@@ -356,195 +527,517 @@ def handle_dynamic_message(sock, data, client_addr):
         #    print(f"Received PING from client {client_addr}? Ignoring.")
 
         else:
-            print(f"Unhandled message type 0x{msg_type:02X} from {client_addr} in AUTHENTICATED state.")
-            # Send ERR
-            err_msg_id = session.get_next_server_msg_id()
-            err_msg = pack_err(err_msg_id, "Server", f"Invalid message type {msg_type} in current state.")
-            send_udp(session.socket, err_msg, session.client_addr)
-            terminate_session(client_addr, sock, "Sent ERR for invalid message type")
-
+            log.info(f"Unhandled message type 0x{msg_type:02X} from {client_addr} in AUTHENTICATED state.")
+            reject_session(session, f"Invalid message type {msg_type} in current state.")
+
+
+    elif session.state == SessionState.NEEDS_AUTH:
+        # Only sessions whose AUTH got REPLY NOK are here (with --auth-db); the client may try again
+        if msg_type == MSG_TYPE_AUTH:
+            fields = unpack_strings(data, 3)
+            if fields is None: return print_err(f"Malformed AUTH from {client_addr}: Cannot parse Username, DisplayName and Secret")
+            username, display_name_auth, secret = fields
+            log.debug("AUTH retry from %s: User='%s', Display='%s'", client_addr, username, display_name_auth)
+            authenticator.verify_later(username, secret, finish_auth_retry, session, msg_id, display_name_auth, received_at)
+        else:
+            log.info(f"Message type 0x{msg_type:02X} from {client_addr} before authentication.")
+            reject_session(session, "Not authenticated.")
 
-    elif session.state == "WAITING_REPLY_CONFIRM":
+    elif session.state == SessionState.WAITING_REPLY_CONFIRM:
          # Should only receive CONFIRM here ideally, but handle others defensively
-         print(f"Received message type 0x{msg_type:02X} from {client_addr} while waiting for AUTH REPLY CONFIRM. Ignoring.")
+         log.info(f"Received message type 0x{msg_type:02X} from {client_addr} while waiting for AUTH REPLY CONFIRM. Ignoring.")
          # Maybe send ERR if it's not a duplicate of the original AUTH?
          # For simplicity, ignore now. CONFIRM was already sent for this new message ID.
 
     else: # Should not happen (e.g., SENT_ERR, SENT_BYE states)
-        print(f"Received message type 0x{msg_type:02X} from {client_addr} in unexpected state {session.state}. Ignoring.")
+        log.info(f"Received message type 0x{msg_type:02X} from {client_addr} in unexpected state {session.state.name}. Ignoring.")
+
+
+def reject_session(session, content):
+    """Sends ERR; the session is torn down once the ERR is confirmed, or when its retries run out."""
+    err_msg_id = session.get_next_server_msg_id()
+    send_reliable(session, err_msg_id, pack_err(err_msg_id, "Server", content))
+    core.leave(session)
+    session.state = SessionState.SENT_ERR
 
 
 def print_err(message):
-    """Helper to print error messages."""
-    print(f"ERROR: {message}")
+    """Helper to log error messages."""
+    log.error(message)
     return None # To allow "return print_err(...)"
 
 
-def send_pings():
-    """Iterates through sessions and sends PING if needed."""
-    with sessions_lock:
-        now = time.time()
-        # Iterate over a copy of keys in case terminate_session modifies the dict
-        for client_addr in list(client_sessions.keys()):
-            session = client_sessions.get(client_addr)
-            if session and session.state == "AUTHENTICATED":
-                if now - session.last_ping_time > PING_INTERVAL:
-                    ping_msg_id = session.get_next_server_msg_id()
-                    ping_msg = pack_ping(ping_msg_id)
-                    print(f"Sending PING (MsgID: {ping_msg_id}) to {client_addr}")
-                    send_udp(session.socket, ping_msg, session.client_addr)
-                    session.last_ping_time = now
-
-
-def cleanup_inactive_sessions():
-    """Removes sessions that haven't seen activity."""
-    with sessions_lock:
-        now = time.time()
-        inactive_clients = []
-        for client_addr, session in client_sessions.items():
-            if now - session.last_activity_time > CLIENT_TIMEOUT:
-                inactive_clients.append((client_addr, session.socket))
-
-        for client_addr, sock in inactive_clients:
-             terminate_session(client_addr, sock, "Session timed out")
+def schedule_keepalive(session):
+    """Arms the session's PING and idle-expiry timers; called once when the session is created."""
+    now = clock()
+    session.ping_timer = timers.schedule(now + PING_INTERVAL, ping_session, session)
+    session.expiry_timer = timers.schedule(client_sessions.last_activity(session) + CLIENT_TIMEOUT, expire_session, session)
+
+
+def ping_session(session):
+    """Timer callback: sends PING to an authenticated session and re-arms the timer."""
+    if client_sessions.get(session.addr) is not session:
+        return # Session already terminated
+    now = clock()
+    if session.state == SessionState.AUTHENTICATED:
+        ping_msg_id = session.get_next_server_msg_id()
+        ping_msg = pack_ping(ping_msg_id)
+        log.debug("Sending PING (MsgID: %d) to %s", ping_msg_id, session.addr)
+        send_reliable(session, ping_msg_id, ping_msg)
+        metrics.pings_sent.inc()
+    session.ping_timer = timers.schedule(now + PING_INTERVAL, ping_session, session)
+
+
+def expire_session(session):
+    """Timer callback: terminates an idle session, or re-arms for its renewed deadline.
+
+    Activity only updates the session's last-activity column; the timer is re-armed lazily here,
+    so each session costs at most one heap operation per CLIENT_TIMEOUT period.
+    """
+    if client_sessions.get(session.addr) is not session:
+        return # Session already terminated
+    deadline = client_sessions.last_activity(session) + CLIENT_TIMEOUT
+    if clock() >= deadline:
+        # sessions_lock is not held here: terminate_session takes it itself
+        metrics.timeouts.inc("idle")
+        terminate_session(session.addr, session.socket, "Session timed out")
+    else:
+        session.expiry_timer = timers.schedule(deadline, expire_session, session)
 
 
 def terminate_session(client_addr, sock, reason="Unknown"):
     """Cleans up a client session."""
-    global monitored_sockets, socket_to_session
-    print(f"Terminating session for {client_addr}: {reason}")
+    log.info(f"Terminating session for {client_addr}: {reason}")
+    session = None
     with sessions_lock:
-        if client_addr in client_sessions:
-            del client_sessions[client_addr]
+        session = client_sessions.remove(client_addr)
         if sock in socket_to_session:
             del socket_to_session[sock]
-        if sock in monitored_sockets:
-            monitored_sockets.remove(sock)
+            selector.unregister(sock)
             try:
                 sock.close()
             except OSError as e:
-                print(f"Error closing dynamic socket for {client_addr}: {e}")
-        else:
-             print(f"WARN: Socket for {client_addr} not found in monitored list during termination.")
+                log.error(f"Error closing dynamic socket for {client_addr}: {e}")
+        elif sock not in reply_socket_pool: # Pooled sockets outlive the sessions they serve
+             log.warn(f"Socket for {client_addr} not found in monitored list during termination.")
+    if session:
+        timers.cancel(session.ping_timer)
+        timers.cancel(session.expiry_timer)
+        if session.outstanding:
+            for entry in session.outstanding.values():
+                timers.cancel(entry.timer)
+        session.outstanding = None
+        core.leave(session)
+        if latency is not None:
+            latency.forget(session)
+    if trace is not None:
+        trace.close_session(client_addr)
 
 
 def signal_handler(sig, frame):
     """Handles Ctrl+C for graceful shutdown."""
     global main_socket
-    print("\nShutting down server...")
+    log.info("Shutting down server...")
     # Close all dynamic sockets first
     with sessions_lock:
-         for client_addr, session in client_sessions.items():
-              print(f"Closing socket for {client_addr}...")
+         for session in client_sessions.values():
+              log.info(f"Closing socket for {session.addr}...")
               try:
                    session.socket.close()
               except OSError:
                    pass # Ignore errors on shutdown close
          client_sessions.clear()
-         monitored_sockets.clear()
          socket_to_session.clear()
+         selector.close()
 
+    if impairment is not None:
+        log.info(f"Impairment statistics: {impairment.describe()}")
+    if trace is not None:
+        trace.flush()
+        log.info(f"Trace: {trace.describe()}")
     if main_socket:
         try:
             main_socket.close()
-            print("Main server socket closed.")
+            log.info("Main server socket closed.")
         except OSError:
              pass # Ignore errors on shutdown close
     sys.exit(0)
 
 
-def start_server():
-    """Starts the UDP chat server."""
-    global main_socket, monitored_sockets
-    signal.signal(signal.SIGINT, signal_handler)
+def open_reply_socket():
+    """Creates a non-blocking UDP socket on an ephemeral port for server->client traffic."""
+    sock = make_socket(socket.AF_INET, socket.SOCK_DGRAM)
+    try:
+        sock.bind((HOST, 0)) # Bind to ephemeral port
+        sock.setblocking(False)
+    except OSError:
+        sock.close()
+        raise
+    return sock
+
+
+def raise_fd_limit():
+    """Lifts the soft open-files limit to the hard limit so 10k+ dedicated sockets fit."""
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft < hard:
+        try:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+            soft = hard
+        except (ValueError, OSError) as e:
+            log.warn(f"Could not raise open file limit: {e}")
+    log.info(f"Open file limit: {soft}")
+
+
+def deliver_from_bus(sock):
+    """Fans out MSG bodies other workers published to channels with sessions here."""
+    for channel_id, body in worker_bus.receive(sock):
+        for session in core.channels.members(channel_id):
+            session.deliver(body)
+        if core.history is not None:
+            core.history.record(channel_id, None, None, TRANSPORT, body)
+    if sock.fileno() < 0:
+        selector.unregister(sock) # Peer worker exited
+
+
+def handle_socket_error(sock, reason):
+    """Terminates the session owning a dedicated socket that reported an error."""
+    with sessions_lock:
+        client_addr_to_remove = socket_to_session.get(sock)
+    if client_addr_to_remove:
+        terminate_session(client_addr_to_remove, sock, reason)
+    else:
+        log.warn(f"{reason} on shared socket {sock.getsockname()}")
+
 
+def dispatch_datagram(sock, kind, data, addr):
+    """Routes one received datagram to the AUTH or session handler."""
+    if sock.fileno() < 0:
+        return # Delivered late by the impairment layer after the session's socket closed
     try:
-        main_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        main_socket.bind((HOST, PORT))
-        print(f"UDP Server listening on {HOST}:{PORT}...")
-        monitored_sockets.append(main_socket)
-    except OSError as e:
-        print(f"Error binding main socket: {e}")
-        sys.exit(1)
+        if kind == SOCKET_MAIN:
+            handle_auth(data, addr)
+        else: # Dedicated or pooled client socket
+            handle_dynamic_message(sock, data, addr)
+    except Exception as e:
+        log.error(f"Unexpected error handling datagram from {addr}: {e}")
+
+
+def receive_from(sock, kind):
+    """Drains up to RECV_BATCH datagrams from a readable socket and dispatches them."""
+    for _ in range(RECV_BATCH):
+        addr = None
+        try:
+            data, addr = sock.recvfrom(BUFFER_SIZE)
+            if not data:
+                # UDP doesn't typically signal close like TCP with 0 bytes
+                log.info(f"Received 0 bytes from {addr} on {sock.getsockname()}? Ignoring.")
+                continue
+            metrics.bytes_received.inc(amount=len(data))
+            if trace is not None:
+                trace.inbound(addr, data, FLAG_MAIN_SOCKET if kind == SOCKET_MAIN else 0)
+
+            if impairment is None:
+                dispatch_datagram(sock, kind, data, addr)
+            else:
+                impairment.deliver(dispatch_datagram, sock, kind, data, addr)
+            if sock.fileno() < 0:
+                return # Session was terminated and its socket closed
+
+        except BlockingIOError:
+            return # Socket drained
+
+        except ConnectionResetError: # Important for UDP on Windows
+             log.info(f"Connection reset by peer {addr} likely means port unreachable. Terminating session.")
+             handle_socket_error(sock, "ConnectionResetError")
+             return
+
+        except OSError as e:
+            log.error(f"Socket error receiving from {addr} on {sock.getsockname()}: {e}")
+            handle_socket_error(sock, f"Socket OSError: {e}")
+            return
+
+        except Exception as e:
+            log.error(f"Unexpected error handling readable socket {sock.getsockname()}: {e}")
+
+
+def handle_readable(sock, kind):
+    """Serves one readable socket registered with the selector under kind."""
+    if kind == SOCKET_BUS:
+        deliver_from_bus(sock)
+    elif kind == SOCKET_HANDOFF:
+        hand_off_sessions()
+    elif kind == SOCKET_AUTH:
+        authenticator.run_completed()
+    else:
+        receive_from(sock, kind)
+
+
+def open_server_sockets():
+    """Binds the main socket and the reply pool and registers them, and the worker bus, with the selector."""
+    global main_socket, reply_socket_cycle
+    main_socket = make_socket(socket.AF_INET, socket.SOCK_DGRAM)
+    if WORKERS > 1:
+        main_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1) # Kernel balances AUTHs across workers
+    main_socket.bind((HOST, PORT))
+    main_socket.setblocking(False)
+    log.info(f"UDP Server listening on {HOST}:{PORT}...")
+    selector.register(main_socket, selectors.EVENT_READ, SOCKET_MAIN)
+    for _ in range(REPLY_SOCKET_POOL_SIZE):
+        pooled = open_reply_socket()
+        reply_socket_pool.append(pooled)
+        selector.register(pooled, selectors.EVENT_READ, SOCKET_POOL)
+    if reply_socket_pool:
+        reply_socket_cycle = itertools.cycle(reply_socket_pool)
+        log.info(f"Serving sessions from {len(reply_socket_pool)} pooled reply sockets")
+    if worker_bus is not None:
+        for sock in worker_bus.sockets():
+            selector.register(sock, selectors.EVENT_READ, SOCKET_BUS)
+    if authenticator is not None:
+        selector.register(authenticator.wakeup_socket(), selectors.EVENT_READ, SOCKET_AUTH)
+
+
+# --- Live Handoff ---
+# A successor connecting to --handoff gets every socket and session, see
+# session_handoff.py. The loop is single-threaded, so the state is consistent
+# as soon as the handoff starts: the snapshot carries each session's protocol
+# state, its unconfirmed messages with their retransmission deadlines, its
+# PING deadline and the messages the rate limiter is holding back. Datagrams
+# the impairment layer is still delaying are not carried over; to the clients
+# they look like losses, which the retransmissions already cover. Neither are
+# AUTHs whose secret is still being checked (--auth-db): those clients have their
+# CONFIRM but no REPLY, and time out as if it had been lost.
+
+def hand_off_sessions():
+    """Handoff socket callback: passes everything to the successor and exits, or resumes if that fails."""
+    channel = accept_successor(handoff_listener)
+    if channel is None:
+        return
+    if hand_off(channel, handoff_listener, snapshot_server_state, time.time()):
+        exit_after_handoff()
+
+
+def snapshot_server_state():
+    """Returns the handoff snapshot and the sockets it refers to by index (main socket first, then the pool)."""
+    if trace is not None:
+        trace.flush() # The successor appends to the same file once it takes over
+    sockets = [main_socket] + reply_socket_pool
+    socket_index = {sock: index for index, sock in enumerate(sockets)}
+    position = {} # Key: SessionData, Value: index in the snapshot's sessions
+    sessions = []
+    for session in client_sessions.values():
+        index = socket_index.get(session.socket)
+        if index is None:
+            index = socket_index[session.socket] = len(sockets)
+            sockets.append(session.socket)
+        data = snapshot_session(session)
+        data.update(socket=index, activity=client_sessions.last_activity(session),
+                    server_message_id=session.server_message_id, seen_high=session.seen_high,
+                    seen_mask=session.seen_mask, auth_reply_id=session.auth_reply_id,
+                    srtt=session.srtt, rttvar=session.rttvar,
+                    ping=session.ping_timer.deadline if session.ping_timer is not None else None,
+                    outstanding=[[msg_id, encode_bytes(entry.data), entry.first_sent, entry.attempts, entry.timer.deadline]
+                                 for msg_id, entry in (session.outstanding or {}).items()])
+        position[session] = len(sessions)
+        sessions.append(data)
+    delayed = []
+    for timer in timers.pending():
+        if timer.callback is process_delayed_message and timer.args[0] in position:
+            session, _, data, msg_type, msg_id, _, _ = timer.args
+            delayed.append(["message", timer.deadline, encode_bytes(data), position[session], msg_type, msg_id])
+        elif timer.callback is handle_delayed_auth:
+            data, client_addr = timer.args
+            delayed.append(["auth", timer.deadline, encode_bytes(data), list(client_addr)])
+    snapshot = {"transport": TRANSPORT, "pool": len(reply_socket_pool), "sessions": sessions,
+                "channels": snapshot_channels(core.channels, position), "delayed": delayed,
+                "history": snapshot_history(core.history, TRANSPORT),
+                "trace": trace.export_sessions() if trace is not None else None}
+    return snapshot, sockets
+
+
+def take_over_sessions(takeover):
+    """Rebuilds sockets, sessions, timers and channels from a predecessor's snapshot."""
+    global main_socket, reply_socket_cycle
+    snapshot = takeover.snapshot
+    sockets = takeover.sockets
+    for sock in sockets:
+        sock.setblocking(False)
+    main_socket = sockets[0]
+    selector.register(main_socket, selectors.EVENT_READ, SOCKET_MAIN)
+    reply_socket_pool.extend(sockets[1:1 + snapshot["pool"]]) # The predecessor's pool size wins over --reply-pool
+    for pooled in reply_socket_pool:
+        selector.register(pooled, selectors.EVENT_READ, SOCKET_POOL)
+    if reply_socket_pool:
+        reply_socket_cycle = itertools.cycle(reply_socket_pool)
+    if authenticator is not None:
+        selector.register(authenticator.wakeup_socket(), selectors.EVENT_READ, SOCKET_AUTH)
+
+    now = clock()
+    sessions = []
+    for data in snapshot["sessions"]:
+        client_addr = tuple(data["addr"])
+        sock = sockets[data["socket"]]
+        session = SessionData(client_addr, sock)
+        restore_session(session, data)
+        session.server_message_id = data["server_message_id"]
+        session.seen_high = data["seen_high"]
+        session.seen_mask = data["seen_mask"]
+        session.auth_reply_id = data["auth_reply_id"]
+        session.srtt = data["srtt"]
+        session.rttvar = data["rttvar"]
+        client_sessions.add(client_addr, session, data["activity"])
+        if data["socket"] > snapshot["pool"]: # Dedicated to this session
+            selector.register(sock, selectors.EVENT_READ, SOCKET_DYNAMIC)
+            socket_to_session[sock] = client_addr
+        for msg_id, message_bytes, first_sent, attempts, deadline in data["outstanding"]:
+            entry = OutstandingMessage(decode_bytes(message_bytes), first_sent)
+            entry.attempts = attempts
+            entry.timer = timers.schedule(deadline, retransmit, session, msg_id)
+            if session.outstanding is None:
+                session.outstanding = {}
+            session.outstanding[msg_id] = entry
+        session.ping_timer = timers.schedule(data["ping"] or now + PING_INTERVAL, ping_session, session)
+        session.expiry_timer = timers.schedule(data["activity"] + CLIENT_TIMEOUT, expire_session, session)
+        sessions.append(session)
+    restore_channels(core.channels, snapshot["channels"], sessions)
+
+    received_at = time.perf_counter()
+    for kind, deadline, data, *rest in snapshot["delayed"]:
+        if kind == "auth":
+            timers.schedule(deadline, handle_delayed_auth, decode_bytes(data), tuple(rest[0]))
+        else:
+            index, msg_type, msg_id = rest
+            session = sessions[index]
+            timers.schedule(deadline, process_delayed_message, session, session.socket, decode_bytes(data),
+                            msg_type, msg_id, session.addr, received_at)
+    restore_history(core.history, snapshot["history"], TRANSPORT)
+    if trace is not None:
+        trace.adopt_sessions(snapshot["trace"])
+
 
-    last_ping_check_time = time.time()
-    last_cleanup_time = time.time()
+def start_server(takeover=None):
+    """Starts the UDP chat server, or resumes the sessions a predecessor handed over."""
+    signal.signal(signal.SIGINT, signal_handler)
+
+    if takeover is not None:
+        take_over_sessions(takeover)
+        takeover.complete(metrics)
+    else:
+        try:
+            open_server_sockets()
+        except OSError as e:
+            log.error(f"Error binding main socket: {e}")
+            sys.exit(1)
+    if handoff_listener is not None:
+        selector.register(handoff_listener, selectors.EVENT_READ, SOCKET_HANDOFF)
 
     while True:
         try:
-            # Use select with a timeout to allow periodic tasks
-            readable, _, exceptional = select.select(monitored_sockets, [], monitored_sockets, 1.0)
-
-            for sock in readable:
-                try:
-                    data, addr = sock.recvfrom(BUFFER_SIZE)
-                    if not data:
-                        # UDP doesn't typically signal close like TCP with 0 bytes
-                        print(f"Received 0 bytes from {addr} on {sock.getsockname()}? Ignoring.")
-                        continue
-
-                    if sock == main_socket:
-                        handle_auth(data, addr)
-                    else: # Must be a dynamic client socket
-                        handle_dynamic_message(sock, data, addr)
-
-                except ConnectionResetError: # Important for UDP on Windows
-                     print(f"Connection reset by peer {addr} likely means port unreachable. Terminating session.")
-                     # Find the session associated with the socket that got the error
-                     client_addr_to_remove = None
-                     with sessions_lock:
-                          for c_addr, sess in client_sessions.items():
-                              if sess.socket == sock:
-                                  client_addr_to_remove = c_addr
-                                  break
-                     if client_addr_to_remove:
-                         terminate_session(client_addr_to_remove, sock, "ConnectionResetError")
-                     else:
-                         print(f"WARN: ConnectionResetError on unknown dynamic socket {sock.getsockname()}")
-
-                except OSError as e:
-                    print(f"Socket error receiving from {addr} on {sock.getsockname()}: {e}")
-                    # Potentially terminate session if it's a dynamic socket?
-                    client_addr_to_remove = None
-                    with sessions_lock:
-                        if sock in socket_to_session:
-                            client_addr_to_remove = socket_to_session[sock]
-                    if client_addr_to_remove:
-                        terminate_session(client_addr_to_remove, sock, f"Socket OSError: {e}")
-
-                except Exception as e:
-                    print(f"Unexpected error handling readable socket {sock.getsockname()}: {e}")
-
-
-            for sock in exceptional:
-                print(f"Exceptional condition on socket {sock.getsockname()}. Terminating associated session.")
-                client_addr_to_remove = None
-                with sessions_lock:
-                     if sock in socket_to_session:
-                          client_addr_to_remove = socket_to_session[sock]
-                if client_addr_to_remove:
-                    terminate_session(client_addr_to_remove, sock, "Exceptional socket condition")
-                elif sock == main_socket:
-                     print("FATAL: Exceptional condition on main socket. Exiting.")
-                     signal_handler(signal.SIGINT, None) # Trigger shutdown
-
-
-            # --- Periodic Tasks ---
-            now = time.time()
-            if now - last_ping_check_time > 5: # Check every 5 seconds to send pings
-                 send_pings()
-                 last_ping_check_time = now
-
-            if now - last_cleanup_time > 10: # Check every 10 seconds for inactive clients
-                 cleanup_inactive_sessions()
-                 last_cleanup_time = now
+            # Wait until the next retransmission, PING or expiry deadline (at most 1 s)
+            timeout = 1.0
+            next_deadline = timers.next_deadline()
+            if next_deadline is not None:
+                timeout = min(timeout, max(next_deadline - clock(), 0))
+            for key, _ in selector.select(timeout=timeout):
+                handle_readable(key.fileobj, key.data)
+            if worker_bus is not None:
+                worker_bus.flush()
+
+            # --- Timers: retransmissions, PINGs and idle expiry, only those that are due ---
+            timers.run_due(clock())
 
 
         except KeyboardInterrupt:
             signal_handler(signal.SIGINT, None)
         except Exception as e:
-             print(f"FATAL: Unhandled exception in main loop: {e}")
+             log.error(f"Unhandled exception in main loop: {e}")
              signal_handler(signal.SIGINT, None) # Attempt graceful shutdown
 
+
+def parse_args():
+    """Parses command line options."""
+    parser = argparse.ArgumentParser(description="IPK25-CHAT UDP test server")
+    parser.add_argument("--reply-pool", type=int, default=REPLY_SOCKET_POOL_SIZE,
+                        help="Serve all sessions from N shared reply sockets instead of one per session")
+    impair = parser.add_argument_group("network impairment (percentages 0-100, times in ms)")
+    impair.add_argument("--loss", type=float, default=0, help="Drop this %% of packets")
+    impair.add_argument("--duplicate", type=float, default=0, help="Send this %% of packets twice")
+    impair.add_argument("--reorder", type=float, default=0, help="Hold back this %% of packets")
+    impair.add_argument("--reorder-window", type=int, default=3,
+                        help="A held packet is released after this many later packets")
+    impair.add_argument("--reorder-timeout", type=float, default=500,
+                        help="...or after this long if traffic is too sparse")
+    impair.add_argument("--delay", type=float, default=0, help="Mean one-way delay")
+    impair.add_argument("--jitter", type=float, default=0, help="Delay spread (uniform/normal) or floor (exponential)")
+    impair.add_argument("--delay-dist", choices=DELAY_DISTRIBUTIONS, default="uniform")
+    impair.add_argument("--impair", choices=("out", "in", "both"), default="out",
+                        help="Which direction the impairments apply to")
+    impair.add_argument("--seed", type=int, default=None, help="RNG seed for reproducible runs")
+    parser.add_argument("--confirm-timeout", type=float, default=CONFIRM_TIMEOUT,
+                        help="Seconds to wait for a CONFIRM before retransmitting")
+    parser.add_argument("--max-retries", type=int, default=MAX_RETRIES,
+                        help="Retransmissions before a silent session is terminated")
+    parser.add_argument("--workers", type=int, default=WORKERS,
+                        help="Fork N worker processes sharing the port via SO_REUSEPORT (1 = single process)")
+    add_history_arguments(parser)
+    add_rate_limit_arguments(parser)
+    add_auth_arguments(parser)
+    add_latency_arguments(parser)
+    add_trace_arguments(parser)
+    add_handoff_arguments(parser)
+    add_log_arguments(parser)
+    add_metrics_arguments(parser)
+    return parser.parse_args()
+
+
+def run_worker(bus, args):
+    """Entry point of a pre-fork worker: links the channel registry to the bus, then serves."""
+    global worker_bus, selector, trace
+    worker_bus = bus
+    selector.close() # The epoll instance was inherited from the parent; each worker needs its own
+    selector = selectors.DefaultSelector()
+    core.channels.on_channel_opened = bus.subscribe
+    core.channels.on_channel_closed = bus.unsubscribe
+    core.on_broadcast = publish_to_bus
+    start_metrics(metrics, args, bus.worker_id)
+    trace = trace_from_args(args, TRANSPORT, clock, bus.worker_id)
+    raise_fd_limit()
+    start_server()
+
+
 if __name__ == "__main__":
-    start_server()
\ No newline at end of file
+    args = parse_args()
+    REPLY_SOCKET_POOL_SIZE = args.reply_pool
+    CONFIRM_TIMEOUT = args.confirm_timeout
+    MAX_RETRIES = args.max_retries
+    WORKERS = args.workers
+    if args.handoff and WORKERS > 1:
+        raise SystemExit("--handoff needs a single process (--workers 1)")
+    configure_from_args(args)
+    core.history, core.history_replay = history_from_args(args)
+    if core.history is not None:
+        metrics.bind_history(core.history.memory_by_channel)
+    limiter = limiter_from_args(args, metrics.throttled.inc)
+    authenticator = authenticator_from_args(args)
+    latency = latency_from_args(args)
+    if latency is not None:
+        metrics.bind_latency(latency)
+    impairment_config = ImpairmentConfig(args.loss, args.duplicate, args.reorder, args.reorder_window,
+                                         args.reorder_timeout / 1000, args.delay / 1000, args.jitter / 1000,
+                                         args.delay_dist)
+    if impairment_config.is_active():
+        no_impairment = ImpairmentConfig()
+        impairment = ImpairedLink(impairment_config if args.impair in ("out", "both") else no_impairment,
+                                  impairment_config if args.impair in ("in", "both") else no_impairment,
+                                  timers, args.seed, clock)
+        log.info(f"Network impairment enabled ({args.impair}), seed={args.seed}")
+    if WORKERS > 1:
+        fork_workers(WORKERS, lambda bus: run_worker(bus, args))
+    else:
+        raise_fd_limit() # Before a takeover, which receives every dynamic socket at once
+        handoff_listener, takeover = handoff_from_args(args, TRANSPORT)
+        if takeover is None:
+            start_metrics(metrics, args)
+        else:
+            takeover.when_predecessor_exits(start_metrics, metrics, args) # It still holds the metrics port
+        trace = trace_from_args(args, TRANSPORT, clock)
+        start_server(takeover)
@@ -0,0 +1,134 @@
+import argparse
+import asyncio
+import json
+import sys
+import time
+
+import udp_server
+from load_generator import UdpVirtualClient, run_load
+from server_log import add_log_arguments, configure_from_args
+from simulation import SimSelector, SimulatedEventLoop, VirtualClock
+from timer_queue import TimerDriver
+from udp_impairment import ImpairedLink, ImpairmentConfig
+
+# --- Simulated UDP Soak ---
+# Runs udp_server.py and load_generator.py UDP clients in one process on a
+# SimulatedEventLoop (see simulation.py): the server's keepalives, expiry and
+# retransmission timers, the impairment delays and the clients' sleeps all run
+# on one virtual clock that jumps straight to the next deadline. A 24 hour run
+# costs only the CPU time of the messages it exchanges, and with a fixed --seed
+# the JSON report (everything except the "wall_s" figure) is identical between runs.
+# --vanish clients disappear without BYE after --vanish-after seconds, so the
+# PING retry and teardown path is exercised too.
+
+
+def add_simulation_arguments(parser):
+    group = parser.add_argument_group("simulation")
+    group.add_argument("--hours", type=float, default=24.0, help="Virtual duration of the load")
+    group.add_argument("--latency", type=float, default=1.0, help="One-way network latency in ms")
+    group.add_argument("--vanish", type=int, default=0,
+                       help="This many of the clients stop answering without BYE (e.g. crashed or roamed)")
+    group.add_argument("--vanish-after", type=float, default=300.0, help="Seconds after start a client vanishes")
+
+
+class VanishingClient(UdpVirtualClient):
+    """Authenticates and chats like any client, then goes silent: no BYE, no CONFIRMs, no PING replies."""
+    async def run(self, stop_at):
+        loop = asyncio.get_running_loop()
+        self.stats.count("sessions_started")
+        session = asyncio.ensure_future(self.session(stop_at))
+        await asyncio.wait((session,), timeout=max(min(self.args.vanish_after, stop_at - loop.time()), 0))
+        session.cancel() # Its finally block closes the socket; the server only notices by silence
+        self.stats.error("vanished")
+
+
+def attach_server(loop, args):
+    """Points udp_server at the loop's clock and network and binds its sockets there."""
+    udp_server.clock = loop.clock
+    udp_server.make_socket = loop.network.socket
+    udp_server.CONFIRM_TIMEOUT = args.confirm_timeout
+    udp_server.MAX_RETRIES = args.max_retries
+    driver = TimerDriver(loop, udp_server.timers, loop.clock)
+
+    def on_readable(sock, kind):
+        udp_server.receive_from(sock, kind)
+        driver.kick() # Handling may have scheduled a retransmission earlier than the next deadline
+
+    udp_server.selector = SimSelector(on_readable)
+    impairment = ImpairmentConfig(args.loss, args.duplicate, 0, delay=args.delay / 1000, jitter=args.jitter / 1000,
+                                  distribution="uniform")
+    if impairment.is_active():
+        udp_server.impairment = ImpairedLink(impairment, ImpairmentConfig(), udp_server.timers, args.seed, loop.clock)
+    udp_server.open_server_sockets()
+    return driver
+
+
+def server_report():
+    metrics = udp_server.metrics
+    counters = (metrics.messages_received, metrics.messages_sent, metrics.duplicates,
+                metrics.retransmissions, metrics.pings_sent, metrics.timeouts)
+    report = {}
+    for counter in counters:
+        samples = counter.samples()
+        report[counter.name] = samples[None] if list(samples) == [None] else samples
+    report["open_sessions"] = len(udp_server.client_sessions)
+    report["pending_timers"] = len(udp_server.timers)
+    return report
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Soak udp_server.py under simulated time")
+    parser.add_argument("--clients", type=int, default=1000)
+    parser.add_argument("--rate", type=float, default=0.0, help="MSG per second per client (0 = idle, PINGs only)")
+    parser.add_argument("--channels", type=int, default=10)
+    parser.add_argument("--session-lifetime", type=float, default=0.0,
+                        help="Reconnect every N seconds to churn sessions (0 = one session per client)")
+    parser.add_argument("--ramp", type=float, default=60.0, help="Seconds over which clients connect")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--loss", type=float, default=0, help="Drop this %% of server packets")
+    parser.add_argument("--duplicate", type=float, default=0, help="Send this %% of server packets twice")
+    parser.add_argument("--delay", type=float, default=0, help="Extra mean delay of server packets in ms")
+    parser.add_argument("--jitter", type=float, default=0, help="Delay spread in ms")
+    parser.add_argument("--confirm-timeout", type=float, default=udp_server.CONFIRM_TIMEOUT)
+    parser.add_argument("--max-retries", type=int, default=udp_server.MAX_RETRIES)
+    add_simulation_arguments(parser)
+    add_log_arguments(parser)
+    parser.set_defaults(log_level="warn")
+    args = parser.parse_args()
+    # Fields load_generator.run_load() expects
+    args.transport = "udp"
+    args.host, args.port = udp_server.HOST, udp_server.PORT
+    args.duration = args.hours * 3600
+    args.bad_auth = 0 # The simulated server accepts every AUTH
+    return args
+
+
+def main():
+    args = parse_args()
+    configure_from_args(args)
+    loop = SimulatedEventLoop(VirtualClock(), args.latency / 1000)
+    asyncio.set_event_loop(loop)
+    driver = attach_server(loop, args)
+
+    def make_client(client_id, *rest):
+        return (VanishingClient if client_id < args.vanish else UdpVirtualClient)(client_id, *rest)
+
+    started = time.perf_counter()
+    try:
+        report = loop.run_until_complete(run_load(args, make_client))
+        # Let the server notice the last silent sessions before reporting
+        loop.run_until_complete(asyncio.sleep(udp_server.PING_INTERVAL + udp_server.CONFIRM_TIMEOUT * (args.max_retries + 2)))
+    finally:
+        driver.stop()
+        loop.close()
+    report["server"] = server_report()
+    report["network"] = {"datagrams": loop.network.sent, "undeliverable": loop.network.undeliverable}
+    wall = time.perf_counter() - started
+    report["simulation"] = {"virtual_s": round(loop.clock(), 3), "wall_s": round(wall, 3)}
+    print(json.dumps(report, indent=2))
+    print(f"{loop.clock() / 3600:.1f} virtual hours in {wall:.1f} s ({loop.clock() / wall:.0f}x real time)",
+          file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
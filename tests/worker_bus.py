@@ -0,0 +1,240 @@
+import collections
+import os
+import signal
+import socket
+import struct
+import threading
+import traceback
+
+from server_log import log
+
+# --- Pre-fork Workers and Inter-worker Bus ---
+# With --workers N a server forks N processes that each bind HOST:PORT with
+# SO_REUSEPORT, so the kernel spreads connections (TCP) or AUTH datagrams (UDP)
+# over them and every worker runs the unchanged single-process session logic.
+# Channels span workers: the workers are connected by a full mesh of Unix
+# SOCK_SEQPACKET socketpairs created before fork(). A worker tells its peers
+# which channels it has local members in (SUBSCRIBE/UNSUBSCRIBE), and a
+# broadcast is published, already encoded, only to the peers subscribed to its
+# channel; the receiving worker fans it out to its own members.
+# Membership is eventually consistent: a member that joins in one worker may miss
+# a message published by another worker before its SUBSCRIBE arrived.
+
+BUS_SUBSCRIBE = 1
+BUS_UNSUBSCRIBE = 2
+BUS_PUBLISH = 3
+
+FRAME_HEADER = struct.Struct('>BH') # Kind, length of the channel id; then channel id and payload
+BUS_ENCODING = 'us-ascii'
+BUS_RECV_SIZE = 1 << 17 # Largest frame: a 64 KiB datagram body plus the channel id
+BUS_RECV_BATCH = 64 # Max frames drained from one peer per wakeup
+BUS_SOCKET_BUFFER = 1 << 20 # Room for bursts before a slow peer's frames start queueing in user space
+MAX_BACKLOG = 10000 # Frames queued per peer that stopped reading; newer frames are dropped beyond this
+
+
+class WorkerBus:
+    """One worker's end of the mesh: publishes encoded broadcasts to peers with members in the channel."""
+    def __init__(self, worker_id, peers):
+        self.worker_id = worker_id
+        self.peers = peers # Key: peer worker id, Value: connected SEQPACKET socket
+        self.socket_peer = {sock: peer_id for peer_id, sock in peers.items()}
+        self.interest = {peer_id: set() for peer_id in peers} # Channels each peer has members in
+        self.backlog = {peer_id: collections.deque() for peer_id in peers} # Frames the peer had no room for
+        self.backlog_size = 0
+        self.lock = threading.Lock() # Threaded TCP publishes from every client thread
+        self.published = 0
+        self.received = 0
+        self.dropped = 0
+        for sock in peers.values():
+            sock.setblocking(False)
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, BUS_SOCKET_BUFFER)
+
+    def sockets(self):
+        """Peer sockets to watch for readability."""
+        return list(self.peers.values())
+
+    def subscribe(self, channel_id):
+        """Announces that this worker now has local members in channel_id."""
+        self._send_all(self._frame(BUS_SUBSCRIBE, channel_id))
+
+    def unsubscribe(self, channel_id):
+        """Announces that the last local member left channel_id."""
+        self._send_all(self._frame(BUS_UNSUBSCRIBE, channel_id))
+
+    def publish(self, channel_id, payload):
+        """Hands an encoded broadcast to every peer with members in channel_id."""
+        with self.lock:
+            targets = [peer_id for peer_id, channels in self.interest.items() if channel_id in channels]
+            if not targets:
+                return
+            frame = self._frame(BUS_PUBLISH, channel_id, payload)
+            self.published += 1
+            for peer_id in targets:
+                self._send(peer_id, frame)
+
+    def receive(self, sock):
+        """Drains a readable peer socket. Returns [(channel_id, payload)] to fan out locally."""
+        deliveries = []
+        peer_id = self.socket_peer.get(sock)
+        if peer_id is None:
+            return deliveries
+        with self.lock:
+            for _ in range(BUS_RECV_BATCH):
+                try:
+                    frame = sock.recv(BUS_RECV_SIZE)
+                except BlockingIOError:
+                    break
+                except OSError as e:
+                    self._drop_peer(peer_id, f"receive failed: {e}")
+                    break
+                if not frame:
+                    self._drop_peer(peer_id, "worker exited")
+                    break
+                kind, channel_length = FRAME_HEADER.unpack_from(frame)
+                start = FRAME_HEADER.size
+                channel_id = frame[start:start + channel_length].decode(BUS_ENCODING)
+                if kind == BUS_PUBLISH:
+                    self.received += 1
+                    deliveries.append((channel_id, frame[start + channel_length:]))
+                elif kind == BUS_SUBSCRIBE:
+                    self.interest[peer_id].add(channel_id)
+                elif kind == BUS_UNSUBSCRIBE:
+                    self.interest[peer_id].discard(channel_id)
+            if self.backlog_size:
+                self._flush_locked()
+        return deliveries
+
+    def flush(self):
+        """Retries frames queued for peers that were not reading; cheap when nothing is queued."""
+        if self.backlog_size:
+            with self.lock:
+                self._flush_locked()
+
+    def describe(self):
+        return (f"worker={self.worker_id} peers={len(self.peers)} published={self.published} "
+                f"received={self.received} queued={self.backlog_size} dropped={self.dropped}")
+
+    def _frame(self, kind, channel_id, payload=b""):
+        encoded_channel = channel_id.encode(BUS_ENCODING)
+        return FRAME_HEADER.pack(kind, len(encoded_channel)) + encoded_channel + payload
+
+    def _send_all(self, frame):
+        with self.lock:
+            for peer_id in list(self.peers):
+                self._send(peer_id, frame)
+
+    def _send(self, peer_id, frame):
+        queue = self.backlog.get(peer_id)
+        if queue is None:
+            return # Peer already dropped
+        if queue:
+            self._enqueue(peer_id, queue, frame) # Keep per-peer order behind older frames
+            return
+        try:
+            self.peers[peer_id].send(frame)
+        except BlockingIOError:
+            self._enqueue(peer_id, queue, frame)
+        except OSError as e:
+            self._drop_peer(peer_id, f"send failed: {e}")
+
+    def _enqueue(self, peer_id, queue, frame):
+        if len(queue) >= MAX_BACKLOG:
+            self.dropped += 1
+            return
+        queue.append(frame)
+        self.backlog_size += 1
+
+    def _flush_locked(self):
+        for peer_id, queue in list(self.backlog.items()):
+            while queue:
+                try:
+                    self.peers[peer_id].send(queue[0])
+                except BlockingIOError:
+                    break
+                except OSError as e:
+                    self._drop_peer(peer_id, f"send failed: {e}")
+                    break
+                queue.popleft()
+                self.backlog_size -= 1
+
+    def _drop_peer(self, peer_id, reason):
+        log.warn("Worker bus: dropping peer worker %d (%s)", peer_id, reason)
+        sock = self.peers.pop(peer_id)
+        self.socket_peer.pop(sock, None)
+        self.interest.pop(peer_id, None)
+        self.backlog_size -= len(self.backlog.pop(peer_id))
+        sock.close()
+
+
+def fork_workers(count, run_worker):
+    """Forks count workers, each calling run_worker(bus), and waits for all of them in the parent.
+
+    Workers run in their own process group so a terminal Ctrl+C reaches only the
+    parent, which forwards one SIGINT to every worker; each worker then shuts down
+    through its usual SIGINT path.
+    """
+    pairs = {}
+    for first in range(count):
+        for second in range(first + 1, count):
+            pairs[(first, second)] = socket.socketpair(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+
+    workers = {} # Key: pid, Value: worker id
+    for worker_id in range(count):
+        pid = os.fork()
+        if pid == 0:
+            os.setpgid(0, 0)
+            peers = {}
+            for (first, second), (first_sock, second_sock) in pairs.items():
+                if first == worker_id:
+                    peers[second] = first_sock
+                    second_sock.close()
+                elif second == worker_id:
+                    peers[first] = second_sock
+                    first_sock.close()
+                else:
+                    first_sock.close()
+                    second_sock.close()
+            os._exit(_run_child(worker_id, peers, run_worker))
+        workers[pid] = worker_id
+    for first_sock, second_sock in pairs.values():
+        first_sock.close()
+        second_sock.close()
+
+    def forward(sig, frame):
+        for pid in workers:
+            try:
+                os.kill(pid, signal.SIGINT)
+            except ProcessLookupError:
+                pass # Already exited
+    signal.signal(signal.SIGINT, forward)
+    signal.signal(signal.SIGTERM, forward)
+    log.info(f"Started {count} worker processes: {sorted(workers)}")
+
+    while workers:
+        try:
+            pid, status = os.wait()
+        except ChildProcessError:
+            break
+        worker_id = workers.pop(pid, None)
+        code = os.waitstatus_to_exitcode(status)
+        if code != 0:
+            log.warn(f"Worker {worker_id} (pid {pid}) exited with status {code}")
+    log.flush()
+
+
+def _run_child(worker_id, peers, run_worker):
+    bus = WorkerBus(worker_id, peers)
+    log.set_context(worker=worker_id)
+    code = 0
+    try:
+        run_worker(bus)
+    except SystemExit as e:
+        code = e.code if isinstance(e.code, int) else 0
+    except KeyboardInterrupt:
+        pass
+    except BaseException:
+        log.error(f"Worker crashed:\n{traceback.format_exc()}")
+        code = 1
+    log.info(f"Worker bus statistics: {bus.describe()}")
+    log.flush()
+    return code